@@ -35,7 +35,9 @@ def generate_ldap_config() -> str:
     """
     config = ""
 
-    for experiment in Experiment.objects.filter(show_in_ldap_config=True):
+    experiments = Experiment.objects.filter(show_in_ldap_config=True)\
+        .prefetch_related('users')
+    for experiment in experiments:
         # Join all solis-id's together using a space
         user_string = " ".join(
             [user.username for user in experiment.users.all()]
@@ -28,7 +28,8 @@ class AdministrationHomeView(braces.StaffuserRequiredMixin, generic.ListView):
         if 'search' in self.request.GET:
             qs = qs.filter(title__icontains=self.request.GET['search'])
 
-        qs = qs.annotate(last_upload=models.Max('datapoint__date_added'))
+        qs = qs.annotate(last_upload=models.Max('datapoint__date_added'),
+                         num_datapoints=models.Count('datapoint'))
         order_by = '-date_created'
         if self.request.GET.get('sort') in ['date_created', 'last_upload', '-last_upload']:
             order_by = self.request.GET['sort']
@@ -0,0 +1,157 @@
+"""Async variants of the most used API views, for deployments that serve the
+application through webapp_datastore/asgi.py.
+
+Under ASGI, Django receives the request body asynchronously before the view
+is called, so a slow client does not occupy a worker thread while it is
+uploading. The views below then do their (blocking) parsing and database
+work in a bounded thread pool, reusing the logic of the regular views.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.http import JsonResponse
+from django.utils import translation
+from django.views import View
+from rest_framework.exceptions import APIException
+
+from .exceptions import get_error_details, get_error_headers
+from .throttling import latency_monitor
+from .views import MetadataView, ParticipantView, SessionUploadView, \
+    UploadView
+
+_executor = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.API_ASYNC_WORKERS,
+            thread_name_prefix='api-async',
+        )
+    return _executor
+
+
+def _run_with_connection(func, *args):
+    # The pool threads live outside of Django's request cycle, so we take
+    # care of stale connections ourselves
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def run_in_pool(func, *args):
+    """Runs a blocking function in the bounded thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(),
+        functools.partial(_run_with_connection, func, *args)
+    )
+
+
+class AsyncApiView(View):
+    """Base class for the async API views.
+
+    Every view wraps the corresponding regular view (sync_view_class), and
+    calls its methods in the thread pool. Errors are returned in the same
+    format as the regular API uses.
+    """
+    sync_view_class = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Like the DRF views, the API does not use session authentication
+        view.csrf_exempt = True
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        # API responses should always use English messages
+        with translation.override('en'):
+            try:
+                return await super().dispatch(request, *args, **kwargs)
+            except APIException as exc:
+                return JsonResponse(get_error_details(exc),
+                                    status=exc.status_code,
+                                    headers=get_error_headers(exc),
+                                    safe=False)
+
+    def get_sync_view(self):
+        return self.sync_view_class(
+            request=self.request,
+            args=self.args,
+            kwargs=self.kwargs,
+            format_kwarg=None,
+        )
+
+    async def run_view(self, func):
+        """Calls func with an instance of the wrapped view in the thread pool,
+        after checking the view's throttles, and returns its result"""
+        def _call():
+            view = self.get_sync_view()
+            with translation.override('en'), \
+                    connection.execute_wrapper(latency_monitor):
+                view.check_throttles(self.request)
+                return func(view)
+
+        return await run_in_pool(_call)
+
+    async def run(self, method, *args):
+        """Calls a method of the wrapped view in the thread pool, and returns
+        its result"""
+        return await self.run_view(lambda view: getattr(view, method)(*args))
+
+    async def call(self, method, *args):
+        """Like run, but returns the result as a JSON response"""
+        return JsonResponse(await self.run(method, *args), safe=False)
+
+    async def call_with_payload(self, method, *args):
+        """Like call, but passes the parsed request body as first argument.
+        Only meant for the upload views, as it honours Idempotency-Key."""
+        def _store(view):
+            return view.store_idempotent(
+                self.request,
+                lambda: getattr(view, method)(
+                    view.parse_payload(self.request), *args
+                )
+            )
+
+        return JsonResponse(await self.run_view(_store), safe=False)
+
+
+class AsyncMetadataView(AsyncApiView):
+    sync_view_class = MetadataView
+
+    async def get(self, request, access_key, field=None):
+        metadata = await self.run('get_metadata', field)
+        return MetadataView.finalize_metadata_response(
+            request,
+            JsonResponse(metadata, safe=False),
+            MetadataView.get_etag(field, metadata)
+        )
+
+
+class AsyncUploadView(AsyncApiView):
+    sync_view_class = UploadView
+
+    async def post(self, request, access_key):
+        return await self.call_with_payload('store_upload')
+
+
+class AsyncSessionUploadView(AsyncApiView):
+    sync_view_class = SessionUploadView
+
+    async def post(self, request, access_key, participant_id):
+        return await self.call_with_payload('store_upload', participant_id)
+
+
+class AsyncParticipantView(AsyncApiView):
+    sync_view_class = ParticipantView
+
+    async def post(self, request, access_key):
+        return await self.call('create_participant')
@@ -0,0 +1,57 @@
+"""Caches the experiments the API looks up by access id.
+
+Participants hit the same few experiments over and over, so the experiment
+and its (prefetched) target groups are kept in Django's cache, which makes
+is_open() and has_groups() free as well. The entries are invalidated by the
+signal handlers in api/signals.py whenever something they depend on changes.
+
+The cache is only used when API_EXPERIMENT_CACHE_TIMEOUT is set, as the
+invalidation has to reach every process serving the API.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+def get_cache_key(access_id) -> str:
+    return 'api:experiment:{}'.format(access_id)
+
+
+def normalize_access_id(access_id):
+    """Returns the access id as UUID, or None if it isn't a valid one. This
+    keeps one cache entry per experiment, whatever way the id was written."""
+    if isinstance(access_id, uuid.UUID):
+        return access_id
+    try:
+        return uuid.UUID(access_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_enabled() -> bool:
+    return settings.API_EXPERIMENT_CACHE_TIMEOUT is not None
+
+
+def get_cached_experiment(access_id):
+    if not is_enabled():
+        return None
+    return cache.get(get_cache_key(access_id))
+
+
+def cache_experiment(experiment):
+    if not is_enabled():
+        return
+    cache.set(get_cache_key(experiment.access_id), experiment,
+              settings.API_EXPERIMENT_CACHE_TIMEOUT)
+
+
+def invalidate_experiment(access_id):
+    if not is_enabled():
+        return
+    key = get_cache_key(access_id)
+    cache.delete(key)
+    # A request running concurrently with the current transaction could still
+    # cache the old rows, so we remove the entry once more after the commit
+    transaction.on_commit(lambda: cache.delete(key))
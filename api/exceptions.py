@@ -1,21 +1,74 @@
+import math
+
 from rest_framework import status
 from rest_framework.exceptions import APIException
 from rest_framework.views import exception_handler as default_exception_handler
 from rest_framework.response import Response
 
 
+class ResultCodes:
+    OK = "OK"
+    ERR_NO_ID = "ERR_NO_ID"
+    ERR_NO_DATA = "ERR_NO_DATA"
+    ERR_UNKNOWN_ID = "ERR_UNKNOWN_ID"
+    ERR_NOT_OPEN = "ERR_NOT_OPEN"
+    ERR_GROUP_ASSIGN_FAIL = "ERR_GROUP_ASSIGN_FAIL"
+    ERR_NO_SESSION = "ERR_NO_SESSION"
+    ERR_TOO_MANY_ITEMS = "ERR_TOO_MANY_ITEMS"
+    ERR_UNKNOWN_UPLOAD = "ERR_UNKNOWN_UPLOAD"
+    ERR_UPLOAD_LOCKED = "ERR_UPLOAD_LOCKED"
+    ERR_OFFSET_MISMATCH = "ERR_OFFSET_MISMATCH"
+    ERR_TOO_LARGE = "ERR_TOO_LARGE"
+    ERR_INCOMPLETE_UPLOAD = "ERR_INCOMPLETE_UPLOAD"
+    ERR_BAD_IDEMPOTENCY_KEY = "ERR_BAD_IDEMPOTENCY_KEY"
+    ERR_UNSUPPORTED_ENCODING = "ERR_UNSUPPORTED_ENCODING"
+    ERR_THROTTLED = "ERR_THROTTLED"
+    ERR_OVERLOADED = "ERR_OVERLOADED"
+
+
+def get_error_details(exc: APIException) -> dict:
+    details = exc.get_full_details()
+    if isinstance(details, list):
+        # sometimes it's a list?
+        details = details[-1]
+    details['result'] = details['code']
+    del details['code']
+    return details
+
+
+def get_error_headers(exc: APIException) -> dict:
+    headers = {}
+    if getattr(exc, 'auth_header', None):
+        headers['WWW-Authenticate'] = exc.auth_header
+    if getattr(exc, 'wait', None):
+        headers['Retry-After'] = '%d' % math.ceil(exc.wait)
+    return headers
+
+
 def exception_handler(exc, context):
     if isinstance(exc, APIException):
-        details = exc.get_full_details()
-        if isinstance(details, list):
-            # sometimes it's a list?
-            details = details[-1]
-        details['result'] = details['code']
-        del details['code']
-        return Response(details, status=exc.status_code)
+        return Response(get_error_details(exc), status=exc.status_code,
+                        headers=get_error_headers(exc))
 
     return default_exception_handler(exc, context)
 
 
 class ConfigError(APIException):
     status_code = status.HTTP_400_BAD_REQUEST
+
+
+class Conflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+
+
+class PayloadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+
+class Overloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    def __init__(self, wait=None, detail=None, code=None):
+        super().__init__(detail, code)
+        # Seconds after which the client may try again
+        self.wait = wait
@@ -0,0 +1,161 @@
+"""A write-ahead journal for text uploads.
+
+When settings.API_UPLOAD_JOURNAL_DIR is set, the upload views append the
+payloads to this journal instead of inserting them into the database. A
+record is fsynced before the upload is acknowledged, so it survives a crash.
+The drain_upload_journal management command then moves the records into
+DataPoint rows in batches.
+
+Every process writes to its own segment files, which it keeps locked with
+flock while it is writing to them. A segment is rotated once it exceeds
+settings.API_UPLOAD_JOURNAL_SEGMENT_SIZE. The drainer can tell a segment
+that is no longer written to by the missing lock; such a segment is removed
+once it is drained completely.
+
+A record is a header with the length and CRC32 of its body, followed by the
+body: a JSON object. Partially written records can only be found at the end
+of a segment, as a writer that fails halfway never writes to that segment
+again.
+"""
+import fcntl
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from django.conf import settings
+
+SEGMENT_SUFFIX = '.journal'
+HEADER = struct.Struct('>II')
+
+
+def encode_record(record: dict) -> bytes:
+    body = json.dumps(record, separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+class JournalWriter:
+    """Appends records to the segments of the current process"""
+
+    def __init__(self, directory, segment_size):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.fd = None
+        self.pid = None
+        self.offset = 0
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = '{:020d}-{}'.format(time.time_ns(), os.getpid())
+        temp_path = os.path.join(self.directory, '.' + name)
+        path = os.path.join(self.directory, name + SEGMENT_SUFFIX)
+
+        # The segment is locked before it gets its final name, so the drainer
+        # never mistakes a new segment for an abandoned one
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(temp_path, path)
+        self._fsync_directory()
+
+        self.fd = fd
+        self.pid = os.getpid()
+        self.offset = 0
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _close_segment(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def append(self, record: dict):
+        """Durably appends a record. When this returns, the record is on
+        disk."""
+        data = encode_record(record)
+        with self.lock:
+            if self.pid != os.getpid():
+                # After a fork, the segment (and its lock) belongs to the
+                # parent process
+                self.fd = None
+            if self.fd is not None and self.offset >= self.segment_size:
+                self._close_segment()
+            if self.fd is None:
+                self._open_segment()
+
+            try:
+                view = memoryview(data)
+                while view:
+                    written = os.write(self.fd, view)
+                    view = view[written:]
+                os.fsync(self.fd)
+            except OSError:
+                # The segment might end in a partial record now, so we never
+                # write to it again
+                self._close_segment()
+                raise
+            self.offset += len(data)
+
+    def close(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                self._close_segment()
+            self.fd = None
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> JournalWriter:
+    """Returns the writer of this process for the configured directory"""
+    global _writer
+    with _writer_lock:
+        directory = settings.API_UPLOAD_JOURNAL_DIR
+        if _writer is None or _writer.directory != directory:
+            if _writer is not None:
+                _writer.close()
+            _writer = JournalWriter(
+                directory,
+                settings.API_UPLOAD_JOURNAL_SEGMENT_SIZE
+            )
+        return _writer
+
+
+def is_enabled() -> bool:
+    return bool(settings.API_UPLOAD_JOURNAL_DIR)
+
+
+def list_segments(directory) -> list:
+    """Returns the names of all segments, oldest first"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        entry.name for entry in os.scandir(directory)
+        if entry.name.endswith(SEGMENT_SUFFIX)
+    )
+
+
+def read_records(segment, offset):
+    """Yields (record, end offset) for every complete record in an open
+    segment file, starting at offset. Stops at the first incomplete or
+    corrupt record."""
+    segment.seek(offset)
+    while True:
+        header = segment.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        length, checksum = HEADER.unpack(header)
+        body = segment.read(length)
+        if len(body) < length or zlib.crc32(body) != checksum:
+            return
+
+        offset += HEADER.size + length
+        yield json.loads(body), offset
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0020_experiment_max_upload_size"),
+        ("api", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdempotencyKey",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("key", models.CharField(max_length=255)),
+                ("response", models.JSONField(null=True)),
+                ("date_created", models.DateTimeField(auto_now_add=True, db_index=True)),
+                ("experiment", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="experiments.experiment")),
+            ],
+            options={
+                "unique_together": {("experiment", "key")},
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0002_idempotencykey"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="JournalCheckpoint",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("segment", models.CharField(max_length=255, unique=True)),
+                ("offset", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -1,3 +1,105 @@
+import fcntl
+import os
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+
+class ChunkedUpload(models.Model):
+    """A resumable binary upload that has not been finalized yet.
+
+    The bytes received so far are appended to a spool file on disk. The size
+    of that file is the current offset of the upload.
+    """
+    uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
+
+    session = models.ForeignKey(
+        'experiments.ParticipantSession',
+        on_delete=models.CASCADE
+    )
+
+    filename = models.CharField(max_length=255)
+
+    # The total size announced by the client, if any
+    size = models.PositiveBigIntegerField(null=True)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+    # Bumped on every received chunk, used to find abandoned uploads
+    date_updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def spool_path(self) -> str:
+        return os.path.join(settings.API_CHUNKED_UPLOAD_DIR, str(self.uuid))
+
+    def create_spool(self):
+        os.makedirs(settings.API_CHUNKED_UPLOAD_DIR, exist_ok=True)
+        open(self.spool_path, 'xb').close()
+
+    @contextmanager
+    def open_spool(self, mode='ab'):
+        """Opens the spool file with an exclusive lock.
+
+        Raises BlockingIOError if another request holds the lock, and
+        FileNotFoundError if the spool file no longer exists.
+        """
+        with open(self.spool_path, mode) as spool:
+            fcntl.flock(spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            yield spool
+
+    def get_offset(self) -> int:
+        return os.path.getsize(self.spool_path)
+
+    def discard(self):
+        """Deletes both this upload and its spool file"""
+        try:
+            os.remove(self.spool_path)
+        except FileNotFoundError:
+            pass
+        self.delete()
+
+    def __str__(self):
+        return "Upload {}".format(self.uuid)
+
+
+class IdempotencyKey(models.Model):
+    """The result of an upload that was sent with an Idempotency-Key header.
+
+    Clients retry uploads that timed out. When they send the same key again,
+    the stored result is returned instead of storing the upload twice. Keys
+    are removed by the api_sweep command once they expire.
+    """
+    KEY_MAX_LENGTH = 255
+
+    experiment = models.ForeignKey(
+        'experiments.Experiment',
+        on_delete=models.CASCADE
+    )
+
+    key = models.CharField(max_length=KEY_MAX_LENGTH)
+
+    # The response body of the original request
+    response = models.JSONField(null=True)
+
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ['experiment', 'key']
+
+    def __str__(self):
+        return "Idempotency key {}".format(self.key)
+
+
+class JournalCheckpoint(models.Model):
+    """How far the drain_upload_journal command got in a journal segment.
+
+    It is updated in the same transaction as the datapoints it stored, so a
+    crashed drain never stores a record twice.
+    """
+    segment = models.CharField(max_length=255, unique=True)
+
+    offset = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return "{} @ {}".format(self.segment, self.offset)
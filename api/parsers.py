@@ -1,7 +1,216 @@
+import zlib
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError, UnsupportedMediaType
 from rest_framework.parsers import BaseParser
 
+from .exceptions import PayloadTooLarge, ResultCodes
+
+try:
+    import brotli
+except ImportError:
+    # Brotli support is optional
+    brotli = None
+
+
+class TextPayload(str):
+    """A parsed piece of text, which also knows its size in bytes as it was
+    received"""
+    def __new__(cls, text, size):
+        payload = super().__new__(cls, text)
+        payload.size = size
+        return payload
+
+
+class ZlibDecoder:
+    """Streaming decoder for gzip and deflate encoded bodies"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.decompressor = None
+
+    def _create_decompressor(self, data):
+        if self.encoding != 'deflate':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        # 'deflate' should mean zlib wrapped data, but some clients send raw
+        # deflate data instead. A zlib stream starts with a recognizable header
+        if len(data) >= 2 and data[0] & 0x0f == 8 and \
+                (data[0] << 8 | data[1]) % 31 == 0:
+            return zlib.decompressobj(zlib.MAX_WBITS)
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decode(self, data, chunk_size):
+        """Yields the decoded data in pieces of at most chunk_size bytes, so
+        a highly compressed body never has to fit in memory at once"""
+        if self.decompressor is None:
+            self.decompressor = self._create_decompressor(data)
+
+        while True:
+            chunk = self.decompressor.decompress(data, chunk_size)
+            if chunk:
+                yield chunk
+            data = self.decompressor.unconsumed_tail
+            if self.decompressor.eof and self.decompressor.unused_data:
+                data = self._restart(self.decompressor.unused_data)
+                continue
+            if not data and len(chunk) < chunk_size:
+                break
+
+    def _restart(self, data):
+        """Starts on the next member of a gzip body, which may consist of
+        several concatenated members. Anything else after the end of the
+        stream is refused."""
+        if self.encoding == 'deflate':
+            raise zlib.error('unexpected data after the end of the stream')
+        self.decompressor = self._create_decompressor(data)
+        return data
 
-class PlainTextParser(BaseParser):
+    def is_finished(self) -> bool:
+        return self.decompressor is not None and self.decompressor.eof
+
+
+class BrotliDecoder:
+    """Streaming decoder for brotli encoded bodies"""
+
+    def __init__(self, encoding):
+        self.decompressor = brotli.Decompressor()
+
+    def decode(self, data, chunk_size):
+        """Yields the decoded data in pieces of roughly chunk_size bytes"""
+        # The output limit makes the decompressor hold back the rest of the
+        # output, which we then collect with empty calls until it runs dry
+        chunk = self.decompressor.process(data, output_buffer_limit=chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.decompressor.process(b'',
+                                              output_buffer_limit=chunk_size)
+
+    def is_finished(self) -> bool:
+        return self.decompressor.is_finished()
+
+
+DECODERS = {
+    'gzip': ZlibDecoder,
+    'x-gzip': ZlibDecoder,
+    'deflate': ZlibDecoder,
+}
+if brotli is not None:
+    DECODERS['br'] = BrotliDecoder
+
+# The errors the decoders raise on corrupt data
+DECODE_ERRORS = (zlib.error, ) + ((brotli.error, ) if brotli else ())
+
+
+class LimitedBodyParser(BaseParser):
+    """
+    Base parser that reads the request body in bounded blocks into a spooled
+    temporary buffer, which moves to disk for large bodies.
+
+    A body larger than the upload limit of the view is rejected before it is
+    read completely.
+
+    Bodies with a gzip, deflate or (if the brotli package is installed) br
+    Content-Encoding are decoded while reading. The upload limit then applies
+    to the decoded body, which is what gets stored.
+    """
+    # Size of the blocks in which the body is read
+    block_size = 64 * 1024
+    # Bodies up to this size are buffered in memory, larger ones on disk
+    spool_size = 1024 * 1024
+
+    def get_limit(self, parser_context) -> int:
+        view = parser_context.get('view')
+        if hasattr(view, 'get_upload_limit'):
+            return view.get_upload_limit()
+        return settings.API_MAX_UPLOAD_SIZE
+
+    def get_decoder(self, request):
+        """Returns a decoder for the Content-Encoding of the request, or None
+        if the body isn't encoded"""
+        if request is None:
+            return None
+
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '')\
+            .strip().lower()
+        if encoding in ('', 'identity'):
+            return None
+        if encoding not in DECODERS:
+            raise UnsupportedMediaType(
+                encoding,
+                code=ResultCodes.ERR_UNSUPPORTED_ENCODING,
+                detail='Unsupported content encoding "{}"'.format(encoding)
+            )
+
+        return DECODERS[encoding](encoding)
+
+    def read_body(self, stream, parser_context):
+        """Returns a buffer containing the (decoded) body, positioned at the
+        start, and the size of the body"""
+        limit = self.get_limit(parser_context)
+
+        request = parser_context.get('request')
+        if request is not None:
+            try:
+                content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                content_length = 0
+            if content_length > limit:
+                self.too_large(limit)
+        decoder = self.get_decoder(request)
+
+        buffer = SpooledTemporaryFile(max_size=self.spool_size)
+        received = 0
+        size = 0
+        try:
+            while stream is not None:
+                block = stream.read(self.block_size)
+                if not block:
+                    break
+
+                received += len(block)
+                if received > limit:
+                    self.too_large(limit)
+
+                chunks = decoder.decode(block, self.block_size) if decoder \
+                    else (block, )
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > limit:
+                        self.too_large(limit)
+                    buffer.write(chunk)
+
+            if decoder is not None and received and \
+                    not decoder.is_finished():
+                raise ParseError('Could not decode body - incomplete data')
+        except DECODE_ERRORS as e:
+            buffer.close()
+            raise ParseError('Could not decode body - {}'.format(e))
+        except Exception:
+            buffer.close()
+            raise
+
+        buffer.seek(0)
+        return buffer, size
+
+    @staticmethod
+    def too_large(limit):
+        raise PayloadTooLarge(
+            code=ResultCodes.ERR_TOO_LARGE,
+            detail='Uploads can be at most {} bytes'.format(limit)
+        )
+
+    @staticmethod
+    def decode(data: bytes, parser_context) -> str:
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError as e:
+            raise ParseError('Could not decode body - {}'.format(e))
+
+
+class PlainTextParser(LimitedBodyParser):
     """
     Plain text parser. As the name would suggest, it only reads in the data
     as a Python string.
@@ -10,6 +219,30 @@ class PlainTextParser(BaseParser):
 
     def parse(self, stream, media_type=None, parser_context=None):
         """
-        Simply return a string representing the body of the request.
+        Return a TextPayload (a string) representing the body of the request.
         """
-        return stream.read()
+        parser_context = parser_context or {}
+        buffer, size = self.read_body(stream, parser_context)
+        with buffer:
+            # Reading an exact size avoids growing (and copying) the result.
+            # The bytes are released before the text is copied into the
+            # TextPayload, so there are never more than two copies around.
+            text = self.decode(buffer.read(size), parser_context)
+        return TextPayload(text, size)
+
+
+class NDJSONParser(LimitedBodyParser):
+    """
+    Newline-delimited parser. Returns a list with a TextPayload for every line
+    of the body, leaving the lines themselves untouched.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        buffer, _ = self.read_body(stream, parser_context)
+        with buffer:
+            return [
+                TextPayload(self.decode(line, parser_context), len(line))
+                for line in (line.rstrip(b'\r\n') for line in buffer)
+            ]
@@ -1,3 +1,5 @@
+import json
+
 from rest_framework.serializers import ModelSerializer
 
 from experiments.models import ParticipantSession
@@ -7,3 +9,14 @@ class ParticipantSerializer(ModelSerializer):
     class Meta:
         model = ParticipantSession
         fields = ['uuid', 'state', 'group_name', 'subject_id']
+
+
+def iter_json_array(items, serializer_class):
+    """Serializes items into a JSON array, one item at a time, for use in a
+    streaming response"""
+    yield '['
+    for i, item in enumerate(items):
+        if i:
+            yield ','
+        yield json.dumps(serializer_class(item).data)
+    yield ']'
@@ -0,0 +1,77 @@
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from experiments.models import Experiment, ParticipantSession, \
+    TargetGroup, session_completed
+from .cache import invalidate_experiment, is_enabled
+
+
+def _invalidate_related_experiment(instance):
+    # The experiment is nearly always loaded already, in which case this
+    # does not need a query
+    if type(instance).experiment.is_cached(instance):
+        invalidate_experiment(instance.experiment.access_id)
+        return
+
+    access_id = Experiment.objects.filter(pk=instance.experiment_id)\
+        .values_list('access_id', flat=True)\
+        .first()
+    if access_id:
+        invalidate_experiment(access_id)
+
+
+@receiver(post_save, sender=Experiment)
+@receiver(post_delete, sender=Experiment)
+def on_experiment_changed(sender, instance: Experiment, *args, **kwargs):
+    invalidate_experiment(instance.access_id)
+
+
+@receiver(post_save, sender=TargetGroup)
+@receiver(post_delete, sender=TargetGroup)
+def on_target_group_changed(sender, instance: TargetGroup, *args, **kwargs):
+    _invalidate_related_experiment(instance)
+
+
+@receiver(post_save, sender=ParticipantSession)
+def on_participant_session_saved(
+        sender,
+        instance: ParticipantSession,
+        created,
+        *args,
+        **kwargs):
+    """Only completed sessions count towards a group's completion target, so
+    only those can change whether the experiment is open"""
+    if created and instance.state == ParticipantSession.COMPLETED:
+        _invalidate_related_experiment(instance)
+
+
+@receiver(post_delete, sender=ParticipantSession)
+def on_participant_session_delete(
+        sender,
+        instance: ParticipantSession,
+        *args,
+        **kwargs):
+    if instance.state == ParticipantSession.COMPLETED:
+        _invalidate_related_experiment(instance)
+
+
+@receiver(session_completed, sender=ParticipantSession)
+def on_participant_session_completed(
+        sender,
+        instance: ParticipantSession,
+        *args,
+        **kwargs):
+    """Upload views complete a session on nearly every request, so the cached
+    experiment is only invalidated when this closes the group, and with it
+    maybe the experiment. The cached groups' counters may lag behind until
+    then, but is_open() is all the API uses them for."""
+    # Only completions while open count towards the completion target
+    if not is_enabled() or instance.experiment_state != Experiment.OPEN:
+        return
+
+    if TargetGroup.objects.filter(
+            pk=instance.group_id,
+            completed_count__gte=F('completion_target')
+    ).exists():
+        _invalidate_related_experiment(instance)
@@ -1,17 +1,47 @@
+import gzip
 import io
 import json
 import math
+import os
 import random
+import shutil
+import tempfile
+import tracemalloc
 import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest.mock import patch
 
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TransactionTestCase, override_settings, \
+    skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework.test import APITestCase
+from django.utils import timezone
+from rest_framework.exceptions import ParseError, UnsupportedMediaType
+from rest_framework.test import APIClient, APITestCase
 
-from experiments.models import Experiment, ParticipantSession
+from experiments.models import DataPoint, Experiment, ParticipantSession
+from . import journal
+from .models import ChunkedUpload, IdempotencyKey, JournalCheckpoint
+from .exceptions import PayloadTooLarge
+from .parsers import PlainTextParser, brotli
+from .throttling import latency_monitor
 from .views import ResultCodes
 
 
-class TestExperimentApi(APITestCase):
+class ApiTestCase(APITestCase):
+    def setUp(self):
+        # Rolling back the test's transaction does not reach the experiment
+        # cache, so an experiment from setUpTestData could still be cached
+        # as a previous test left it
+        cache.clear()
+
+
+class TestExperimentApi(ApiTestCase):
     @classmethod
     def setUpTestData(cls):
         access_id = uuid.uuid4()
@@ -41,6 +71,46 @@ class TestExperimentApi(APITestCase):
         self.assertEqual(self.exp.datapoint_set.count(), 1)
         self.assertEqual(json.loads(self.exp.datapoint_set.first().data), {'key': 'value'})
 
+    def test_upload_size(self):
+        self.exp.state = Experiment.OPEN
+        self.exp.approved = True
+        self.exp.save()
+
+        data = json.dumps({'key': 'välue'})
+        self.client.post(reverse('api:upload', args=[self.exp.access_id]), data, content_type='text/plain')
+        self.assertEqual(self.exp.datapoint_set.first().size, len(data.encode('utf-8')))
+
+    def test_upload_too_large(self):
+        self.exp.state = Experiment.OPEN
+        self.exp.approved = True
+        self.exp.max_upload_size = 10
+        self.exp.save()
+
+        response = self._upload()
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post(reverse('api:upload', args=[self.exp.access_id]), 'A' * 11,
+                                    content_type='text/plain')
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_TOO_LARGE)
+        self.assertEqual(self.exp.datapoint_set.count(), 1)
+
+    def test_upload_compressed(self):
+        self.exp.state = Experiment.OPEN
+        self.exp.approved = True
+        self.exp.save()
+
+        data = json.dumps({'key': 'välue' * 100})
+        response = self.client.post(reverse('api:upload', args=[self.exp.access_id]),
+                                    gzip.compress(data.encode('utf-8')),
+                                    content_type='text/plain', HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+
+        # Stored exactly as if it was sent uncompressed
+        dp = self.exp.datapoint_set.get()
+        self.assertEqual(dp.data, data)
+        self.assertEqual(dp.size, len(data.encode('utf-8')))
+
     def test_upload_not_found(self):
         response = self.client.post(reverse('api:upload', args=[uuid.uuid4()]), {}, content_type='text/plain')
         self.assertEqual(response.status_code, 404)
@@ -64,13 +134,38 @@ class TestExperimentApi(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['state'], 'Open')
 
+    @override_settings(API_EXPERIMENT_CACHE_TIMEOUT=60)
+    def test_get_metadata_etag(self):
+        url = reverse('api:metadata_field', args=[self.exp.access_id, 'state'])
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('max-age=5', response['Cache-Control'])
+
+        # The experiment is cached by now, so a poll needs no queries at all
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        self.exp.state = Experiment.OPEN
+        self.exp.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), 'Open')
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(API_METADATA_CACHE_CONTROL={'no_cache': True})
+    def test_get_metadata_cache_control(self):
+        response = self.client.get(reverse('api:metadata', args=[self.exp.access_id]))
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
     def test_get_metadata_not_found(self):
         response = self.client.get(reverse('api:metadata', args=[uuid.uuid4()]))
         self.assertEqual(response.status_code, 404)
         self.assertEqual(response.json()['result'], ResultCodes.ERR_UNKNOWN_ID)
 
 
-class TestTargetGroupAllocation(APITestCase):
+class TestTargetGroupAllocation(ApiTestCase):
     @classmethod
     def setUpTestData(cls):
         access_id = uuid.uuid4()
@@ -139,6 +234,62 @@ class TestTargetGroupAllocation(APITestCase):
         entries = [dp.data for dp in self.exp.datapoint_set.all()]
         self.assertEqual(set(entries), set([data1, data2]))
 
+    def _upload_batch(self, session, lines):
+        return self.client.post(reverse('api:upload_batch', args=[self.exp.access_id, session.uuid]),
+                                '\n'.join(lines),
+                                content_type='application/x-ndjson')
+
+    def test_upload_batch(self):
+        session = self.exp.participantsession_set.create(group=self.group_a)
+        lines = [json.dumps({'trial': i}) for i in range(3)]
+        response = self._upload_batch(session, [lines[0], '', lines[1], lines[2]])
+        self.assertEqual(response.status_code, 200)
+
+        j = response.json()
+        self.assertEqual(j['result'], ResultCodes.OK)
+        self.assertEqual([item['result'] for item in j['items']],
+                         [ResultCodes.OK, ResultCodes.ERR_NO_DATA, ResultCodes.OK, ResultCodes.OK])
+        self.assertEqual([item.get('number') for item in j['items']], [1, None, 2, 3])
+
+        data_points = self.exp.datapoint_set.order_by('number')
+        self.assertEqual([dp.data for dp in data_points], lines)
+        self.assertTrue(all(dp.session == session for dp in data_points))
+        session.refresh_from_db()
+        self.assertEqual(session.state, ParticipantSession.COMPLETED)
+
+    def test_upload_batch_no_data(self):
+        session = self.exp.participantsession_set.create(group=self.group_a)
+        response = self._upload_batch(session, ['', ''])
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_NO_DATA)
+        self.assertEqual(self.exp.datapoint_set.count(), 0)
+
+    @override_settings(API_BATCH_UPLOAD_MAX_ITEMS=2)
+    def test_upload_batch_too_many_items(self):
+        session = self.exp.participantsession_set.create(group=self.group_a)
+        response = self._upload_batch(session, ['1', '2', '3'])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_TOO_MANY_ITEMS)
+        self.assertEqual(self.exp.datapoint_set.count(), 0)
+
+    def test_upload_batch_constant_queries(self):
+        session = self.exp.participantsession_set.create(group=self.group_a)
+
+        def _count_queries(n):
+            with CaptureQueriesContext(connection) as ctx:
+                self._upload_batch(session, [json.dumps({'trial': i}) for i in range(n)])
+            return len(ctx)
+
+        def _count_single_queries(n):
+            with CaptureQueriesContext(connection) as ctx:
+                for i in range(n):
+                    self.client.post(reverse('api:upload', args=[self.exp.access_id, session.uuid]),
+                                     json.dumps({'trial': i}),
+                                     content_type='text/plain')
+            return len(ctx)
+
+        self.assertEqual(_count_queries(1), _count_queries(50))
+        self.assertLess(_count_queries(50), _count_single_queries(50))
+
     def test_create_participant_fail_when_not_open(self):
         self.exp.state = Experiment.CLOSED
         self.exp.save()
@@ -238,6 +389,76 @@ class TestTargetGroupAllocation(APITestCase):
             # should keep trying to assign us to B
             self.assertEqual(self.exp.get_next_group(), self.group_b)
 
+    def test_get_next_group_bounded_queries(self):
+        self.exp.participantsession_set.create(group=self.group_a).complete()
+
+        def _count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                self.exp.get_next_group()
+            return len(ctx)
+
+        queries = _count_queries()
+        for i in range(20):
+            group = self.exp.targetgroup_set.create(name=str(i), completion_target=2)
+            self.exp.participantsession_set.create(group=group)
+
+        self.assertEqual(_count_queries(), queries)
+
+    def _create_participants(self, count):
+        return self.client.post(reverse('api:participant_batch', args=[self.exp.access_id]),
+                                {'count': count}, format='json')
+
+    def test_create_participant_batch(self):
+        response = self._create_participants(5)
+        self.assertEqual(response.status_code, 200)
+        participants = json.loads(b''.join(response.streaming_content))
+
+        self.assertEqual([p['group_name'] for p in participants], ['A', 'B', 'A', 'B', 'A'])
+        self.assertEqual([p['subject_id'] for p in participants], [1, 2, 3, 4, 5])
+        self.assertEqual(self.exp.participantsession_set.count(), 5)
+        self.group_a.refresh_from_db()
+        self.assertEqual(self.group_a.num_started, 3)
+
+        # The next participant continues where the batch left off
+        response = self.client.post(reverse('api:participant', args=[self.exp.access_id]))
+        self.assertEqual(response.json()['group_name'], 'B')
+        self.assertEqual(response.json()['subject_id'], 6)
+
+    def test_create_participant_batch_rebalance(self):
+        self.exp.participantsession_set.create(group=self.group_a)
+        self.exp.participantsession_set.create(group=self.group_b).complete()
+
+        participants = json.loads(b''.join(self._create_participants(3).streaming_content))
+        # The group with the fewest completed sessions first, then in turn
+        self.assertEqual([p['group_name'] for p in participants], ['A', 'B', 'A'])
+
+    def test_create_participant_batch_constant_queries(self):
+        def _count_queries(count):
+            with CaptureQueriesContext(connection) as ctx:
+                b''.join(self._create_participants(count).streaming_content)
+            return len(ctx)
+
+        # Warm up the experiment cache
+        _count_queries(1)
+        self.assertEqual(_count_queries(1), _count_queries(100))
+
+    @override_settings(API_PARTICIPANT_BATCH_MAX_SIZE=2)
+    def test_create_participant_batch_invalid_count(self):
+        response = self._create_participants(3)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_TOO_MANY_ITEMS)
+
+        self.assertEqual(self._create_participants(0).status_code, 400)
+        self.assertEqual(self._create_participants('many').status_code, 400)
+        self.assertEqual(self.exp.participantsession_set.count(), 0)
+
+    def test_allocate_sessions_command(self):
+        out = io.StringIO()
+        call_command('allocate_sessions', str(self.exp.access_id), '4', stdout=out)
+        participants = json.loads(out.getvalue())
+        self.assertEqual([p['group_name'] for p in participants], ['A', 'B', 'A', 'B'])
+        self.assertEqual(len({p['uuid'] for p in participants}), 4)
+
     def test_upload_fail_without_session(self):
         # if the experiment has target groups configured, then it should no longer
         # be possible to upload data without a session id
@@ -262,3 +483,822 @@ class TestTargetGroupAllocation(APITestCase):
         self.assertEqual(response.status_code, 204)
 
         self.assertEqual(self.exp.datapoint_set.last().file.read(), data.getvalue())
+
+
+@override_settings(API_EXPERIMENT_CACHE_TIMEOUT=60)
+class TestExperimentCache(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True
+        )
+        cls.session = cls.exp.create_session()
+
+    def _get_metadata(self):
+        return self.client.get(reverse('api:metadata', args=[self.exp.access_id]))
+
+    def _upload(self):
+        return self.client.post(reverse('api:upload', args=[self.exp.access_id, self.session.uuid]),
+                                'data', content_type='text/plain')
+
+    def test_metadata_without_queries(self):
+        self._get_metadata()
+        with self.assertNumQueries(0):
+            response = self._get_metadata()
+        self.assertEqual(response.json()['state'], 'Open')
+
+    def test_upload_saves_experiment_queries(self):
+        def _count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self._upload().status_code, 200)
+            return len(ctx)
+
+        # The first upload completes the session, which needs more queries
+        self._upload()
+        warm = _count_queries()
+        cache.clear()
+        cold = _count_queries()
+        # Neither the experiment nor its groups are queried on a cache hit
+        self.assertEqual(cold - warm, 2)
+
+    def test_plain_uploads_keep_experiment_cached(self):
+        # Every plain upload completes a new session, which only invalidates
+        # the cache once the group reaches its completion target
+        url = reverse('api:upload', args=[self.exp.access_id])
+        counts = []
+        for _ in range(3):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.post(url, 'data',
+                                            content_type='text/plain')
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(ctx))
+
+        warm = counts[-1]
+        self.assertEqual(counts, [warm + 2, warm, warm])
+
+    @override_settings(API_EXPERIMENT_CACHE_TIMEOUT=None)
+    def test_disabled(self):
+        # Every request looks the experiment up again
+        with CaptureQueriesContext(connection) as first:
+            self._get_metadata()
+        with CaptureQueriesContext(connection) as second:
+            self._get_metadata()
+        self.assertGreater(len(second), 0)
+        self.assertEqual(len(first), len(second))
+
+    def test_invalidated_on_experiment_change(self):
+        self._get_metadata()
+        self.exp.state = Experiment.CLOSED
+        self.exp.save()
+        self.assertEqual(self._get_metadata().json()['state'], 'Closed')
+
+    def test_invalidated_on_group_change(self):
+        self.client.post(reverse('api:participant', args=[self.exp.access_id]))
+        group = self.exp.targetgroup_set.get()
+        group.completion_target = 0
+        group.save()
+
+        response = self.client.post(reverse('api:participant', args=[self.exp.access_id]))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_NOT_OPEN)
+
+    def test_invalidated_on_completion(self):
+        group = self.exp.targetgroup_set.get()
+        group.completion_target = 1
+        group.save()
+        self._get_metadata()
+
+        self.session.complete()
+        response = self.client.post(reverse('api:participant', args=[self.exp.access_id]))
+        self.assertEqual(response.status_code, 403)
+
+
+class TestIdempotencyKeys(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True
+        )
+
+    def _upload(self, key, data='data'):
+        return self.client.post(reverse('api:upload', args=[self.exp.access_id]), data,
+                                content_type='text/plain', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay(self):
+        response = self._upload('key-1')
+        self.assertEqual(response.status_code, 200)
+
+        with CaptureQueriesContext(connection) as ctx:
+            replayed = self._upload('key-1', 'other data')
+        self.assertEqual(replayed.status_code, 200)
+        self.assertEqual(replayed.json(), response.json())
+        # The replay does not touch the session and datapoint tables
+        self.assertFalse(any(
+            table in query['sql']
+            for query in ctx.captured_queries
+            for table in ('experiments_datapoint', 'experiments_participantsession')
+        ))
+
+        self.assertEqual(self.exp.datapoint_set.count(), 1)
+        self.assertEqual(self.exp.datapoint_set.get().data, 'data')
+        self.assertEqual(self.exp.participantsession_set.count(), 1)
+
+        self._upload('key-2')
+        self.assertEqual(self.exp.datapoint_set.count(), 2)
+
+    def test_session_upload_replay(self):
+        session = self.exp.create_session()
+        url = reverse('api:upload', args=[self.exp.access_id, session.uuid])
+        for i in range(3):
+            response = self.client.post(url, 'data', content_type='text/plain', HTTP_IDEMPOTENCY_KEY='key')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.datapoint_set.count(), 1)
+
+    def test_failed_upload_not_stored(self):
+        self.exp.state = Experiment.CLOSED
+        self.exp.save()
+        self.assertEqual(self._upload('key').status_code, 403)
+
+        self.exp.state = Experiment.OPEN
+        self.exp.save()
+        self.assertEqual(self._upload('key').status_code, 200)
+        self.assertEqual(self.exp.datapoint_set.count(), 1)
+
+    def test_invalid_key(self):
+        response = self._upload('x' * (IdempotencyKey.KEY_MAX_LENGTH + 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_BAD_IDEMPOTENCY_KEY)
+        self.assertEqual(self.exp.datapoint_set.count(), 0)
+
+    @override_settings(API_IDEMPOTENCY_KEY_EXPIRY=60)
+    def test_sweep(self):
+        self._upload('old')
+        self._upload('new')
+        IdempotencyKey.objects.filter(key='old').update(date_created=timezone.now() - timedelta(minutes=2))
+
+        call_command('api_sweep', stdout=io.StringIO())
+
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['new'])
+        self.assertEqual(self.exp.datapoint_set.count(), 2)
+
+
+class TestThrottling(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True,
+            api_rate_limit='2/min'
+        )
+        cls.other_exp = Experiment.objects.create(access_id=uuid.uuid4())
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(latency_monitor.reset)
+
+    def _get_metadata(self, exp):
+        return self.client.get(reverse('api:metadata', args=[exp.access_id]))
+
+    def test_rate_limit(self):
+        self.assertEqual(self._get_metadata(self.exp).status_code, 200)
+        self.assertEqual(self._get_metadata(self.exp).status_code, 200)
+
+        response = self._get_metadata(self.exp)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_THROTTLED)
+        # A token is added every 30 seconds
+        self.assertEqual(response['Retry-After'], '30')
+
+        # Other experiments have their own bucket
+        self.assertEqual(self._get_metadata(self.other_exp).status_code, 200)
+
+    @override_settings(API_THROTTLE_RATE='1/min')
+    def test_default_rate_limit(self):
+        self.assertEqual(self._get_metadata(self.other_exp).status_code, 200)
+        self.assertEqual(self._get_metadata(self.other_exp).status_code, 429)
+
+    @override_settings(API_THROTTLE_RATE=None)
+    def test_no_rate_limit(self):
+        for i in range(10):
+            self.assertEqual(self._get_metadata(self.other_exp).status_code, 200)
+
+    @override_settings(API_LOAD_SHEDDING_LATENCY=0.1, API_LOAD_SHEDDING_RETRY_AFTER=15)
+    def test_load_shedding(self):
+        # Twice the threshold: 90% of the requests is rejected
+        latency_monitor.latency = 0.2
+        with patch('api.throttling.random.random', return_value=0.5):
+            response = self._get_metadata(self.other_exp)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_OVERLOADED)
+        self.assertEqual(response['Retry-After'], '15')
+
+        with patch('api.throttling.random.random', return_value=0.95):
+            self.assertEqual(self._get_metadata(self.other_exp).status_code, 200)
+
+        latency_monitor.latency = 0.05
+        self.assertEqual(self._get_metadata(self.other_exp).status_code, 200)
+
+    def test_latency_monitor(self):
+        latency_monitor.reset()
+        self.client.post(reverse('api:participant', args=[self.exp.access_id]))
+        self.assertGreater(latency_monitor.latency, 0)
+
+
+class CountingStream(io.BytesIO):
+    """A request body that keeps track of how much of it was read"""
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read = getattr(self, 'bytes_read', 0) + len(data)
+        return data
+
+
+class TestPlainTextParser(SimpleTestCase):
+    def test_parse(self):
+        data = 'Some text, with ümlauts'.encode('utf-8')
+        payload = PlainTextParser().parse(io.BytesIO(data))
+        self.assertEqual(payload, data.decode('utf-8'))
+        self.assertEqual(payload.size, len(data))
+
+    @override_settings(API_MAX_UPLOAD_SIZE=1024 * 1024)
+    def test_reject_without_reading_everything(self):
+        stream = CountingStream(b'A' * 10 * 1024 * 1024)
+        with self.assertRaises(Exception) as cm:
+            PlainTextParser().parse(stream)
+
+        self.assertEqual(cm.exception.status_code, 413)
+        self.assertLess(stream.bytes_read, 2 * 1024 * 1024)
+
+    def test_peak_memory(self):
+        size = 16 * 1024 * 1024
+        # Keep the body itself out of the measurement by putting it on disk
+        with tempfile.TemporaryFile() as body:
+            for _ in range(size // 1024):
+                body.write(b'A' * 1024)
+            body.seek(0)
+
+            tracemalloc.start()
+            try:
+                payload = PlainTextParser().parse(body)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        self.assertEqual(payload.size, size)
+        # The final string and, briefly, the bytes it is decoded from
+        self.assertLess(peak, 2.2 * size)
+
+    def _parse_encoded(self, body, encoding):
+        request = RequestFactory().post('/', body, content_type='text/plain', HTTP_CONTENT_ENCODING=encoding)
+        return PlainTextParser().parse(request, parser_context={'request': request})
+
+    def test_content_encoding(self):
+        text = json.dumps([{'trial': i, 'response': 'left'} for i in range(1000)])
+        data = text.encode('utf-8')
+        raw_deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        bodies = {
+            'gzip': gzip.compress(data),
+            'deflate': zlib.compress(data),
+            # Sent by some clients instead of zlib wrapped data
+            'DEFLATE': raw_deflate.compress(data) + raw_deflate.flush(),
+            'identity': data,
+        }
+        if brotli is not None:
+            bodies['br'] = brotli.compress(data)
+
+        for encoding, body in bodies.items():
+            with self.subTest(encoding=encoding):
+                payload = self._parse_encoded(body, encoding)
+                self.assertEqual(payload, text)
+                self.assertEqual(payload.size, len(data))
+
+    @override_settings(API_MAX_UPLOAD_SIZE=1024 * 1024)
+    def test_content_encoding_bomb(self):
+        body = gzip.compress(b'A' * 100 * 1024 * 1024)
+        with self.assertRaises(PayloadTooLarge):
+            self._parse_encoded(body, 'gzip')
+
+    def test_content_encoding_multiple_members(self):
+        payload = self._parse_encoded(gzip.compress(b'ab') + gzip.compress(b'cd'), 'gzip')
+        self.assertEqual(payload, 'abcd')
+
+        # Members split over the blocks in which the body is read
+        members = [gzip.compress(os.urandom(50_000).hex().encode('ascii')) for _ in range(3)]
+        payload = self._parse_encoded(b''.join(members), 'gzip')
+        self.assertEqual(payload.size, 300_000)
+
+    def test_content_encoding_trailing_data(self):
+        with self.assertRaises(ParseError):
+            self._parse_encoded(gzip.compress(b'data') + b'garbage', 'gzip')
+        with self.assertRaises(ParseError):
+            self._parse_encoded(zlib.compress(b'data') + b'garbage', 'deflate')
+        # A second member that is cut off
+        with self.assertRaises(ParseError):
+            self._parse_encoded(gzip.compress(b'ab') + gzip.compress(b'cd')[:-4], 'gzip')
+
+    def test_content_encoding_errors(self):
+        with self.assertRaises(ParseError):
+            self._parse_encoded(b'not gzipped', 'gzip')
+        with self.assertRaises(ParseError):
+            self._parse_encoded(gzip.compress(b'truncated' * 100)[:-20], 'gzip')
+        with self.assertRaises(UnsupportedMediaType):
+            self._parse_encoded(b'data', 'compress')
+
+
+class TestChunkedUpload(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True
+        )
+        cls.session = cls.exp.create_session()
+
+    def setUp(self):
+        super().setUp()
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        settings_override = override_settings(API_CHUNKED_UPLOAD_DIR=self.spool_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _create(self, **data):
+        response = self.client.post(
+            reverse('api:upload_chunked_create', args=[self.exp.access_id, self.session.uuid]),
+            dict(filename='recording.webm', **data),
+            format='json'
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()['upload_id']
+
+    def _patch(self, upload_id, offset, chunk):
+        return self.client.patch(
+            reverse('api:upload_chunked', args=[self.exp.access_id, upload_id]),
+            chunk,
+            content_type='application/offset+octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset)
+        )
+
+    def _offset(self, upload_id):
+        response = self.client.head(reverse('api:upload_chunked', args=[self.exp.access_id, upload_id]))
+        return int(response['Upload-Offset'])
+
+    def _finalize(self, upload_id):
+        return self.client.post(reverse('api:upload_chunked_finalize', args=[self.exp.access_id, upload_id]))
+
+    def test_chunked_upload(self):
+        data = os.urandom(300_000)
+        upload_id = self._create(size=len(data))
+
+        for offset in range(0, len(data), 100_000):
+            response = self._patch(upload_id, offset, data[offset:offset + 100_000])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['offset'], min(offset + 100_000, len(data)))
+
+        self.assertEqual(self._offset(upload_id), len(data))
+        response = self._finalize(upload_id)
+        self.assertEqual(response.status_code, 204)
+
+        self.assertEqual(self.exp.datapoint_set.last().file.read(), data)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+    def test_resume_after_offset_mismatch(self):
+        upload_id = self._create()
+        self._patch(upload_id, 0, b'A' * 10)
+
+        # A retried chunk that was already received is refused
+        response = self._patch(upload_id, 0, b'A' * 10)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_OFFSET_MISMATCH)
+
+        self.assertEqual(self._offset(upload_id), 10)
+        self._patch(upload_id, 10, b'B' * 10)
+        self.assertEqual(self._finalize(upload_id).status_code, 204)
+        self.assertEqual(self.exp.datapoint_set.last().file.read(), b'A' * 10 + b'B' * 10)
+
+    def test_incomplete_upload(self):
+        upload_id = self._create(size=20)
+        self._patch(upload_id, 0, b'A' * 10)
+
+        response = self._finalize(upload_id)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_INCOMPLETE_UPLOAD)
+
+        response = self._patch(upload_id, 10, b'A' * 20)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_TOO_LARGE)
+        self.assertEqual(self._offset(upload_id), 10)
+
+    def test_invalid_content_length(self):
+        upload_id = self._create()
+        for content_length in ('abc', '-1'):
+            response = self.client.patch(
+                reverse('api:upload_chunked', args=[self.exp.access_id, upload_id]),
+                b'A',
+                content_type='application/offset+octet-stream',
+                HTTP_UPLOAD_OFFSET='0',
+                CONTENT_LENGTH=content_length
+            )
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._offset(upload_id), 0)
+
+    def test_retried_finalize(self):
+        upload_id = self._create()
+        self._patch(upload_id, 0, b'A' * 10)
+        discard = ChunkedUpload.discard
+        retries = []
+
+        def _discard(upload):
+            # A finalize that is retried before the upload is gone
+            retries.append(self._finalize(upload_id).status_code)
+            discard(upload)
+
+        with patch.object(ChunkedUpload, 'discard', _discard):
+            self.assertEqual(self._finalize(upload_id).status_code, 204)
+
+        self.assertEqual(retries, [409])
+        self.assertEqual(self.exp.datapoint_set.count(), 1)
+        self.assertEqual(self._finalize(upload_id).status_code, 404)
+
+    def test_unknown_upload(self):
+        response = self._patch(uuid.uuid4(), 0, b'A')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_UNKNOWN_UPLOAD)
+
+    def test_sweep(self):
+        abandoned = self._create()
+        active = self._create()
+        ChunkedUpload.objects.filter(uuid=abandoned).update(
+            date_updated=ChunkedUpload.objects.get(uuid=abandoned).date_updated - timedelta(days=2)
+        )
+
+        call_command('api_sweep', stdout=io.StringIO())
+
+        self.assertEqual(list(ChunkedUpload.objects.values_list('uuid', flat=True)), [uuid.UUID(active)])
+        self.assertEqual(os.listdir(self.spool_dir), [active])
+
+
+class TestUploadJournal(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True
+        )
+        cls.session = cls.exp.create_session()
+
+    def setUp(self):
+        super().setUp()
+        self.journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.journal_dir)
+        settings_override = override_settings(API_UPLOAD_JOURNAL_DIR=self.journal_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(lambda: journal.get_writer().close())
+
+    def _upload(self, data):
+        response = self.client.post(reverse('api:upload', args=[self.exp.access_id, self.session.uuid]),
+                                    data, content_type='text/plain')
+        self.assertEqual(response.status_code, 200)
+
+    def _drain(self, **options):
+        stderr = io.StringIO()
+        call_command('drain_upload_journal', stdout=io.StringIO(), stderr=stderr, **options)
+        return stderr.getvalue()
+
+    def _segments(self):
+        return journal.list_segments(self.journal_dir)
+
+    def _stored_data(self):
+        return list(self.exp.datapoint_set.order_by('number').values_list('number', 'data', 'size'))
+
+    def test_upload_journaled(self):
+        self._upload('välue')
+        self.assertEqual(self.exp.datapoint_set.count(), 0)
+        self.assertEqual(len(self._segments()), 1)
+
+        # The segment is still being written to, so it is drained but kept
+        self._drain()
+        self._drain()
+        self.assertEqual(self._stored_data(), [(1, 'välue', len('välue'.encode('utf-8')))])
+        self.assertEqual(len(self._segments()), 1)
+
+        self._upload('second')
+        journal.get_writer().close()
+        self._drain()
+        self.assertEqual([data for _, data, _ in self._stored_data()], ['välue', 'second'])
+        self.assertEqual(self._segments(), [])
+        self.assertFalse(JournalCheckpoint.objects.exists())
+
+    def test_session_completed_when_drained(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self._upload('data')
+        writes = [query['sql'] for query in ctx.captured_queries
+                  if not query['sql'].startswith('SELECT')]
+        self.assertEqual(writes, [])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.state, ParticipantSession.STARTED)
+
+        self._drain()
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.state, ParticipantSession.COMPLETED)
+        self.assertEqual(self.exp.targetgroup_set.get().num_completed, 1)
+
+    def test_plain_upload_sessions_created_when_drained(self):
+        url = reverse('api:upload', args=[self.exp.access_id])
+        for data in ['first', 'second']:
+            response = self.client.post(url, data, content_type='text/plain')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.exp.participantsession_set.count(), 1)
+
+        # Closing the experiment in between does not change the state the
+        # sessions were started in
+        self.exp.state = Experiment.CLOSED
+        self.exp.save()
+        self._drain()
+
+        sessions = self.exp.participantsession_set.exclude(pk=self.session.pk)
+        self.assertEqual(
+            sorted(sessions.values_list('datapoint__data', 'state',
+                                        'experiment_state')),
+            [('first', ParticipantSession.COMPLETED, Experiment.OPEN),
+             ('second', ParticipantSession.COMPLETED, Experiment.OPEN)]
+        )
+        self.assertEqual(self.exp.targetgroup_set.get().num_completed, 2)
+
+    @override_settings(API_UPLOAD_JOURNAL_SEGMENT_SIZE=1)
+    def test_segment_rotation(self):
+        for i in range(3):
+            self._upload(str(i))
+        self.assertEqual(len(self._segments()), 3)
+
+        self._drain()
+        self.assertEqual([data for _, data, _ in self._stored_data()], ['0', '1', '2'])
+        # Only the segment that is being written to is left
+        self.assertEqual(len(self._segments()), 1)
+
+    def test_incomplete_record_discarded(self):
+        self._upload('first')
+        self._upload('second')
+        journal.get_writer().close()
+
+        # A writer that crashed halfway through a record
+        segment = os.path.join(self.journal_dir, self._segments()[0])
+        with open(segment, 'ab') as f:
+            f.write(journal.encode_record({'data': 'third'})[:-5])
+
+        stderr = self._drain()
+        self.assertIn('incomplete data', stderr)
+        self.assertEqual([data for _, data, _ in self._stored_data()], ['first', 'second'])
+        self.assertEqual(self._segments(), [])
+
+    def test_crash_during_drain(self):
+        for i in range(5):
+            self._upload(str(i))
+        journal.get_writer().close()
+
+        bulk_create_data = DataPoint.bulk_create_data
+        calls = []
+
+        def _crash_on_second_batch(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('Crash')
+            return bulk_create_data(*args)
+
+        with patch.object(DataPoint, 'bulk_create_data', side_effect=_crash_on_second_batch):
+            with self.assertRaises(RuntimeError):
+                self._drain(batch_size=2)
+        self.assertEqual(len(self._stored_data()), 2)
+
+        # The next drain continues after the first batch
+        self._drain(batch_size=2)
+        self.assertEqual(self._stored_data(), [(i + 1, str(i), 1) for i in range(5)])
+        self.assertEqual(self._segments(), [])
+
+
+def run_concurrently(func, n, workers=20):
+    """Calls func(i) for every i in range(n) from a pool of threads, returns
+    the results in order. Every thread gets its own database connection."""
+    def _run(i):
+        try:
+            return func(i)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run, range(n)))
+
+
+def run_sequentially(func, n):
+    """Like run_concurrently, but calls func(i) one after the other in the
+    current thread"""
+    return [func(i) for i in range(n)]
+
+
+class UploadNumberTests:
+    """Runs its requests with run_requests(), so the same checks are done
+    concurrently and sequentially. (Not run(), that is TestCase.run.)"""
+    run_requests = staticmethod(run_concurrently)
+
+    def setUp(self):
+        super().setUp()
+        self.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True
+        )
+
+    def test_parallel_uploads_get_unique_numbers(self):
+        N = 300
+
+        def _upload(i):
+            return APIClient().post(
+                reverse('api:upload', args=[self.exp.access_id]),
+                json.dumps({'upload': i}),
+                content_type='text/plain'
+            ).status_code
+
+        statuses = self.run_requests(_upload, N)
+
+        self.assertEqual(statuses, [200] * N)
+        numbers = list(self.exp.datapoint_set.values_list('number', flat=True))
+        self.assertEqual(sorted(numbers), list(range(1, N + 1)))
+
+
+# SQLite only allows one writer at a time and its in-memory test database
+# cannot be shared between threads reliably, so the concurrent variants need
+# a real database server. The sequential ones run everywhere, so the counters
+# are still checked on SQLite.
+@skipUnlessDBFeature('has_select_for_update')
+class TestConcurrentUploads(UploadNumberTests, TransactionTestCase):
+    pass
+
+
+class TestSequentialUploads(UploadNumberTests, ApiTestCase):
+    run_requests = staticmethod(run_sequentially)
+
+
+class ParticipantTests:
+    """See UploadNumberTests"""
+    run_requests = staticmethod(run_concurrently)
+
+    def setUp(self):
+        super().setUp()
+        self.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True
+        )
+
+    def test_parallel_participants_get_unique_subject_ids(self):
+        N = 300
+
+        def _create_participant(i):
+            response = APIClient().post(
+                reverse('api:participant', args=[self.exp.access_id])
+            )
+            self.assertEqual(response.status_code, 200)
+            return response.json()['subject_id']
+
+        subject_ids = self.run_requests(_create_participant, N)
+
+        self.assertEqual(sorted(subject_ids), list(range(1, N + 1)))
+        self.assertEqual(self.exp.participantsession_set.count(), N)
+
+    def test_parallel_participants_balanced_groups(self):
+        N = 1000
+        self.exp.targetgroup_set.all().delete()
+        for name in 'ABCD':
+            self.exp.targetgroup_set.create(name=name, completion_target=N)
+
+        def _create_participant(i):
+            response = APIClient().post(
+                reverse('api:participant', args=[self.exp.access_id])
+            )
+            self.assertEqual(response.status_code, 200)
+            return response.json()['group_name']
+
+        group_names = self.run_requests(_create_participant, N)
+
+        # Strict round-robin assignment leaves every group at exactly N / 4
+        for name in 'ABCD':
+            self.assertEqual(group_names.count(name), N // 4)
+        # The denormalized counters must match the sessions themselves
+        for group in self.exp.targetgroup_set.all():
+            self.assertEqual(group.num_started, N // 4)
+            self.assertEqual(group.participantsession_set.count(), N // 4)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class TestConcurrentParticipants(ParticipantTests, TransactionTestCase):
+    pass
+
+
+class TestSequentialParticipants(ParticipantTests, ApiTestCase):
+    run_requests = staticmethod(run_sequentially)
+
+
+class TestAsyncApi(TransactionTestCase):
+    # The async views do their database work in a thread pool, which cannot
+    # see the transaction a regular TestCase wraps around every test
+    def setUp(self):
+        self.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True
+        )
+        self.client = AsyncClient()
+
+    async def test_upload(self):
+        response = await self.client.post(reverse('api:async_upload', args=[self.exp.access_id]),
+                                          json.dumps({'key': 'value'}), content_type='text/plain')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['result'], ResultCodes.OK)
+        self.assertEqual(await self.exp.datapoint_set.acount(), 1)
+
+    async def test_upload_errors(self):
+        response = await self.client.post(reverse('api:async_upload', args=[uuid.uuid4()]),
+                                          'data', content_type='text/plain')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_UNKNOWN_ID)
+
+        response = await self.client.post(reverse('api:async_upload', args=[self.exp.access_id]),
+                                          '', content_type='text/plain')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()['result'], ResultCodes.ERR_NO_DATA)
+
+        response = await self.client.post(reverse('api:async_upload', args=[self.exp.access_id]),
+                                          {'key': 'value'}, content_type='application/json')
+        self.assertEqual(response.status_code, 415)
+
+    async def test_participant_and_session_upload(self):
+        response = await self.client.post(reverse('api:async_participant', args=[self.exp.access_id]))
+        self.assertEqual(response.status_code, 200)
+        participant = response.json()
+        self.assertEqual(participant['subject_id'], 1)
+
+        response = await self.client.post(
+            reverse('api:async_upload', args=[self.exp.access_id, participant['uuid']]),
+            'data', content_type='text/plain'
+        )
+        self.assertEqual(response.status_code, 200)
+
+        session = await self.exp.participantsession_set.aget()
+        self.assertEqual(session.state, ParticipantSession.COMPLETED)
+
+    async def test_metadata(self):
+        response = await self.client.get(reverse('api:async_metadata', args=[self.exp.access_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'state': 'Open'})
+
+        response = await self.client.get(reverse('api:async_metadata_field', args=[self.exp.access_id, 'state']))
+        self.assertEqual(response.json(), 'Open')
+
+
+class IdempotentUploadTests:
+    """See UploadNumberTests"""
+    run_requests = staticmethod(run_concurrently)
+
+    def setUp(self):
+        super().setUp()
+        self.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True
+        )
+
+    def test_parallel_duplicates_stored_once(self):
+        N = 50
+        session = self.exp.create_session()
+
+        def _upload(i):
+            response = APIClient().post(
+                reverse('api:upload', args=[self.exp.access_id, session.uuid]),
+                json.dumps({'retry': i}),
+                content_type='text/plain',
+                HTTP_IDEMPOTENCY_KEY='same-key'
+            )
+            return response.status_code, response.json()
+
+        results = self.run_requests(_upload, N)
+
+        self.assertEqual(results, [results[0]] * N)
+        self.assertEqual(results[0][0], 200)
+        self.assertEqual(self.exp.datapoint_set.count(), 1)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class TestConcurrentIdempotentUploads(IdempotentUploadTests,
+                                      TransactionTestCase):
+    pass
+
+
+class TestSequentialIdempotentUploads(IdempotentUploadTests, ApiTestCase):
+    run_requests = staticmethod(run_sequentially)
@@ -0,0 +1,130 @@
+"""Throttles that keep a single experiment, or an overloaded database, from
+degrading the API for every other experiment."""
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+from .exceptions import Overloaded, ResultCodes
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_rate(rate):
+    """Parses a rate like '100/min' into (number of requests, seconds), the
+    same format Django REST framework uses"""
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+class ExperimentRateThrottle(BaseThrottle):
+    """Token bucket per experiment, kept in Django's cache.
+
+    A rate of 100/min means a bucket of 100 tokens, which refills at 100
+    tokens a minute. This is implemented as the equivalent 'generic cell rate
+    algorithm', which only needs a single timestamp per experiment: the time
+    at which the bucket would be full again.
+
+    The timestamp is read and written without a lock, so concurrent requests
+    may occasionally both take the last token. Processes only share the
+    buckets through a shared cache backend; with the local memory cache,
+    every process limits on its own.
+    """
+
+    def __init__(self):
+        self.wait_time = None
+
+    @staticmethod
+    def get_rate(experiment):
+        return experiment.api_rate_limit or settings.API_THROTTLE_RATE
+
+    @staticmethod
+    def get_cache_key(experiment):
+        return 'api:throttle:{}'.format(experiment.access_id)
+
+    def allow_request(self, request, view):
+        rate = self.get_rate(view.experiment)
+        if not rate:
+            return True
+
+        num_requests, duration = parse_rate(rate)
+        if num_requests == 0:
+            self.wait_time = duration
+            return False
+        interval = duration / num_requests
+
+        key = self.get_cache_key(view.experiment)
+        now = time.time()
+        full_at = max(cache.get(key, now), now) + interval
+        if full_at - now > duration:
+            # Empty, the next token is available when the bucket can take
+            # one more request again
+            self.wait_time = full_at - duration - now
+            return False
+
+        cache.set(key, full_at, math.ceil(duration))
+        return True
+
+    def wait(self):
+        return self.wait_time
+
+
+class DatabaseLatencyMonitor:
+    """Keeps an exponentially weighted moving average of the duration of the
+    queries done by the API in this process. Used as a database
+    execute_wrapper."""
+    # Weight of a single query in the average
+    alpha = 0.05
+
+    def __init__(self):
+        self.latency = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(time.perf_counter() - start)
+
+    def record(self, duration):
+        with self.lock:
+            self.latency += self.alpha * (duration - self.latency)
+
+    def reset(self):
+        with self.lock:
+            self.latency = 0.0
+
+
+latency_monitor = DatabaseLatencyMonitor()
+
+
+class DatabaseLoadThrottle(BaseThrottle):
+    """Sheds load when the database gets slow.
+
+    Once the average query latency exceeds API_LOAD_SHEDDING_LATENCY, a
+    growing share of the requests is rejected with a 503, up to 90% at twice
+    the threshold. The remaining requests keep the average up to date, so the
+    API recovers by itself once the database does.
+    """
+    max_shed_fraction = 0.9
+
+    def allow_request(self, request, view):
+        threshold = settings.API_LOAD_SHEDDING_LATENCY
+        if not threshold:
+            return True
+
+        overload = latency_monitor.latency / threshold - 1
+        if overload <= 0 or random.random() >= min(overload,
+                                                   self.max_shed_fraction):
+            return True
+
+        raise Overloaded(
+            wait=settings.API_LOAD_SHEDDING_RETRY_AFTER,
+            code=ResultCodes.ERR_OVERLOADED,
+            detail='The datastore is overloaded, please try again later'
+        )
@@ -1,6 +1,8 @@
 from django.urls import path
 
-from .views import UploadView, MetadataView, ParticipantView, SessionUploadView, BinaryUploadView
+from .views import UploadView, MetadataView, ParticipantView, SessionUploadView, BinaryUploadView, \
+    BatchUploadView, ChunkedUploadCreateView, ChunkedUploadView, ChunkedUploadFinalizeView, ParticipantBatchView
+from .async_views import AsyncMetadataView, AsyncParticipantView, AsyncSessionUploadView, AsyncUploadView
 
 app_name = 'api'
 
@@ -10,6 +12,22 @@ urlpatterns = [
     path('<str:access_key>/metadata/<str:field>/', MetadataView.as_view(), name='metadata_field'),
 
     path('<str:access_key>/participant/', ParticipantView.as_view(), name='participant'),
+    path('<str:access_key>/participants/', ParticipantBatchView.as_view(), name='participant_batch'),
     path('<str:access_key>/upload/<str:participant_id>/', SessionUploadView.as_view(), name='upload'),
     path('<str:access_key>/upload-bin/<str:participant_id>/', BinaryUploadView.as_view(), name='upload_bin'),
+    path('<str:access_key>/upload-bin/<str:participant_id>/chunked/', ChunkedUploadCreateView.as_view(),
+         name='upload_chunked_create'),
+    path('<str:access_key>/upload-chunked/<str:upload_id>/', ChunkedUploadView.as_view(), name='upload_chunked'),
+    path('<str:access_key>/upload-chunked/<str:upload_id>/finalize/', ChunkedUploadFinalizeView.as_view(),
+         name='upload_chunked_finalize'),
+    path('<str:access_key>/upload-batch/<str:participant_id>/', BatchUploadView.as_view(), name='upload_batch'),
+
+    # Async variants, only useful when served through ASGI
+    path('async/<str:access_key>/upload/', AsyncUploadView.as_view(), name='async_upload'),
+    path('async/<str:access_key>/metadata/', AsyncMetadataView.as_view(), name='async_metadata'),
+    path('async/<str:access_key>/metadata/<str:field>/', AsyncMetadataView.as_view(),
+         name='async_metadata_field'),
+    path('async/<str:access_key>/participant/', AsyncParticipantView.as_view(), name='async_participant'),
+    path('async/<str:access_key>/upload/<str:participant_id>/', AsyncSessionUploadView.as_view(),
+         name='async_upload'),
 ]
@@ -1,58 +1,113 @@
-from django.http import Http404
-from django.utils import translation
+import hashlib
+import json
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.db import IntegrityError, connection, transaction
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone, translation
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 from functools import cached_property
-from rest_framework.exceptions import APIException, ValidationError, PermissionDenied, NotFound
+from rest_framework.exceptions import APIException, ValidationError, PermissionDenied, NotFound, \
+    Throttled, UnsupportedMediaType
 from rest_framework.response import Response
 from rest_framework.generics import GenericAPIView, CreateAPIView
-from rest_framework.parsers import FormParser, MultiPartParser
-
-from .exceptions import ConfigError
-from .parsers import PlainTextParser
-from .serializers import ParticipantSerializer
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+
+from . import journal
+from .cache import cache_experiment, get_cached_experiment, normalize_access_id
+from .exceptions import ConfigError, Conflict, ResultCodes
+from .models import ChunkedUpload, IdempotencyKey
+from .parsers import NDJSONParser, PlainTextParser
+from .serializers import ParticipantSerializer, iter_json_array
+from .throttling import DatabaseLoadThrottle, ExperimentRateThrottle, latency_monitor
 from experiments.models import DataPoint, Experiment, ParticipantSession
 
 
-class ResultCodes:
-    OK = "OK"
-    ERR_NO_ID = "ERR_NO_ID"
-    ERR_NO_DATA = "ERR_NO_DATA"
-    ERR_UNKNOWN_ID = "ERR_UNKNOWN_ID"
-    ERR_NOT_OPEN = "ERR_NOT_OPEN"
-    ERR_GROUP_ASSIGN_FAIL = "ERR_GROUP_ASSIGN_FAIL"
-    ERR_NO_SESSION = "ERR_NO_SESSION"
-
-
 class BaseExperimentApiView(GenericAPIView):
     lookup_field = 'access_id'
     lookup_url_kwarg = 'access_key'
-    queryset = Experiment.objects.all()
+    # Prefetching the groups makes is_open() and has_groups() query-free
+    queryset = Experiment.objects.prefetch_related('targetgroup_set')
+    throttle_classes = [ExperimentRateThrottle, DatabaseLoadThrottle]
 
     def dispatch(self, *args, **kwargs):
-        # API responses should always use English messages
-        with translation.override('en'):
+        # API responses should always use English messages. The queries are
+        # timed for the load shedding in DatabaseLoadThrottle
+        with translation.override('en'), \
+                connection.execute_wrapper(latency_monitor):
             return super().dispatch(*args, **kwargs)
 
+    def throttled(self, request, wait):
+        raise Throttled(wait, code=ResultCodes.ERR_THROTTLED,
+                        detail='Too many requests for this experiment')
+
     def get_object(self):
+        access_id = normalize_access_id(self.kwargs[self.lookup_url_kwarg])
+        if access_id is None:
+            raise self._experiment_not_found()
+
+        experiment = get_cached_experiment(access_id)
+        if experiment is not None:
+            return experiment
+
         try:
-            return super().get_object()
+            experiment = super().get_object()
         except Http404:
-            raise NotFound(code=ResultCodes.ERR_UNKNOWN_ID,
-                           detail='No experiment using that id was found')
+            raise self._experiment_not_found()
+
+        cache_experiment(experiment)
+        return experiment
+
+    @staticmethod
+    def _experiment_not_found():
+        return NotFound(code=ResultCodes.ERR_UNKNOWN_ID,
+                        detail='No experiment using that id was found')
 
     @cached_property
     def experiment(self):
         return self.get_object()
 
+    def get_session(self, participant_id) -> ParticipantSession:
+        try:
+            return self.experiment.participantsession_set.get(uuid=participant_id)
+        except ParticipantSession.DoesNotExist:
+            raise PermissionDenied(code=ResultCodes.ERR_NO_SESSION,
+                                   detail='Bad participant session id')
+
 
 class MetadataView(BaseExperimentApiView):
     # List of all variables that are retrievable
     fields = ('state', )
 
     def get(self, request, access_key, field=None):
+        metadata = self.get_metadata(field)
+        return self.finalize_metadata_response(request, Response(metadata),
+                                               self.get_etag(field, metadata))
+
+    @staticmethod
+    def get_etag(field, metadata) -> str:
+        """The metadata only depends on the experiment's state, so instead of
+        tracking a modification version we hash the values themselves. Any
+        change that does not show up in the response leaves the ETag as is."""
+        content = json.dumps([field, metadata], sort_keys=True)
+        return quote_etag(hashlib.sha1(content.encode()).hexdigest())
+
+    @staticmethod
+    def finalize_metadata_response(request, response, etag):
+        """Adds the caching headers, and replaces the response with a 304
+        if the client already has this version"""
+        response['ETag'] = etag
+        patch_cache_control(response, **settings.API_METADATA_CACHE_CONTROL)
+        return get_conditional_response(request, etag=etag, response=response)
+
+    def get_metadata(self, field=None):
         if field in self.fields:
-            return Response(self.get_value(self.experiment, field))
+            return self.get_value(self.experiment, field)
 
-        return Response({field: self.get_value(self.experiment, field) for field in self.fields})
+        return {field: self.get_value(self.experiment, field) for field in self.fields}
 
     @staticmethod
     def get_value(experiment: Experiment, field):
@@ -87,17 +142,99 @@ class BaseUploadView(BaseExperimentApiView):
     """
     parser_classes = [PlainTextParser]
 
+    def get_upload_limit(self) -> int:
+        """Maximum size of the body in bytes, enforced by the parser"""
+        return self.experiment.max_upload_size or settings.API_MAX_UPLOAD_SIZE
+
+    def parse_payload(self, request):
+        """Parses the body of a plain Django request with this view's parser,
+        for use outside of the DRF request cycle"""
+        parser = self.parser_classes[0]()
+        if request.content_type != parser.media_type:
+            raise UnsupportedMediaType(request.content_type)
+
+        return parser.parse(request, parser.media_type, {
+            'view': self,
+            'request': request,
+            'encoding': request.encoding or settings.DEFAULT_CHARSET,
+        })
+
+    def store_idempotent(self, request, store) -> dict:
+        """Calls store() and returns its result, unless the request has an
+        Idempotency-Key header that was used before. In that case, the result
+        of the earlier request is returned without storing anything.
+
+        Concurrent requests with the same key are serialized by the unique
+        constraint on the key: the second insert waits for the transaction of
+        the first request. It then fails if that request succeeded, or goes
+        ahead if it didn't.
+        """
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return store()
+
+        if not key or len(key) > IdempotencyKey.KEY_MAX_LENGTH:
+            raise ValidationError(code=ResultCodes.ERR_BAD_IDEMPOTENCY_KEY,
+                                  detail='Invalid idempotency key')
+
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    entry = IdempotencyKey.objects.create(
+                        experiment=self.experiment,
+                        key=key
+                    )
+            except IntegrityError:
+                return IdempotencyKey.objects.get(
+                    experiment=self.experiment,
+                    key=key
+                ).response
+
+            entry.response = store()
+            entry.save(update_fields=['response'])
+
+        return entry.response
+
     def _validate_request(self, payload):
         # Error if no data was sent
         if not payload:
             raise APIException(code=ResultCodes.ERR_NO_DATA, detail='No data was provided')
 
-    def _save_data_point(self, payload, session: ParticipantSession):
-        return DataPoint.objects.create(
+    def _save_completed_data_point(self, payload,
+                                   session: ParticipantSession = None):
+        """Stores the payload as a datapoint and completes its session.
+        Without a session, a new one is created for just this datapoint.
+
+        With the upload journal enabled, the payload is appended to the
+        journal instead, and the drain_upload_journal command does the rest
+        (including the session), so the request does not write to the
+        database at all."""
+        if journal.is_enabled():
+            journal.get_writer().append({
+                'experiment': self.experiment.pk,
+                'session': session.pk if session else None,
+                # The state new sessions are started in, as it could change
+                # before the journal is drained
+                'experiment_state': self.experiment.state,
+                'complete': True,
+                'data': payload,
+                'size': DataPoint.get_payload_size(payload),
+            })
+            return
+
+        if session is None:
+            session = ParticipantSession.objects.create(
+                experiment=self.experiment,
+                group=self.experiment.targetgroup_set.first()
+            )
+
+        DataPoint.objects.create(
             experiment=self.experiment,
             data=payload,
+            size=DataPoint.get_payload_size(payload),
             session=session
         )
+        session.complete()
 
 
 class UploadView(BaseUploadView):
@@ -110,7 +247,12 @@ class UploadView(BaseUploadView):
                                    detail='The experiment is not open to new uploads')
 
     def post(self, request, access_key):
-        payload = request.data
+        return Response(self.store_idempotent(
+            request,
+            lambda: self.store_upload(request.data)
+        ))
+
+    def store_upload(self, payload) -> dict:
         self._validate_request(payload)
 
         if self.experiment.uses_groups():
@@ -119,33 +261,29 @@ class UploadView(BaseUploadView):
             raise ConfigError(code=ResultCodes.ERR_NO_SESSION,
                               detail='Missing participant session id')
 
-        session = ParticipantSession.objects.create(
-            experiment=self.experiment,
-            group=self.experiment.targetgroup_set.first()
-        )
-        session.complete()
-
-        dp = self._save_data_point(payload, session)
+        # Every upload gets a completed session of its own
+        self._save_completed_data_point(payload)
 
-        return Response({
+        return {
             'result': ResultCodes.OK,
             'message': 'Upload successful'
-        })
+        }
 
 
 class SessionUploadView(BaseUploadView):
     def post(self, request, access_key, participant_id):
-        payload = request.data
+        return Response(self.store_idempotent(
+            request,
+            lambda: self.store_upload(request.data, participant_id)
+        ))
+
+    def store_upload(self, payload, participant_id) -> dict:
         self._validate_request(payload)
 
         if not self.experiment.has_groups():
             raise ValidationError(detail='Experiment is not using session ids')
 
-        try:
-            session = self.experiment.participantsession_set.get(uuid=participant_id)
-        except ParticipantSession.DoesNotExist:
-            raise PermissionDenied(code=ResultCodes.ERR_NO_SESSION,
-                                   detail='Bad participant session id')
+        session = self.get_session(participant_id)
 
         # We do not check if the experiment is open.
         # We can rely on the fact that for a session to be created, the experiment had to be
@@ -154,14 +292,65 @@ class SessionUploadView(BaseUploadView):
         # regardless of changes to the experiment status.
 
         # Create the new datapoint
-        self._save_data_point(payload, session)
-
-        session.complete()
+        self._save_completed_data_point(payload, session)
 
         # Return that everything went OK
-        return Response({
+        return {
             "result":  ResultCodes.OK,
             "message": "Upload successful"
+        }
+
+
+class BatchUploadView(BaseUploadView):
+    """Stores every line of a newline-delimited body as a separate datapoint
+    of a session, in one transaction.
+
+    The response contains a result for every line, in the same order. Empty
+    lines are not stored and get ERR_NO_DATA as their result.
+    """
+    parser_classes = [NDJSONParser]
+
+    def _validate_request(self, payload):
+        if not payload or not any(payload):
+            raise APIException(code=ResultCodes.ERR_NO_DATA, detail='No data was provided')
+
+        if len(payload) > settings.API_BATCH_UPLOAD_MAX_ITEMS:
+            raise ValidationError(
+                code=ResultCodes.ERR_TOO_MANY_ITEMS,
+                detail='A batch can contain at most {} items'.format(
+                    settings.API_BATCH_UPLOAD_MAX_ITEMS
+                )
+            )
+
+    def post(self, request, access_key, participant_id):
+        payloads = request.data
+        self._validate_request(payloads)
+
+        if not self.experiment.has_groups():
+            raise ValidationError(detail='Experiment is not using session ids')
+
+        session = self.get_session(participant_id)
+
+        # Like SessionUploadView, this doesn't check if the experiment is open
+        with transaction.atomic():
+            data_points = DataPoint.bulk_create_data(
+                self.experiment,
+                [payload for payload in payloads if payload],
+                session
+            )
+            session.complete()
+
+        numbers = iter(data_point.number for data_point in data_points)
+        items = [
+            {'result': ResultCodes.OK, 'number': next(numbers)}
+            if payload else {'result': ResultCodes.ERR_NO_DATA}
+            for payload in payloads
+        ]
+
+        return Response({
+            "result":  ResultCodes.OK,
+            "message": "Upload successful",
+            "items": items,
         })
 
 
@@ -169,6 +358,9 @@ class ParticipantView(BaseExperimentApiView, CreateAPIView):
     serializer_class = ParticipantSerializer
 
     def create(self, *args, **kwargs):
+        return Response(self.create_participant())
+
+    def create_participant(self) -> dict:
         """creates a new participant session"""
         if not self.experiment.is_open():
             raise PermissionDenied(code=ResultCodes.ERR_NOT_OPEN,
@@ -178,31 +370,67 @@ class ParticipantView(BaseExperimentApiView, CreateAPIView):
             raise ConfigError(code=ResultCodes.ERR_GROUP_ASSIGN_FAIL,
                               detail='Experiment is not configured for using session ids (has no groups)')
 
-        group = self.experiment.get_next_group()
-        if not group:
+        participant = self.experiment.create_session()
+        if not participant:
             raise ConfigError(code=ResultCodes.ERR_GROUP_ASSIGN_FAIL,
                               detail='Could not assign participant to any group')
 
-        participant = ParticipantSession.objects.create(
-            experiment=self.experiment,
-            state=ParticipantSession.STARTED,
-            group=group
-        )
-
         serialized = self.serializer_class(participant)
-        return Response(serialized.data)
+        return serialized.data
+
+
+class ParticipantBatchView(BaseExperimentApiView):
+    """Creates a batch of participant sessions at once, for setups that know
+    in advance how many participants they will run. The sessions are spread
+    over the groups like ParticipantView would, and returned as a (streamed)
+    JSON array."""
+    parser_classes = [JSONParser, FormParser]
+    serializer_class = ParticipantSerializer
+
+    def get_count(self, request) -> int:
+        try:
+            count = int(request.data.get('count'))
+        except (TypeError, ValueError):
+            count = 0
+        if count < 1:
+            raise ValidationError(detail='count should be a positive number')
+
+        if count > settings.API_PARTICIPANT_BATCH_MAX_SIZE:
+            raise ValidationError(
+                code=ResultCodes.ERR_TOO_MANY_ITEMS,
+                detail='At most {} sessions can be created at once'.format(
+                    settings.API_PARTICIPANT_BATCH_MAX_SIZE
+                )
+            )
+        return count
+
+    def post(self, request, access_key):
+        count = self.get_count(request)
+
+        if not self.experiment.is_open():
+            raise PermissionDenied(code=ResultCodes.ERR_NOT_OPEN,
+                                   detail="The experiment is not open to new uploads")
+
+        if not self.experiment.has_groups():
+            raise ConfigError(code=ResultCodes.ERR_GROUP_ASSIGN_FAIL,
+                              detail='Experiment is not configured for using session ids (has no groups)')
+
+        sessions = self.experiment.create_sessions(count)
+        if not sessions:
+            raise ConfigError(code=ResultCodes.ERR_GROUP_ASSIGN_FAIL,
+                              detail='Could not assign participants to any group')
+
+        return StreamingHttpResponse(
+            iter_json_array(sessions, self.serializer_class),
+            content_type='application/json'
+        )
 
 
 class BinaryUploadView(BaseExperimentApiView):
     parser_classes = [FormParser, MultiPartParser]
 
     def post(self, request, access_key, participant_id):
-        try:
-            session = self.experiment.participantsession_set\
-                                         .get(uuid=participant_id)
-        except ParticipantSession.DoesNotExist:
-            raise PermissionDenied(code=ResultCodes.ERR_NO_SESSION,
-                                   detail='Bad participant session id')
+        session = self.get_session(participant_id)
 
         if 'file' not in request.FILES:
             raise ValidationError(detail='Field "file" is missing from request or is not a valid file')
@@ -216,3 +444,193 @@ class BinaryUploadView(BaseExperimentApiView):
         # note that session.complete() is not called, because we expect
         # that another (non-binary) upload will mark session completion
         return Response(status=204)
+
+
+class ChunkedUploadCreateView(BaseExperimentApiView):
+    """Starts a resumable binary upload for a session.
+
+    The protocol works as follows:
+    - POST a filename (and optionally the total size) to this view, which
+      returns the id of the new upload
+    - PATCH the bytes to ChunkedUploadView, with the position of the first
+      byte in the Upload-Offset header. A chunk that does not start at the
+      current offset is rejected.
+    - After an interruption, GET (or HEAD) ChunkedUploadView to retrieve the
+      current offset and continue from there
+    - POST to ChunkedUploadFinalizeView to store the file as a datapoint
+
+    Uploads that are not finalized are removed by the api_sweep management
+    command after API_CHUNKED_UPLOAD_EXPIRY seconds without activity.
+    """
+    parser_classes = [JSONParser, FormParser]
+
+    def post(self, request, access_key, participant_id):
+        session = self.get_session(participant_id)
+
+        filename = os.path.basename(str(request.data.get('filename', '')))
+        if not filename:
+            raise ValidationError(detail='Field "filename" is missing from request')
+
+        size = request.data.get('size')
+        if size is not None:
+            try:
+                size = int(size)
+            except (TypeError, ValueError):
+                raise ValidationError(detail='Field "size" should be a number')
+            if not 0 <= size <= settings.API_CHUNKED_UPLOAD_MAX_SIZE:
+                raise ValidationError(code=ResultCodes.ERR_TOO_LARGE,
+                                      detail='Invalid file size')
+
+        upload = ChunkedUpload.objects.create(
+            session=session,
+            filename=filename[-255:],
+            size=size
+        )
+        upload.create_spool()
+
+        return Response({
+            'result': ResultCodes.OK,
+            'upload_id': upload.uuid,
+            'offset': 0,
+        }, status=201)
+
+
+class BaseChunkedUploadView(BaseExperimentApiView):
+    def get_upload(self, upload_id) -> ChunkedUpload:
+        try:
+            return ChunkedUpload.objects.select_related('session').get(
+                uuid=upload_id,
+                session__experiment=self.experiment
+            )
+        except ChunkedUpload.DoesNotExist:
+            raise NotFound(code=ResultCodes.ERR_UNKNOWN_UPLOAD,
+                           detail='No upload using that id was found')
+
+    @staticmethod
+    def _not_found():
+        return NotFound(code=ResultCodes.ERR_UNKNOWN_UPLOAD,
+                        detail='No upload using that id was found')
+
+    @staticmethod
+    def _lock_failed():
+        return Conflict(code=ResultCodes.ERR_UPLOAD_LOCKED,
+                        detail='Another request is busy with this upload')
+
+
+class ChunkedUploadView(BaseChunkedUploadView):
+    """Receives the chunks of a resumable upload, see ChunkedUploadCreateView
+    """
+    # Chunks are read from the request stream directly, never parsed
+    parser_classes = []
+
+    # Size of the blocks in which a chunk is copied to the spool file
+    block_size = 64 * 1024
+
+    def get(self, request, access_key, upload_id):
+        upload = self.get_upload(upload_id)
+        try:
+            offset = upload.get_offset()
+        except FileNotFoundError:
+            raise self._not_found()
+
+        return Response({
+            'result': ResultCodes.OK,
+            'offset': offset,
+            'size': upload.size,
+        }, headers={'Upload-Offset': str(offset)})
+
+    def patch(self, request, access_key, upload_id):
+        upload = self.get_upload(upload_id)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            raise ValidationError(detail='Missing or invalid Upload-Offset header')
+
+        max_size = upload.size
+        if max_size is None:
+            max_size = settings.API_CHUNKED_UPLOAD_MAX_SIZE
+
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise ValidationError(detail='Invalid Content-Length header')
+        if content_length < 0:
+            raise ValidationError(detail='Invalid Content-Length header')
+        if offset + content_length > max_size:
+            raise ValidationError(code=ResultCodes.ERR_TOO_LARGE,
+                                  detail='Chunk exceeds the size of the upload')
+
+        try:
+            with upload.open_spool('ab') as spool:
+                current_offset = os.fstat(spool.fileno()).st_size
+                if offset != current_offset:
+                    raise Conflict(
+                        code=ResultCodes.ERR_OFFSET_MISMATCH,
+                        detail='Chunk should start at offset {}'.format(current_offset)
+                    )
+
+                new_offset = self._receive_chunk(request.stream, spool, offset, max_size)
+        except FileNotFoundError:
+            raise self._not_found()
+        except BlockingIOError:
+            raise self._lock_failed()
+
+        ChunkedUpload.objects.filter(pk=upload.pk).update(date_updated=timezone.now())
+
+        return Response({
+            'result': ResultCodes.OK,
+            'offset': new_offset,
+        }, headers={'Upload-Offset': str(new_offset)})
+
+    def _receive_chunk(self, stream, spool, offset, max_size) -> int:
+        """Appends the request body to the spool file in fixed-size blocks,
+        returns the new offset"""
+        received = offset
+        while stream is not None:
+            block = stream.read(self.block_size)
+            if not block:
+                break
+
+            received += len(block)
+            if received > max_size:
+                # Drop the whole chunk, so the upload stays consistent
+                spool.truncate(offset)
+                raise ValidationError(code=ResultCodes.ERR_TOO_LARGE,
+                                      detail='Chunk exceeds the size of the upload')
+            spool.write(block)
+
+        return received
+
+
+class ChunkedUploadFinalizeView(BaseChunkedUploadView):
+    """Stores a completed resumable upload as a datapoint, see
+    ChunkedUploadCreateView"""
+
+    def post(self, request, access_key, upload_id):
+        upload = self.get_upload(upload_id)
+
+        try:
+            with upload.open_spool('rb') as spool:
+                size = os.fstat(spool.fileno()).st_size
+                if upload.size is not None and size != upload.size:
+                    raise Conflict(
+                        code=ResultCodes.ERR_INCOMPLETE_UPLOAD,
+                        detail='Only {} of {} bytes were received'.format(size, upload.size)
+                    )
+
+                with transaction.atomic():
+                    DataPoint.objects.create(
+                        experiment=self.experiment,
+                        file=File(spool, name=upload.filename),
+                        session=upload.session
+                    )
+                    # Still holding the lock, so a retried finalize can't
+                    # store the upload a second time
+                    upload.discard()
+        except FileNotFoundError:
+            raise self._not_found()
+        except BlockingIOError:
+            raise self._lock_failed()
+
+        # Like BinaryUploadView, this doesn't complete the session
+        return Response(status=204)
@@ -0,0 +1,22 @@
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption('--run-large', action='store_true',
+                     help='Also run the tests marked as large, which grow '
+                          'the data to production-like sizes')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers',
+                            'large: slow test on a lot of data, needs '
+                            '--run-large')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('run_large'):
+        return
+    skip = pytest.mark.skip(reason='large tests only run with --run-large')
+    for item in items:
+        if item.get_closest_marker('large'):
+            item.add_marker(skip)
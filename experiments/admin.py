@@ -19,6 +19,9 @@ class ExperimentAdmin(admin.ModelAdmin):
         ('Experiment server', {
             'fields': ('folder_name', 'show_in_ldap_config'),
         }),
+        ('API', {
+            'fields': ('max_upload_size', 'api_rate_limit'),
+        }),
     )
     formfield_overrides = {
         models.TextField: {'widget': widgets.TextInput},
@@ -61,7 +61,8 @@ class CreateExperimentForm(TemplatedModelForm):
 class DownloadForm(TemplatedForm):
     file_format = forms.ChoiceField(
         widget=BootstrapRadioSelect,
-        choices=[('csv', 'CSV'), ('raw', 'Raw')])
+        choices=[('csv', 'CSV'), ('raw', 'Raw'),
+                 ('merged', _('experiments:forms:download:merged'))])
     include_status = forms.MultipleChoiceField(
         widget=BootstrapCheckboxSelectMultiple,
         choices=[(Experiment.OPEN, _('experiments:models:datapoint:label:test')),
@@ -70,6 +71,11 @@ class DownloadForm(TemplatedForm):
         widget=BootstrapCheckboxSelectMultiple,
         choices=()
     )
+    since_last_download = forms.BooleanField(
+        label=_('experiments:forms:download:since_last_download'),
+        help_text=_('experiments:forms:download:since_last_download:help'),
+        required=False,
+    )
 
     def __init__(self, *args, **kwargs):
         experiment = kwargs.pop('experiment')
@@ -80,3 +86,16 @@ class DownloadForm(TemplatedForm):
         # select all by default
         self.fields['include_status'].initial = [k for k, v in self.fields['include_status'].choices]
         self.fields['include_groups'].initial = [k for k, v in self.fields['include_groups'].choices]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('since_last_download'):
+            # New data is downloaded only once, so data left out by these
+            # filters would never be downloaded
+            for field in ('include_status', 'include_groups'):
+                choices = {str(k) for k, v in self.fields[field].choices}
+                if set(cleaned_data.get(field, [])) != choices:
+                    self.add_error(field, _(
+                        'experiments:forms:download:since_last_download:filtered'
+                    ))
+        return cleaned_data
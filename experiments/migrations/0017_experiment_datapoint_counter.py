@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+def backfill_datapoint_counter(apps, schema_editor):
+    """
+    Start every counter at the highest number already in use
+    """
+    experiment_model = apps.get_model("experiments", "Experiment")
+    experiments = experiment_model.objects.annotate(
+        last_number=models.Max('datapoint__number')
+    )
+    for experiment in experiments:
+        experiment_model.objects.filter(pk=experiment.pk).update(
+            datapoint_counter=experiment.last_number or 0
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0016_alter_datapoint_date_added"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="experiment",
+            name="datapoint_counter",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(
+            backfill_datapoint_counter,
+            lambda x, y: None,  # Fake reverse func, as the AddField's reverse
+            # will reverse this operation anyway
+        ),
+    ]
@@ -0,0 +1,54 @@
+from django.db import migrations, models
+
+
+def backfill_subject_counter(apps, schema_editor):
+    """
+    Older versions could hand out the same subject_id twice when sessions were
+    created concurrently. Every duplicate except the oldest gets a fresh id
+    above the highest id in use, after which the counter starts from there.
+    """
+    experiment_model = apps.get_model("experiments", "Experiment")
+    session_model = apps.get_model("experiments", "ParticipantSession")
+
+    for experiment in experiment_model.objects.all():
+        sessions = session_model.objects.filter(experiment=experiment)
+        last_id = sessions.aggregate(
+            last_id=models.Max('subject_id')
+        )['last_id'] or 0
+
+        seen = set()
+        for pk, subject_id in sessions.order_by('subject_id', 'pk')\
+                .values_list('pk', 'subject_id'):
+            if subject_id in seen:
+                last_id += 1
+                sessions.filter(pk=pk).update(subject_id=last_id)
+            else:
+                seen.add(subject_id)
+
+        experiment_model.objects.filter(pk=experiment.pk).update(
+            subject_counter=last_id
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0017_experiment_datapoint_counter"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="experiment",
+            name="subject_counter",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(
+            backfill_subject_counter,
+            lambda x, y: None,  # Fake reverse func, as the AddField's reverse
+            # will reverse this operation anyway
+        ),
+        migrations.AlterUniqueTogether(
+            name="participantsession",
+            unique_together={("experiment", "subject_id")},
+        ),
+    ]
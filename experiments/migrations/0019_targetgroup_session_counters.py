@@ -0,0 +1,63 @@
+from django.db import migrations, models
+
+COMPLETED = 2
+EXPERIMENT_OPEN = 1
+EXPERIMENT_PILOTING = 3
+
+
+def backfill_session_counters(apps, schema_editor):
+    """
+    Count the existing sessions of every group
+    """
+    group_model = apps.get_model("experiments", "TargetGroup")
+
+    def _completed(experiment_state):
+        return models.Count(
+            'participantsession',
+            filter=models.Q(
+                participantsession__state=COMPLETED,
+                participantsession__experiment_state=experiment_state
+            )
+        )
+
+    groups = group_model.objects.annotate(
+        num_started=models.Count('participantsession'),
+        num_completed=_completed(EXPERIMENT_OPEN),
+        num_pilot_completed=_completed(EXPERIMENT_PILOTING),
+    )
+    for group in groups:
+        group_model.objects.filter(pk=group.pk).update(
+            started_count=group.num_started,
+            completed_count=group.num_completed,
+            pilot_completed_count=group.num_pilot_completed,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0018_experiment_subject_counter"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="targetgroup",
+            name="started_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="targetgroup",
+            name="completed_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="targetgroup",
+            name="pilot_completed_count",
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(
+            backfill_session_counters,
+            lambda x, y: None,  # Fake reverse func, as the AddField's reverse
+            # will reverse this operation anyway
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0019_targetgroup_session_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="experiment",
+            name="max_upload_size",
+            field=models.PositiveBigIntegerField(
+                blank=True,
+                help_text="experiments:models:experiment:max_upload_size:help",
+                null=True,
+                verbose_name="experiments:models:experiment:max_upload_size",
+            ),
+        ),
+    ]
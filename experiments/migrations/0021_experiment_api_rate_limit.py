@@ -0,0 +1,23 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0020_experiment_max_upload_size"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="experiment",
+            name="api_rate_limit",
+            field=models.CharField(
+                blank=True,
+                help_text="experiments:models:experiment:api_rate_limit:help",
+                max_length=32,
+                validators=[django.core.validators.RegexValidator("^[0-9]+/[smhd][a-z]*$")],
+                verbose_name="experiments:models:experiment:api_rate_limit",
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("experiments", "0021_experiment_api_rate_limit"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ExportCursor",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("last_number", models.PositiveIntegerField(default=0)),
+                ("last_date_added", models.DateTimeField(null=True)),
+                ("date_downloaded", models.DateTimeField(auto_now=True)),
+                ("experiment", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="experiments.experiment")),
+                ("user", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                "unique_together": {("user", "experiment")},
+            },
+        ),
+    ]
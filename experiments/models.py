@@ -1,5 +1,10 @@
+from collections import Counter
+from typing import Optional
+
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import models, transaction
+from django.dispatch import Signal
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 import uuid
 
@@ -8,8 +13,31 @@ from cdh.files.db import FileField
 
 from main.models import User
 
+# Sent when a session moves to the completed state, with the session as
+# 'instance'. Saving a session that already was completed does not send it.
+session_completed = Signal()
+
+
+class CounterFieldsMixin:
+    """Keeps save() from writing COUNTER_FIELDS back to the database.
+
+    Counter fields are only ever incremented in the database itself, writing a
+    (possibly stale) in-memory value back would undo concurrent increments.
+    """
+    COUNTER_FIELDS = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.COUNTER_FIELDS
+            ]
+
+        return super().save(*args, **kwargs)
+
 
-class Experiment(models.Model):
+class Experiment(CounterFieldsMixin, models.Model):
     """Describes the metadata of an experiment"""
     OPEN = 1
     CLOSED = 2
@@ -74,6 +102,63 @@ class Experiment(models.Model):
         default=True,
     )
 
+    # Maximum size of a single upload through the API, in bytes. When empty,
+    # settings.API_MAX_UPLOAD_SIZE is used
+    max_upload_size = models.PositiveBigIntegerField(
+        _("experiments:models:experiment:max_upload_size"),
+        help_text=_("experiments:models:experiment:max_upload_size:help"),
+        null=True,
+        blank=True,
+    )
+
+    # Rate limit of the API for this experiment, like '100/min'. When empty,
+    # settings.API_THROTTLE_RATE is used
+    api_rate_limit = models.CharField(
+        _("experiments:models:experiment:api_rate_limit"),
+        help_text=_("experiments:models:experiment:api_rate_limit:help"),
+        max_length=32,
+        blank=True,
+        validators=[
+            RegexValidator(r"^[0-9]+/[smhd][a-z]*$")
+        ]
+    )
+
+    # The last DataPoint.number handed out in this experiment. Only modified
+    # through reserve_datapoint_numbers, never by a regular save()
+    datapoint_counter = models.PositiveIntegerField(default=0, editable=False)
+
+    # The last ParticipantSession.subject_id handed out in this experiment.
+    # Only modified through reserve_subject_ids
+    subject_counter = models.PositiveIntegerField(default=0, editable=False)
+
+    COUNTER_FIELDS = ('datapoint_counter', 'subject_counter')
+
+    def _reserve(self, counter: str, amount: int) -> int:
+        """Atomically increments the given counter field by amount and
+        returns the first value of the reserved block.
+
+        The UPDATE locks this experiment's row until the surrounding
+        transaction ends, so concurrent callers always receive distinct blocks.
+        """
+        with transaction.atomic():
+            Experiment.objects.filter(pk=self.pk).update(
+                **{counter: models.F(counter) + amount}
+            )
+            last = Experiment.objects.filter(pk=self.pk).values_list(
+                counter, flat=True
+            ).get()
+
+        setattr(self, counter, last)
+        return last - amount + 1
+
+    def reserve_datapoint_numbers(self, amount: int = 1) -> int:
+        """Reserves a block of amount DataPoint numbers, returns the first"""
+        return self._reserve('datapoint_counter', amount)
+
+    def reserve_subject_ids(self, amount: int = 1) -> int:
+        """Reserves a block of amount subject ids, returns the first"""
+        return self._reserve('subject_counter', amount)
+
     def get_state_display(self):
         # While not included, this is actually a state. One that overrides the
         # state defined by researchers. That is also the reason why it's not
@@ -96,13 +181,18 @@ class Experiment(models.Model):
         """An experiment is open if it is both approved and set to 'open'.
         It should also have at least one target group that is open to new participants.
         While an experiment should not be able to have the status 'open' without being approved,
-        we check both to be sure."""
-        experiment_open = self.state in (self.OPEN, self.PILOTING) and self.approved
-        groups_open = True
-        if self.has_groups():
-            groups_open = any((group.is_open() for group in self.targetgroup_set.all()))
+        we check both to be sure.
+
+        When the target groups are prefetched, this does not query the
+        database at all."""
+        if not (self.state in (self.OPEN, self.PILOTING) and self.approved):
+            return False
 
-        return experiment_open and groups_open
+        groups = self.targetgroup_set.all()
+        if not groups:
+            return True
+
+        return any(group.is_open() for group in groups)
 
     def has_groups(self):
         """
@@ -117,52 +207,131 @@ class Experiment(models.Model):
         return self.targetgroup_set.count() > 1
 
     def get_next_group(self):
-        # the basic idea here is to assign incoming sessions equally across all available groups.
-        # however, since opened session don't necessarily reflect completed sessions, we also try
-        # to rebalance the distribution whenever a session is completed
-        groups = list(self.targetgroup_set.all().order_by('pk'))
-        filtered_sessions = self.participantsession_set.filter(experiment_state=self.state)
+        """Picks the target group for the next participant session.
 
-        if len(groups) < 1:
-            # experiment has no groups defined, it should still be possible to run it using the old API
-            # but trying to create a participant session should fail.
-            return None
+        This locks the experiment's row until the surrounding transaction
+        ends, which serializes concurrent assignments. Call it from the
+        transaction that creates the session (see create_session), otherwise
+        the lock is already released before the session exists.
 
-        last_opened = filtered_sessions.order_by('-date_started').first()
-        last_closed = filtered_sessions\
-            .filter(state=ParticipantSession.COMPLETED)\
-            .order_by('-date_updated').first()
+        The amount of queries does not depend on the amount of groups or
+        sessions.
+        """
+        groups = self.get_next_groups(1)
+        return groups[0] if groups else None
+
+    def get_next_groups(self, amount):
+        """Picks the target groups for the next amount participant sessions,
+        in the order in which get_next_group would pick them if the sessions
+        were created one by one. Returns an empty list if no group is open.
 
-        if last_closed is not None and last_closed.date_updated > last_opened.date_started:
+        Like get_next_group, this locks the experiment's row.
+        """
+        # the basic idea here is to assign incoming sessions equally across all available groups.
+        # however, since opened session don't necessarily reflect completed sessions, we also try
+        # to rebalance the distribution whenever a session is completed
+        with transaction.atomic():
+            Experiment.objects.select_for_update().filter(pk=self.pk)\
+                .values_list('pk', flat=True).get()
+
+            groups = list(self.targetgroup_set.order_by('pk'))
+            if len(groups) < 1:
+                # experiment has no groups defined, it should still be possible to run it using the old API
+                # but trying to create a participant session should fail.
+                return []
+
+            filtered_sessions = self.participantsession_set.filter(experiment_state=self.state)
+            last_opened = filtered_sessions.order_by('-date_started', '-pk')\
+                .values_list('group_id', 'date_started').first()
+            last_closed = filtered_sessions\
+                .filter(state=ParticipantSession.COMPLETED)\
+                .order_by('-date_updated')\
+                .values_list('date_updated', flat=True).first()
+
+        # New sessions don't change which groups are open, as only completed
+        # sessions count towards the completion target
+        open_groups = [group for group in groups if group.is_open()]
+        if not open_groups:
+            return []
+
+        if last_opened is not None and last_closed is not None and last_closed > last_opened[1]:
             # last thing to happen was a session being completed
             # assign the incoming participant to the group with less completed sessions
-            completed_expr = models.Count(
-                'participantsession',
-                filter=models.Q(participantsession__state=ParticipantSession.COMPLETED,
-                                participantsession__experiment_state=self.state)
-            )
-            annotated = self.targetgroup_set.annotate(completed=completed_expr)
-            for group in annotated.order_by('completed'):
-                if group.is_open():
-                    return group
-            return None
+            # (min() returns the first group in pk order on a tie)
+            first = min(open_groups,
+                        key=lambda group: group.num_completed_in(self.state))
+            last_idx = open_groups.index(first)
+            picked = [first]
         else:
             # last thing to happen was a new session being opened
-            # assign the incoming participant to the next group in line
-            if last_opened is None:
+            # assign the incoming participant to the next open group in line
+            group_ids = [group.pk for group in groups]
+            if last_opened is None or last_opened[0] not in group_ids:
                 # no participants yet
-                last_idx = len(groups) - 1
+                last_group = groups[-1]
             else:
-                last_idx = groups.index(last_opened.group)
-            i = (last_idx + 1) % len(groups)
-            while not groups[i].is_open():
-                # too many completed sessions, advance to the next group
-                if i == last_idx:
-                    # looped around, no group to assign
-                    return None
-                i = (i + 1) % len(groups)
+                last_group = groups[group_ids.index(last_opened[0])]
+
+            # too many completed sessions, advance to the next open group
+            last_idx = len(open_groups) - 1
+            for idx, group in enumerate(open_groups):
+                if group.pk > last_group.pk:
+                    last_idx = idx - 1
+                    break
+            picked = []
+
+        # every following session goes to the next open group in line
+        while len(picked) < amount:
+            last_idx = (last_idx + 1) % len(open_groups)
+            picked.append(open_groups[last_idx])
+
+        return picked
+
+    def create_session(self):
+        """Creates a participant session in the next group in line. Returns
+        None if no group could be assigned.
+        """
+        with transaction.atomic():
+            group = self.get_next_group()
+            if not group:
+                return None
+
+            return ParticipantSession.objects.create(
+                experiment=self,
+                state=ParticipantSession.STARTED,
+                group=group
+            )
 
-            return groups[i]
+    def create_sessions(self, amount):
+        """Creates amount participant sessions at once, spread over the groups
+        like create_session would. Returns an empty list if no group could be
+        assigned.
+
+        The sessions are inserted in bulk, so no signals are sent for them.
+        """
+        with transaction.atomic():
+            groups = self.get_next_groups(amount)
+            if not groups:
+                return []
+
+            first_subject_id = self.reserve_subject_ids(amount)
+            sessions = ParticipantSession.objects.bulk_create([
+                ParticipantSession(
+                    experiment=self,
+                    state=ParticipantSession.STARTED,
+                    experiment_state=self.state,
+                    group=group,
+                    subject_id=first_subject_id + i,
+                )
+                for i, group in enumerate(groups)
+            ])
+
+            # Normally done by the post_save signal of every session
+            for group, started in Counter(groups).items():
+                TargetGroup.update_counters(group.pk, self.state,
+                                            started=started)
+
+            return sessions
 
 
 class DataPoint(models.Model):
@@ -203,7 +372,8 @@ class DataPoint(models.Model):
     STATUS_PILOT = _('experiments:models:datapoint:label:pilot')
 
     def is_file(self):
-        return self.file is not None
+        # An empty FileField still gives a (falsy) FieldFile, never None
+        return bool(self.file)
 
     def get_status_display(self):
         if self.session is None:
@@ -212,18 +382,58 @@ class DataPoint(models.Model):
             return self.STATUS_PILOT
         return self.STATUS_TEST
 
+    @staticmethod
+    def get_payload_size(payload: str) -> int:
+        """The size of a text payload in bytes, as it was received. Parsed
+        payloads carry their size, others are measured."""
+        size = getattr(payload, 'size', None)
+        if size is None:
+            size = len(payload.encode('utf-8'))
+        return size
+
+    @classmethod
+    def bulk_create_data(cls, experiment: Experiment, payloads, session=None):
+        """Creates a datapoint for every (text) payload using a single block of
+        reserved numbers. Like bulk_create, this does not send any signals.
+        """
+        with transaction.atomic():
+            first_number = experiment.reserve_datapoint_numbers(len(payloads))
+            return cls.objects.bulk_create([
+                cls(
+                    experiment=experiment,
+                    session=session,
+                    data=payload,
+                    number=first_number + i,
+                    size=DataPoint.get_payload_size(payload),
+                )
+                for i, payload in enumerate(payloads)
+            ])
+
     def save(self, *args, **kwargs):
         if self.data is None and self.file is None:
             raise ValueError('Datapoint must contain either inline data or a file upload')
         if self.data is not None and self.file is not None:
             raise ValueError('Unexpected attempt to save datapoint containing both inline data and a file upload')
 
-        return super().save(*args, **kwargs)
+        if self._state.adding and self.file:
+            # Normally stored by the field right before the insert, after the
+            # number is reserved. That locks the experiment until the insert
+            # commits, which should not last as long as copying a large file.
+            self._meta.get_field('file').pre_save(self, add=True)
+
+        # The number is reserved in a pre_save signal, which should happen in
+        # the same transaction as the insert itself. Datapoints then become
+        # visible in the order of their numbers, which ExportCursor relies on.
+        with transaction.atomic():
+            return super().save(*args, **kwargs)
 
     def __str__(self):
         return "Datapoint {}".format(self.number)
 
 class ParticipantSession(models.Model):
+    class Meta:
+        unique_together = ['experiment', 'subject_id']
+
     STARTED = 1
     COMPLETED = 2
     REJECTED = 3
@@ -261,9 +471,31 @@ class ParticipantSession(models.Model):
     def group_name(self):
         return self.group.name
 
+    def save(self, *args, **kwargs):
+        # The subject_id is reserved in a pre_save signal, which should happen
+        # in the same transaction as the insert itself
+        with transaction.atomic():
+            return super().save(*args, **kwargs)
+
     def complete(self):
-        self.state = self.COMPLETED
-        self.save()
+        with transaction.atomic():
+            # Only the call that actually moves the session to completed may
+            # update the group's counters, even when called concurrently
+            transitioned = ParticipantSession.objects.filter(pk=self.pk)\
+                .exclude(state=self.COMPLETED)\
+                .update(state=self.COMPLETED)
+
+            self.state = self.COMPLETED
+            self.save()
+
+            if transitioned:
+                TargetGroup.update_counters(
+                    self.group_id,
+                    self.experiment_state,
+                    completed=1
+                )
+                session_completed.send(sender=ParticipantSession,
+                                       instance=self)
 
     def delete_if_empty(self):
         # this is used in the DataPoint post_delete hook.
@@ -273,7 +505,7 @@ class ParticipantSession(models.Model):
             self.delete()
 
 
-class TargetGroup(models.Model):
+class TargetGroup(CounterFieldsMixin, models.Model):
     experiment = models.ForeignKey(Experiment, on_delete=models.CASCADE)
     name = models.CharField(
         _("experiments:models:targetgroup:name"),
@@ -281,19 +513,33 @@ class TargetGroup(models.Model):
         help_text=_("experiments:models:targetgroup:name:help"),
     )
 
+    # Denormalized session counts, kept up to date by the ParticipantSession
+    # signals and ParticipantSession.complete(). The recount_target_groups
+    # command re-derives them from the sessions themselves.
+    started_count = models.IntegerField(default=0, editable=False)
+    completed_count = models.IntegerField(default=0, editable=False)
+    pilot_completed_count = models.IntegerField(default=0, editable=False)
+
+    COUNTER_FIELDS = ('started_count', 'completed_count',
+                      'pilot_completed_count')
+
+    # Which counter holds the completed sessions for a given experiment_state
+    COMPLETED_COUNTERS = {
+        Experiment.OPEN: 'completed_count',
+        Experiment.PILOTING: 'pilot_completed_count',
+    }
+
     @property
     def num_started(self):
-        return self.participantsession_set.count()
+        return self.started_count
 
     @property
     def num_completed(self):
-        return self.participantsession_set.filter(state=ParticipantSession.COMPLETED,
-                                                  experiment_state=Experiment.OPEN).count()
+        return self.completed_count
 
     @property
     def num_pilot_completed(self):
-        return self.participantsession_set.filter(state=ParticipantSession.COMPLETED,
-                                                  experiment_state=Experiment.PILOTING).count()
+        return self.pilot_completed_count
 
     completion_target = models.IntegerField(
         _("experiments:models:targetgroup:completion_target"),
@@ -304,3 +550,104 @@ class TargetGroup(models.Model):
 
     def is_open(self):
         return self.num_completed < self.completion_target
+
+    def num_completed_in(self, experiment_state):
+        """The number of sessions completed while the experiment was in the
+        given state"""
+        counter = self.COMPLETED_COUNTERS.get(experiment_state)
+        return getattr(self, counter) if counter else 0
+
+    @classmethod
+    def update_counters(cls, group_id, experiment_state, started=0,
+                        completed=0):
+        """Adds the given deltas to the counters of a group in the database.
+
+        :param experiment_state: the experiment_state of the session(s)
+                                 involved, decides which completed counter to
+                                 use
+        """
+        changes = {}
+        if started:
+            changes['started_count'] = models.F('started_count') + started
+
+        completed_counter = cls.COMPLETED_COUNTERS.get(experiment_state)
+        if completed and completed_counter:
+            changes[completed_counter] = \
+                models.F(completed_counter) + completed
+
+        if changes:
+            cls.objects.filter(pk=group_id).update(**changes)
+
+
+class ExportCursor(models.Model):
+    """Up to which datapoint a user has downloaded the new data of an
+    experiment, so the next download of new data can start there.
+
+    Only downloads of new data move the cursor, and only once they were sent
+    completely. Without a cursor, all data is new.
+    """
+
+    class Meta:
+        unique_together = ['user', 'experiment']
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    experiment = models.ForeignKey(Experiment, on_delete=models.CASCADE)
+
+    last_number = models.PositiveIntegerField(default=0)
+    # date_added of that datapoint
+    last_date_added = models.DateTimeField(null=True)
+    date_downloaded = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_for(cls, user: User, experiment: Experiment) -> 'ExportCursor':
+        """The cursor of the user, unsaved when they never downloaded new
+        data of the experiment before"""
+        cursor = cls.objects.filter(user=user, experiment=experiment).first()
+        return cursor or cls(user=user, experiment=experiment)
+
+    def get_last(self) -> Optional[dict]:
+        """The number and date_added of the newest datapoint, or None when
+        there is no new data.
+
+        Numbers are reserved in the transaction that inserts the datapoint,
+        which keeps the experiment locked until it commits. A datapoint can
+        therefore not show up after one with a higher number, so moving the
+        cursor up to the newest one skips none.
+        """
+        return self.experiment.datapoint_set \
+            .filter(number__gt=self.last_number) \
+            .order_by('-number') \
+            .values('number', 'date_added') \
+            .first()
+
+    def filter_new(self, queryset, last: Optional[dict]):
+        """Filters the datapoints in the queryset that are new, up to and
+        including last (see get_last()). Uses the index on experiment and
+        number, so the cost depends on the new data only."""
+        if last is None:
+            return queryset.none()
+        return queryset.filter(
+            number__gt=self.last_number,
+            number__lte=last['number'],
+        ).order_by('number')
+
+    def advance(self, last: Optional[dict]) -> None:
+        """Moves the cursor up to last. Downloads of the same user can run at
+        the same time, so this never creates a second cursor, nor moves one
+        back."""
+        if last is None:
+            return
+        cursor, created = ExportCursor.objects.get_or_create(
+            user=self.user,
+            experiment=self.experiment,
+            defaults={
+                'last_number': last['number'],
+                'last_date_added': last['date_added'],
+            }
+        )
+        if not created:
+            ExportCursor.objects \
+                .filter(pk=cursor.pk, last_number__lt=last['number']) \
+                .update(last_number=last['number'],
+                        last_date_added=last['date_added'],
+                        date_downloaded=timezone.now())
@@ -12,4 +12,8 @@ class ExperimentSerializer(ModelDisplaySerializer):
     num_datapoints = serializers.SerializerMethodField()
 
     def get_num_datapoints(self, experiment):
-        return experiment.datapoint_set.count()
+        # Listings annotate the count, so they don't need a query per row
+        num_datapoints = getattr(experiment, 'num_datapoints', None)
+        if num_datapoints is None:
+            num_datapoints = experiment.datapoint_set.count()
+        return num_datapoints
@@ -1,28 +1,19 @@
-import sys
-
 from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 
-from .models import DataPoint, ParticipantSession, Experiment
+from .models import DataPoint, ParticipantSession, Experiment, TargetGroup
+from .utils import export_cache
 
 
 @receiver(pre_save, sender=DataPoint)
 def on_datapoint_creation(sender, instance, *args, **kwargs):
     if not instance.number:
-        # Set this DP's number
-        experiment = instance.experiment
-        last_datapoint = experiment.datapoint_set.all().order_by(
-            'date_added'
-        ).last()
-
-        if last_datapoint:
-            instance.number = last_datapoint.number + 1
-        else:
-            instance.number = 1
+        # Set this DP's number, using the experiment's counter
+        instance.number = instance.experiment.reserve_datapoint_numbers()
 
     if not instance.size or instance.size == 0:
         if instance.data is not None:
-            instance.size = sys.getsizeof(instance.data)
+            instance.size = DataPoint.get_payload_size(instance.data)
         else:
             instance.size = instance.file.size
 
@@ -40,6 +31,17 @@ def on_datapoint_delete(sender, instance, *args, **kwargs):
         pass
 
 
+@receiver(post_delete, sender=DataPoint)
+def on_datapoint_delete_invalidate_export(sender, instance, *args, **kwargs):
+    """Cached exports can only be appended to, so they are rebuilt"""
+    export_cache.invalidate(instance.experiment_id)
+
+
+@receiver(post_delete, sender=Experiment)
+def on_experiment_delete(sender, instance: Experiment, *args, **kwargs):
+    export_cache.remove(instance.pk)
+
+
 @receiver(pre_save, sender=ParticipantSession)
 def on_participant_session_creation(
         sender,
@@ -47,22 +49,48 @@ def on_participant_session_creation(
         *args,
         **kwargs):
 
-    # save the state of the experiment at the time the session was started
-    instance.experiment_state = instance.experiment.state
+    # save the state of the experiment at the time the session was started,
+    # unless the caller knows it better (see drain_upload_journal)
+    if instance._state.adding and instance.experiment_state is None:
+        instance.experiment_state = instance.experiment.state
 
     """
     Add an incremental session_id number when saving a session starting from 1
     """
     if not instance.subject_id:
-        experiment = instance.experiment
-        last_session = experiment.participantsession_set.all().order_by(
-            'subject_id'
-        ).last()
+        instance.subject_id = instance.experiment.reserve_subject_ids()
 
-        if last_session:
-            instance.subject_id = last_session.subject_id + 1
-        else:
-            instance.subject_id = 1
+
+@receiver(post_save, sender=ParticipantSession)
+def on_participant_session_saved(
+        sender,
+        instance: ParticipantSession,
+        created,
+        *args,
+        **kwargs):
+    """Count new sessions in their group's counters"""
+    if created:
+        TargetGroup.update_counters(
+            instance.group_id,
+            instance.experiment_state,
+            started=1,
+            completed=int(instance.state == ParticipantSession.COMPLETED)
+        )
+
+
+@receiver(post_delete, sender=ParticipantSession)
+def on_participant_session_delete(
+        sender,
+        instance: ParticipantSession,
+        *args,
+        **kwargs):
+    """Remove deleted sessions from their group's counters"""
+    TargetGroup.update_counters(
+        instance.group_id,
+        instance.experiment_state,
+        started=-1,
+        completed=-int(instance.state == ParticipantSession.COMPLETED)
+    )
 
 
 @receiver(post_save, sender=Experiment)
@@ -0,0 +1,63 @@
+"""Factories that create experiments and their data, for tests that need a
+realistic amount of rows.
+
+Data is inserted with bulk_create by experiments.utils.fake_data, so no
+signals are sent for it. Sessions can be created in bulk with
+Experiment.create_sessions."""
+import uuid
+
+from main.models import User
+
+from ..models import Experiment
+from ..utils.fake_data import FakeDataGenerator
+
+
+def create_user(username='researcher', **kwargs) -> User:
+    return User.objects.create(username=username, **kwargs)
+
+
+def create_experiment(users=(), **kwargs) -> Experiment:
+    """Creates an experiment with its default group, which the given users
+    have access to"""
+    kwargs.setdefault('access_id', uuid.uuid4())
+    kwargs.setdefault('title', 'Experiment')
+    kwargs.setdefault('folder_name', 'experiment-{}'.format(
+        kwargs['access_id'].hex[:8]
+    ))
+    experiment = Experiment.objects.create(**kwargs)
+    experiment.users.add(*users)
+    return experiment
+
+
+def create_experiments(amount, users=(), **kwargs) -> list:
+    """Creates amount experiments at once. Unlike create_experiment, these
+    have no target groups."""
+    experiments = []
+    for i in range(amount):
+        access_id = uuid.uuid4()
+        experiments.append(Experiment(
+            access_id=access_id,
+            title='Experiment {}'.format(i),
+            folder_name='experiment-{}'.format(access_id.hex[:8]),
+            **kwargs
+        ))
+    experiments = Experiment.objects.bulk_create(experiments)
+
+    Experiment.users.through.objects.bulk_create([
+        Experiment.users.through(experiment_id=experiment.pk, user_id=user.pk)
+        for experiment in experiments
+        for user in users
+    ])
+    return experiments
+
+
+def create_datapoints(experiment, amount, sessions=None, seed=0) -> None:
+    """Creates amount text datapoints like the generate_fake_data command
+    does, but with smaller payloads. When sessions are given, the
+    datapoints are divided over those sessions in order."""
+    generator = FakeDataGenerator(seed, trials=5)
+    generator.create_datapoints(
+        experiment,
+        amount,
+        [session.pk for session in sessions] if sessions else None
+    )
@@ -1,4 +1,16 @@
+import csv
+import os
+import shutil
+import tempfile
+import tracemalloc
+import zipfile
+from io import BytesIO, StringIO
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase, modify_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from unittest.mock import patch, ANY
 from django.utils import timezone
@@ -10,7 +22,13 @@ import random
 import uuid
 
 # Create your tests here.
-from ..models import Experiment, ParticipantSession, TargetGroup, DataPoint
+from ..models import Experiment, ParticipantSession, TargetGroup, DataPoint, \
+    ExportCursor
+from ..utils import create_cached_download_response_zip, \
+    create_delta_download_response_zip, create_download_response_zip, \
+    export_cache
+from ..utils.fake_data import FakeDataGenerator
+from .factories import create_datapoints, create_experiment, create_user
 
 
 class ParticipantSessionSubjectIdTests(TestCase):
@@ -88,6 +106,665 @@ class ParticipantSessionSubjectIdTests(TestCase):
         # cleanup
         ParticipantSession.objects.all().delete()
 
+    def test_participant_session_subject_id_constant_queries(self):
+        """
+        Test that allocating a subject_id does not depend on the amount of
+        existing sessions.
+        """
+        group = self.experiment1.targetgroup_set.first()
+
+        def _create():
+            with CaptureQueriesContext(connection) as ctx:
+                ParticipantSession.objects.create(
+                    experiment=self.experiment1,
+                    group=group
+                )
+            return len(ctx)
+
+        first = _create()
+        for _ in range(50):
+            ParticipantSession.objects.create(
+                experiment=self.experiment1,
+                group=group
+            )
+
+        self.assertEqual(_create(), first)
+
+
+class DataPointNumberTests(TestCase):
+    """
+    Test that datapoint numbers are handed out by the experiment's counter.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.experiment1 = Experiment.objects.create(access_id=uuid.uuid4())
+        cls.experiment2 = Experiment.objects.create(access_id=uuid.uuid4())
+
+    def test_datapoint_number_per_experiment(self):
+        dp_e1_1 = DataPoint.objects.create(experiment=self.experiment1, data='')
+        dp_e1_2 = DataPoint.objects.create(experiment=self.experiment1, data='')
+        dp_e2_1 = DataPoint.objects.create(experiment=self.experiment2, data='')
+
+        self.assertEqual(dp_e1_1.number, 1)
+        self.assertEqual(dp_e1_2.number, 2)
+        self.assertEqual(dp_e2_1.number, 1)
+
+    def test_datapoint_number_not_reused_after_delete(self):
+        DataPoint.objects.create(experiment=self.experiment1, data='')
+        last = DataPoint.objects.create(experiment=self.experiment1, data='')
+        last.delete()
+
+        dp = DataPoint.objects.create(experiment=self.experiment1, data='')
+        self.assertEqual(dp.number, 3)
+
+    def test_stale_experiment_save_keeps_counter(self):
+        stale = Experiment.objects.get(pk=self.experiment1.pk)
+        DataPoint.objects.create(experiment=self.experiment1, data='')
+
+        stale.title = 'Renamed'
+        stale.save()
+
+        dp = DataPoint.objects.create(experiment=self.experiment1, data='')
+        self.assertEqual(dp.number, 2)
+
+    def test_reserve_block(self):
+        self.assertEqual(self.experiment1.reserve_datapoint_numbers(10), 1)
+        self.assertEqual(self.experiment1.reserve_datapoint_numbers(), 11)
+
+
+class TargetGroupCounterTests(TestCase):
+    """
+    Test that the denormalized session counters of target groups follow the
+    sessions.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.exp = Experiment.objects.create(
+            access_id=uuid.uuid4(),
+            state=Experiment.OPEN,
+            approved=True
+        )
+        cls.group = cls.exp.targetgroup_set.first()
+
+    def _counters(self):
+        self.group.refresh_from_db()
+        return (self.group.num_started, self.group.num_completed,
+                self.group.num_pilot_completed)
+
+    def test_counters_follow_sessions(self):
+        s1 = self.exp.participantsession_set.create(group=self.group)
+        s2 = self.exp.participantsession_set.create(group=self.group)
+        self.assertEqual(self._counters(), (2, 0, 0))
+
+        s1.complete()
+        s1.complete()  # completing twice should only be counted once
+        self.assertEqual(self._counters(), (2, 1, 0))
+
+        s1.delete()
+        s2.delete()
+        self.assertEqual(self._counters(), (0, 0, 0))
+
+    def test_pilot_counter(self):
+        self.exp.state = Experiment.PILOTING
+        self.exp.save()
+        session = self.exp.participantsession_set.create(group=self.group)
+        self.exp.participantsession_set.create(
+            group=self.group,
+            state=ParticipantSession.COMPLETED
+        )
+
+        # Changing the state afterwards should not move existing sessions
+        self.exp.state = Experiment.OPEN
+        self.exp.save()
+        session.complete()
+
+        self.assertEqual(self._counters(), (2, 0, 2))
+
+    def test_stale_group_save_keeps_counters(self):
+        stale = TargetGroup.objects.get(pk=self.group.pk)
+        self.exp.participantsession_set.create(group=self.group).complete()
+
+        stale.name = 'Renamed'
+        stale.save()
+
+        self.assertEqual(self._counters(), (1, 1, 0))
+
+    def test_is_open_query_free(self):
+        self.group.completion_target = 1
+        self.group.save()
+        exp = Experiment.objects.prefetch_related('targetgroup_set')\
+            .get(pk=self.exp.pk)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(exp.is_open())
+
+        self.exp.participantsession_set.create(group=self.group).complete()
+        exp = Experiment.objects.prefetch_related('targetgroup_set')\
+            .get(pk=self.exp.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(exp.is_open())
+
+    def test_recount_command(self):
+        self.exp.participantsession_set.create(group=self.group).complete()
+        self.exp.participantsession_set.create(group=self.group)
+        TargetGroup.objects.filter(pk=self.group.pk).update(
+            started_count=5,
+            completed_count=0
+        )
+
+        out = StringIO()
+        call_command('recount_target_groups', '--dry-run', stdout=out)
+        self.assertIn('started_count 5 -> 2', out.getvalue())
+        self.assertEqual(self._counters(), (5, 0, 0))
+
+        out = StringIO()
+        call_command('recount_target_groups', stdout=out)
+        self.assertIn('1 group(s) with drifted counters', out.getvalue())
+        self.assertEqual(self._counters(), (2, 1, 0))
+
+        out = StringIO()
+        call_command('recount_target_groups', stdout=out)
+        self.assertIn('0 group(s) with drifted counters', out.getvalue())
+
+
+class FakeDataTests(TestCase):
+    def _generate(self, seed):
+        call_command('generate_fake_data', '--groups', '3', '--sessions', '20',
+                     '--datapoints', '50', '--seed', str(seed),
+                     stdout=StringIO())
+        exp = Experiment.objects.latest('pk')
+        data_points = exp.datapoint_set.select_related('session__group')\
+            .order_by('number')
+        return exp, [
+            (dp.number, dp.session.subject_id, dp.session.group.name,
+             dp.session.state, dp.size, dp.data)
+            for dp in data_points
+        ]
+
+    def test_same_seed_same_data(self):
+        exp, data = self._generate(1)
+        self.assertEqual(exp.targetgroup_set.count(), 3)
+        self.assertEqual(len(data), 50)
+
+        self.assertEqual(self._generate(1)[1], data)
+        self.assertNotEqual(self._generate(2)[1], data)
+
+    def test_binary(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        generator = FakeDataGenerator(binary_fraction=0.5, binary_size=1000)
+        exp = generator.create_experiment('Fake binaries')
+
+        with self.settings(MEDIA_ROOT=media_root):
+            generator.create_datapoints(exp, 20)
+            files = [dp for dp in exp.datapoint_set.all() if dp.is_file()]
+            self.assertTrue(0 < len(files) < 20)
+            for data_point in files:
+                self.assertIsNone(data_point.data)
+                with data_point.file.open('rb') as f:
+                    self.assertEqual(len(f.read()), data_point.size)
+                self.assertTrue(data_point.file.name.endswith('.webm'))
+
+    def test_counters(self):
+        exp, _ = self._generate(0)
+        for group in exp.targetgroup_set.all():
+            sessions = group.participantsession_set
+            self.assertEqual(group.num_started, sessions.count())
+            self.assertEqual(
+                group.num_completed,
+                sessions.filter(state=ParticipantSession.COMPLETED).count()
+            )
+
+
+def _read_zip(content: bytes):
+    with zipfile.ZipFile(BytesIO(content)) as zip_file:
+        return [(name, zip_file.read(name)) for name in zip_file.namelist()]
+
+
+class ExportPoolTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.exp = create_experiment(title='Export pool')
+        create_datapoints(cls.exp, 120, cls.exp.create_sessions(10))
+        # Not JSON, so it can't be converted to CSV
+        DataPoint.bulk_create_data(cls.exp, ['not json'])
+
+    def _export(self, file_format):
+        response = create_download_response_zip(file_format, self.exp)
+        return _read_zip(b''.join(response.streaming_content))
+
+    def _assertSameExport(self, file_format, **pool_settings):
+        with self.settings(EXPORT_WORKERS=0, EXPORT_COMPRESSION_THREADS=0):
+            expected = self._export(file_format)
+        with self.settings(**pool_settings):
+            self.assertEqual(self._export(file_format), expected)
+
+    def test_thread_pool(self):
+        for file_format in ('csv', 'raw'):
+            self._assertSameExport(file_format, EXPORT_WORKERS=3,
+                                   EXPORT_WORKER_TYPE='thread')
+
+    def test_process_pool(self):
+        self._assertSameExport('csv', EXPORT_WORKERS=2,
+                               EXPORT_WORKER_TYPE='process')
+
+    def test_compression_threads(self):
+        self._assertSameExport('raw', EXPORT_WORKERS=2,
+                               EXPORT_WORKER_TYPE='thread',
+                               EXPORT_COMPRESSION_THREADS=3)
+
+    def test_stored_files(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with self.settings(MEDIA_ROOT=media_root):
+            for name in ('recording.webm', 'responses.csv'):
+                DataPoint.objects.create(
+                    experiment=self.exp,
+                    number=self.exp.reserve_datapoint_numbers(1),
+                    size=1000,
+                    file=ContentFile(b'a' * 1000, name=name),
+                )
+
+            response = create_download_response_zip('raw', self.exp)
+            content = BytesIO(b''.join(response.streaming_content))
+        with zipfile.ZipFile(content) as zip_file:
+            compression = {info.filename.rsplit('.')[-1]: info.compress_type
+                           for info in zip_file.infolist()}
+            self.assertIsNone(zip_file.testzip())
+        self.assertEqual(compression['webm'], zipfile.ZIP_STORED)
+        self.assertEqual(compression['csv'], zipfile.ZIP_DEFLATED)
+        self.assertEqual(compression['txt'], zipfile.ZIP_DEFLATED)
+
+    def test_failed_datapoint(self):
+        with self.settings(EXPORT_WORKERS=2, EXPORT_WORKER_TYPE='thread'):
+            report = dict(self._export('csv'))['export_report.txt']
+        self.assertIn(b'export-pool__0121.csv - FAILED', report)
+        self.assertEqual(report.count(b'SUCCESS'), 120)
+
+
+class ExportCacheTests(TestCase):
+    def setUp(self):
+        self.exp = create_experiment(title='Export cache')
+        self._add(10)
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        settings_override = self.settings(EXPORT_CACHE_DIR=cache_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _add(self, amount):
+        create_datapoints(self.exp, amount, self.exp.create_sessions(amount))
+
+    def _download(self, file_format='csv'):
+        response = create_cached_download_response_zip(file_format, self.exp)
+        content = b''.join(response.streaming_content)
+        response.close()
+        if response.has_header('Content-Length'):
+            self.assertEqual(int(response['Content-Length']), len(content))
+        return response, content
+
+    def _expected(self, file_format='csv'):
+        response = create_download_response_zip(file_format, self.exp)
+        return _read_zip(b''.join(response.streaming_content))
+
+    def test_cached(self):
+        # Built while it is sent, so its size isn't known yet
+        response, content = self._download()
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertEqual(_read_zip(content), self._expected())
+
+        # Served as is
+        with CaptureQueriesContext(connection) as ctx:
+            response, second = self._download()
+        self.assertTrue(response.has_header('Content-Length'))
+        self.assertEqual(second, content)
+        self.assertEqual(len(ctx), 1)
+
+        _, raw = self._download('raw')
+        self.assertEqual(_read_zip(raw), self._expected('raw'))
+
+    def test_append(self):
+        _, content = self._download()
+        state = export_cache._read_state(self.exp.pk, 'csv')
+
+        self._add(5)
+        _, appended = self._download()
+        self.assertEqual(_read_zip(appended), self._expected())
+        # The entries that were there are kept as they were
+        offset = state['report_offset']
+        self.assertEqual(appended[:offset], content[:offset])
+
+    def test_delete(self):
+        self._download()
+        self.exp.datapoint_set.latest('number').delete()
+        self.assertIsNone(export_cache._read_state(self.exp.pk, 'csv'))
+
+        _, content = self._download()
+        self.assertEqual(_read_zip(content), self._expected())
+
+    def test_rename(self):
+        self._download()
+        self.exp.title = 'Renamed'
+        self.exp.save()
+
+        _, content = self._download()
+        self.assertEqual(_read_zip(content), self._expected())
+
+    def test_rebuild_streamed(self):
+        response = create_cached_download_response_zip('csv', self.exp)
+        chunks = iter(response.streaming_content)
+        first = next(chunks)
+
+        # The download started before the archive was complete. Meanwhile,
+        # others get an export on the fly.
+        self.assertIsNone(export_cache._read_state(self.exp.pk, 'csv'))
+        other, content = self._download()
+        self.assertFalse(other.has_header('Content-Length'))
+        self.assertEqual(_read_zip(content), self._expected())
+
+        content = first + b''.join(chunks)
+        response.close()
+        self.assertEqual(_read_zip(content), self._expected())
+        self.assertIsNotNone(export_cache._read_state(self.exp.pk, 'csv'))
+
+    def test_rebuild_aborted(self):
+        response = create_cached_download_response_zip('csv', self.exp)
+        next(iter(response.streaming_content))
+        response.close()
+        self.assertIsNone(export_cache._read_state(self.exp.pk, 'csv'))
+
+        # Rebuilt from scratch
+        _, content = self._download()
+        self.assertEqual(_read_zip(content), self._expected())
+        response, cached = self._download()
+        self.assertTrue(response.has_header('Content-Length'))
+        self.assertEqual(cached, content)
+
+    def test_in_use(self):
+        self._download()
+        # Someone else is downloading the archive
+        archive, _ = export_cache.open_archive(self.exp, 'csv')
+        self.addCleanup(archive.close)
+
+        response, _ = self._download()
+        self.assertTrue(response.has_header('Content-Length'))
+
+        # It can't be updated until they're done, so it's exported on the fly
+        self._add(1)
+        response, content = self._download()
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertEqual(_read_zip(content), self._expected())
+
+    def test_delete_experiment(self):
+        self._download()
+        self.exp.delete()
+        self.assertFalse(os.path.exists(export_cache.get_cache_dir(self.exp.pk)))
+
+
+class DeltaExportTests(TestCase):
+    databases = '__all__'  # required for login because of auditlog
+
+    def setUp(self):
+        self.user = create_user()
+        self.exp = create_experiment(users=[self.user], title='Delta export',
+                                     state=Experiment.OPEN)
+        self._add(10)
+
+    def _add(self, amount):
+        create_datapoints(self.exp, amount, self.exp.create_sessions(amount))
+
+    def _numbers(self, content):
+        # Entries are named <title>_<subject>_<number>..., the title has no
+        # underscores
+        return sorted(int(name.split('_')[2].split('.')[0])
+                      for name, _ in _read_zip(content)
+                      if name != 'export_report.txt')
+
+    def _download(self, user=None):
+        response = create_delta_download_response_zip('raw', self.exp,
+                                                      user or self.user)
+        content = b''.join(response.streaming_content)
+        response.close()
+        return self._numbers(content)
+
+    def test_delta(self):
+        # The first time, everything is new
+        self.assertEqual(self._download(), list(range(1, 11)))
+        self.assertEqual(self._download(), [])
+
+        self._add(5)
+        self.assertEqual(self._download(), list(range(11, 16)))
+
+        # Every user has their own cursor
+        other = create_user('other')
+        self.assertEqual(self._download(other), list(range(1, 16)))
+
+    def test_file_stored_late(self):
+        self._download()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+
+        field = DataPoint._meta.get_field('file')
+        store_file = field.pre_save
+        downloads = []
+
+        def _store_slowly(data_point, add):
+            if not downloads:
+                # Another datapoint comes in and is downloaded while the
+                # file is still being stored
+                DataPoint.bulk_create_data(self.exp, ['{"trial": 1}'])
+                downloads.append(self._download())
+            return store_file(data_point, add)
+
+        with self.settings(MEDIA_ROOT=media_root), \
+                patch.object(field, 'pre_save', _store_slowly):
+            DataPoint.objects.create(
+                experiment=self.exp,
+                size=1000,
+                file=ContentFile(b'a' * 1000, name='recording.webm'),
+            )
+
+            # The file only got its number once it was stored, so it is
+            # part of the next download instead of being skipped
+            self.assertEqual(downloads, [[11]])
+            self.assertEqual(self._download(), [12])
+
+    def test_aborted(self):
+        response = create_delta_download_response_zip('raw', self.exp,
+                                                      self.user)
+        next(iter(response.streaming_content))
+        response.close()
+        self.assertFalse(ExportCursor.objects.exists())
+
+        self.assertEqual(self._download(), list(range(1, 11)))
+        cursor = ExportCursor.objects.get(user=self.user, experiment=self.exp)
+        self.assertEqual(cursor.last_number, 10)
+
+    def test_concurrent_first_downloads(self):
+        first = create_delta_download_response_zip('raw', self.exp, self.user)
+        second = create_delta_download_response_zip('raw', self.exp,
+                                                    self.user)
+        for response in (first, second):
+            b''.join(response.streaming_content)
+            response.close()
+
+        cursor = ExportCursor.objects.get(user=self.user, experiment=self.exp)
+        self.assertEqual(cursor.last_number, 10)
+
+    def test_cursor_not_moved_back(self):
+        # Started before the datapoints below were added
+        earlier = create_delta_download_response_zip('raw', self.exp,
+                                                     self.user)
+        self._add(5)
+        self.assertEqual(self._download(), list(range(1, 16)))
+
+        b''.join(earlier.streaming_content)
+        earlier.close()
+        self.assertEqual(self._download(), [])
+
+    def _post_form(self, **data):
+        self.client.force_login(self.user)
+        return self.client.post(
+            reverse('experiments:download', args=[self.exp.pk]),
+            {
+                'file_format': 'raw',
+                'include_status': [Experiment.OPEN, Experiment.PILOTING],
+                'include_groups': [group.pk for group in
+                                   self.exp.targetgroup_set.all()],
+                'since_last_download': 'on',
+                **data
+            }
+        )
+
+    def test_form(self):
+        self._download()
+        self._add(5)
+
+        response = self._post_form()
+        self.assertEqual(
+            self._numbers(b''.join(response.streaming_content)),
+            list(range(11, 16))
+        )
+
+    def test_form_filtered(self):
+        # The cursor would move past what the filter leaves out
+        response = self._post_form(include_status=[Experiment.OPEN])
+        self.assertFalse(response.streaming)
+        self.assertTrue(response.context['form'].has_error('include_status'))
+        self.assertFalse(ExportCursor.objects.exists())
+
+    def test_api(self):
+        self.client.force_login(self.user)
+        url = reverse('experiments:download', args=[self.exp.pk, 'raw'])
+
+        response = self.client.get(url, {'since': 'last'})
+        self.assertEqual(self._numbers(b''.join(response.streaming_content)),
+                         list(range(1, 11)))
+        response = self.client.get(url, {'since': 'last'})
+        self.assertEqual(self._numbers(b''.join(response.streaming_content)),
+                         [])
+
+        response = self.client.get(url, {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class MergedExportTests(TestCase):
+    databases = '__all__'  # required for login because of auditlog
+
+    def setUp(self):
+        self.exp = create_experiment(title='Merged export')
+
+    def _export(self, queryset=None):
+        response = create_download_response_zip('merged', self.exp, queryset)
+        files = dict(_read_zip(b''.join(response.streaming_content)))
+        self.assertEqual(sorted(files),
+                         ['export_report.txt', 'merged-export.csv'])
+        rows = list(csv.reader(StringIO(
+            files['merged-export.csv'].decode('utf-8'))))
+        return rows, files['export_report.txt'].decode('utf-8')
+
+    def test_merged(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        session = self.exp.create_sessions(1)[0]
+        with self.settings(MEDIA_ROOT=media_root):
+            DataPoint.objects.create(
+                experiment=self.exp,
+                session=session,
+                number=self.exp.reserve_datapoint_numbers(1),
+                size=1000,
+                file=ContentFile(b'a' * 1000, name='recording.webm'),
+            )
+            DataPoint.bulk_create_data(self.exp, [
+                '{"c": "x", "number": 5}',
+                'not json',
+            ], session=session)
+            DataPoint.bulk_create_data(self.exp, ['{"b": 4}'])
+
+            rows, report = self._export()
+        group = session.group.name
+        status = str(DataPoint.STATUS_TEST)
+        self.assertEqual(rows, [
+            ['number', 'subject_id', 'group', 'status', 'c', 'data_number', 'b'],
+            ['2', str(session.subject_id), group, status, 'x', '5', ''],
+            ['4', '', '', status, '', '', '4'],
+        ])
+        # The file is left out, and the datapoint that is not JSON fails
+        lines = [line for line in report.splitlines() if line.startswith('-')]
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith('_0003.txt - FAILED'))
+        self.assertNotIn('_0001.txt', report)
+
+    def test_column_names(self):
+        DataPoint.bulk_create_data(self.exp, [
+            '{"status": "done", "data_status": 1, "group": "A", "rt": 300}'
+        ])
+        rows, _ = self._export()
+        self.assertEqual(rows[0], [
+            'number', 'subject_id', 'group', 'status',
+            'data_data_status', 'data_status', 'data_group', 'rt'
+        ])
+        self.assertEqual(rows[1][4:], ['done', '1', 'A', '300'])
+
+    def test_rows(self):
+        DataPoint.bulk_create_data(self.exp, ['[{"a": 1, "b": 2}, {"a": 3}]'])
+        rows, _ = self._export()
+        self.assertEqual(rows[1:], [
+            ['1', '', '', str(DataPoint.STATUS_TEST), '1', '2'],
+            ['1', '', '', str(DataPoint.STATUS_TEST), '3', ''],
+        ])
+
+    def test_queryset(self):
+        create_datapoints(self.exp, 10)
+        rows, _ = self._export(self.exp.datapoint_set.filter(number__gt=5))
+        self.assertEqual(sorted({row[0] for row in rows[1:]}),
+                         ['10', '6', '7', '8', '9'])
+
+    def test_view(self):
+        DataPoint.bulk_create_data(self.exp, ['{"a": 1}'])
+        user = create_user()
+        self.exp.users.add(user)
+        self.client.force_login(user)
+
+        response = self.client.get(
+            reverse('experiments:download', args=[self.exp.pk, 'merged']))
+        files = dict(_read_zip(b''.join(response.streaming_content)))
+        self.assertIn('merged-export.csv', files)
+
+        # A single datapoint has nothing to merge
+        data_point = self.exp.datapoint_set.get()
+        response = self.client.get(reverse(
+            'experiments:download_single',
+            args=[self.exp.pk, data_point.pk, 'merged']
+        ))
+        self.assertEqual(response.status_code, 400)
+
+    @staticmethod
+    def _peak_memory(amount):
+        exp = create_experiment(title='Merged export {}'.format(amount))
+        create_datapoints(exp, amount)
+
+        response = create_download_response_zip('merged', exp)
+        tracemalloc.start()
+        try:
+            for _ in response.streaming_content:
+                pass
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return peak
+
+    def test_memory(self):
+        small = self._peak_memory(1_000)
+        large = self._peak_memory(10_000)
+
+        # Both pass over the rows EXPORT_CHUNK_SIZE at a time, only the
+        # export report grows until it spills to disk
+        self.assertLess(large, small + 2 * 1024 * 1024)
+
 
 class TestDeleteData(TestCase):
     databases = '__all__'  # required for login because of auditlog
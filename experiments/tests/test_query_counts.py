@@ -0,0 +1,492 @@
+"""Query budgets for the views of the api, experiments and administration
+apps.
+
+Every view is measured after growing the data to 10 and 100 datapoints (or
+sessions, or experiments), and should do exactly the same amount of queries
+both times. A view that queries per row fails here.
+
+The TestLarge* variants at the end repeat this at production-like sizes.
+They take several minutes, so they only run with pytest --run-large.
+
+The async API views are not covered: they run the sync views in a thread
+pool, on connections that can't see the data of a test's transaction.
+"""
+import io
+import shutil
+import tempfile
+import zipfile
+
+import pytest
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from api.models import ChunkedUpload
+from ..models import Experiment
+from ..utils import create_download_response_zip
+from .factories import create_datapoints, create_experiment, \
+    create_experiments, create_user
+
+
+class QueryBudgetMixin:
+    sizes = (10, 100)
+
+    def assertConstantQueries(self, grow, request, prepare=None):
+        """Calls grow(amount) to reach every size in sizes, and measures the
+        queries done by request() after each step. These should not change.
+
+        When given, prepare() is called before every request, and the
+        keyword arguments it returns are passed to request(). Its queries
+        are not counted.
+        """
+        counts = []
+        size = 0
+        for target in self.sizes:
+            grow(target - size)
+            size = target
+
+            if not counts:
+                # Fills caches (sessions, content types, the experiment
+                # cache) that would otherwise only be cold for the first size
+                self._count_queries(request, prepare)
+
+            counts.append(self._count_queries(request, prepare))
+
+        self.assertEqual(
+            counts,
+            [counts[0]] * len(counts),
+            'Queries at {} rows: {}'.format(self.sizes, counts)
+        )
+
+    def _count_queries(self, request, prepare) -> int:
+        kwargs = prepare() if prepare else {}
+        with CaptureQueriesContext(connection) as ctx:
+            response = request(**kwargs)
+            # Streaming responses only query while they are consumed
+            if response.streaming:
+                b''.join(response.streaming_content)
+
+        self.assertLess(response.status_code, 400)
+        return len(ctx)
+
+
+class TestExperimentsQueryCounts(QueryBudgetMixin, TestCase):
+    databases = '__all__'  # required for login because of auditlog
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user()
+        cls.exp = create_experiment(
+            users=[cls.user],
+            state=Experiment.OPEN,
+            approved=True
+        )
+        cls.group = cls.exp.targetgroup_set.first()
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        settings_override = override_settings(EXPORT_CACHE_DIR=cache_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _grow_data(self, amount):
+        sessions = self.exp.create_sessions(amount)
+        create_datapoints(self.exp, amount, sessions)
+
+    def _grow_experiments(self, amount):
+        create_experiments(amount, users=[self.user])
+
+    def _get(self, name, *args):
+        url = reverse(name, args=args)
+        return lambda: self.client.get(url)
+
+    def test_home(self):
+        self.assertConstantQueries(self._grow_data,
+                                   self._get('experiments:home'))
+
+    def test_home_experiments(self):
+        self.assertConstantQueries(self._grow_experiments,
+                                   self._get('experiments:home'))
+
+    def test_new(self):
+        self.assertConstantQueries(self._grow_data,
+                                   self._get('experiments:new'))
+
+    def test_edit(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            self._get('experiments:edit', self.exp.pk)
+        )
+
+    def test_detail(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            self._get('experiments:detail', self.exp.pk)
+        )
+
+    def test_delete_experiment(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            self._get('experiments:delete_experiment', self.exp.pk)
+        )
+
+    def _new_datapoint(self):
+        create_datapoints(self.exp, 1, self.exp.create_sessions(1))
+        data_point = self.exp.datapoint_set.latest('number')
+        return {'url': reverse('experiments:delete_datapoint',
+                               args=[self.exp.pk, data_point.pk])}
+
+    def test_delete_datapoint_form(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda url: self.client.get(url),
+            prepare=self._new_datapoint
+        )
+
+    def test_delete_datapoint(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda url: self.client.post(url),
+            prepare=self._new_datapoint
+        )
+
+    def test_delete_all_data(self):
+        # Only the confirmation page, deleting sends signals for every
+        # datapoint to keep the session counters right
+        self.assertConstantQueries(
+            self._grow_data,
+            self._get('experiments:delete_all_data', self.exp.pk)
+        )
+
+    def test_download_form(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            self._get('experiments:download', self.exp.pk)
+        )
+
+    def test_download_form_post(self):
+        url = reverse('experiments:download', args=[self.exp.pk])
+        self.assertConstantQueries(self._grow_data, lambda: self.client.post(url, {
+            'file_format': 'csv',
+            'include_status': [Experiment.OPEN, Experiment.PILOTING],
+            'include_groups': [self.group.pk],
+        }))
+
+    def _new_export_data(self):
+        # So every download appends to the cached export
+        create_datapoints(self.exp, 1, self.exp.create_sessions(1))
+        return {}
+
+    def test_download_csv(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            self._get('experiments:download', self.exp.pk, 'csv'),
+            prepare=self._new_export_data
+        )
+
+    def test_download_raw(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            self._get('experiments:download', self.exp.pk, 'raw'),
+            prepare=self._new_export_data
+        )
+
+    def test_download_merged(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            self._get('experiments:download', self.exp.pk, 'merged')
+        )
+
+    def test_download_cached(self):
+        url = reverse('experiments:download', args=[self.exp.pk, 'csv'])
+
+        def prepare():
+            # Brings the cached export up to date, so it is only sent. A
+            # rebuild happens while it is sent, so it is read completely.
+            response = self.client.get(url)
+            b''.join(response.streaming_content)
+            response.close()
+            return {}
+
+        self.assertConstantQueries(self._grow_data,
+                                   lambda: self.client.get(url),
+                                   prepare=prepare)
+
+    def test_download_delta(self):
+        url = reverse('experiments:download', args=[self.exp.pk, 'csv'])
+
+        def prepare():
+            # Downloads everything, so only the next datapoint is new
+            response = self.client.get(url, {'since': 'last'})
+            b''.join(response.streaming_content)
+            return self._new_export_data()
+
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda: self.client.get(url, {'since': 'last'}),
+            prepare=prepare
+        )
+
+    def test_download_single(self):
+        def prepare():
+            data_point = self.exp.datapoint_set.first()
+            return {'url': reverse('experiments:download_single',
+                                   args=[self.exp.pk, data_point.pk, 'raw'])}
+
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda url: self.client.get(url),
+            prepare=prepare
+        )
+
+
+class TestExportQueryCounts(QueryBudgetMixin, TestCase):
+    """The export reads all datapoints through a single cursor, so it
+    should not even do a query per chunk"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.exp = create_experiment(title='Export: query counts')
+
+    def _grow_data(self, amount):
+        create_datapoints(self.exp, amount, self.exp.create_sessions(amount))
+
+    def test_export(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda: create_download_response_zip('csv', self.exp)
+        )
+
+    def test_export_in_pool(self):
+        with self.settings(EXPORT_WORKERS=2, EXPORT_WORKER_TYPE='thread'):
+            self.assertConstantQueries(
+                self._grow_data,
+                lambda: create_download_response_zip('csv', self.exp)
+            )
+
+    def test_file_names(self):
+        self._grow_data(3)
+        response = create_download_response_zip('raw', self.exp)
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as zip_file:
+            self.assertEqual(zip_file.namelist(), [
+                'export-query-counts_0001_0001.txt',
+                'export-query-counts_0002_0002.txt',
+                'export-query-counts_0003_0003.txt',
+                'export_report.txt',
+            ])
+
+
+class TestAdministrationQueryCounts(QueryBudgetMixin, TestCase):
+    databases = '__all__'  # required for login because of auditlog
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user(is_staff=True, email='staff@example.com')
+        cls.exp = create_experiment(users=[cls.user])
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def _grow_data(self, amount):
+        sessions = self.exp.create_sessions(amount)
+        create_datapoints(self.exp, amount, sessions)
+
+    def _grow_experiments(self, amount):
+        create_experiments(amount, users=[self.user])
+
+    def test_home(self):
+        url = reverse('administration:home')
+        self.assertConstantQueries(self._grow_data,
+                                   lambda: self.client.get(url))
+
+    def test_home_experiments(self):
+        url = reverse('administration:home')
+        self.assertConstantQueries(
+            self._grow_experiments,
+            lambda: self.client.get(url, {'sort': '-last_upload'})
+        )
+
+    def test_approve_form(self):
+        url = reverse('administration:approve', args=[self.exp.pk])
+        self.assertConstantQueries(self._grow_data,
+                                   lambda: self.client.get(url))
+
+    def test_approve(self):
+        url = reverse('administration:approve', args=[self.exp.pk])
+        self.assertConstantQueries(self._grow_data,
+                                   lambda: self.client.post(url))
+
+    def test_switch_ldap_inclusion(self):
+        url = reverse('administration:switch_ldap_inclusion',
+                      args=[self.exp.pk])
+        self.assertConstantQueries(self._grow_data,
+                                   lambda: self.client.get(url))
+
+    def test_ldap(self):
+        url = reverse('administration:ldap')
+        self.assertConstantQueries(self._grow_experiments,
+                                   lambda: self.client.get(url))
+
+
+class TestApiQueryCounts(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.exp = create_experiment(state=Experiment.OPEN, approved=True)
+        # Keeps the group open, however many sessions complete
+        cls.exp.targetgroup_set.update(completion_target=1_000_000)
+
+    def setUp(self):
+        cache.clear()
+
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir)
+        settings_override = override_settings(
+            API_CHUNKED_UPLOAD_DIR=upload_dir + '/chunked',
+            MEDIA_ROOT=upload_dir + '/media',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _grow_data(self, amount):
+        sessions = self.exp.create_sessions(amount)
+        create_datapoints(self.exp, amount, sessions)
+
+    def _new_session(self):
+        return {'participant_id': self.exp.create_session().uuid}
+
+    def _new_upload(self):
+        upload = ChunkedUpload.objects.create(
+            session=self.exp.create_session(),
+            filename='recording.webm'
+        )
+        upload.create_spool()
+        return {'upload_id': upload.uuid}
+
+    def _url(self, name, *args):
+        return reverse(name, args=[self.exp.access_id, *args])
+
+    def test_upload(self):
+        self.assertConstantQueries(self._grow_data, lambda: self.client.post(
+            self._url('api:upload'), '{}', content_type='text/plain'
+        ))
+
+    def test_metadata(self):
+        self.assertConstantQueries(self._grow_data, lambda: self.client.get(
+            self._url('api:metadata')
+        ))
+
+    def test_metadata_field(self):
+        self.assertConstantQueries(self._grow_data, lambda: self.client.get(
+            self._url('api:metadata_field', 'state')
+        ))
+
+    def test_participant(self):
+        self.assertConstantQueries(self._grow_data, lambda: self.client.post(
+            self._url('api:participant')
+        ))
+
+    def test_participant_batch(self):
+        self.assertConstantQueries(self._grow_data, lambda: self.client.post(
+            self._url('api:participant_batch'),
+            {'count': 10},
+            content_type='application/json'
+        ))
+
+    def test_session_upload(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda participant_id: self.client.post(
+                self._url('api:upload', participant_id),
+                '{}',
+                content_type='text/plain'
+            ),
+            prepare=self._new_session
+        )
+
+    def test_batch_upload(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda participant_id: self.client.post(
+                self._url('api:upload_batch', participant_id),
+                '{}\n{}\n',
+                content_type='application/x-ndjson'
+            ),
+            prepare=self._new_session
+        )
+
+    def test_binary_upload(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda participant_id: self.client.post(
+                self._url('api:upload_bin', participant_id),
+                {'file': io.BytesIO(b'A' * 1000)}
+            ),
+            prepare=self._new_session
+        )
+
+    def test_chunked_upload_create(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda participant_id: self.client.post(
+                self._url('api:upload_chunked_create', participant_id),
+                {'filename': 'recording.webm'},
+                content_type='application/json'
+            ),
+            prepare=self._new_session
+        )
+
+    def test_chunked_upload_offset(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda upload_id: self.client.get(
+                self._url('api:upload_chunked', upload_id)
+            ),
+            prepare=self._new_upload
+        )
+
+    def test_chunked_upload(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda upload_id: self.client.patch(
+                self._url('api:upload_chunked', upload_id),
+                b'A' * 1000,
+                content_type='application/offset+octet-stream',
+                HTTP_UPLOAD_OFFSET='0'
+            ),
+            prepare=self._new_upload
+        )
+
+    def test_chunked_upload_finalize(self):
+        self.assertConstantQueries(
+            self._grow_data,
+            lambda upload_id: self.client.post(
+                self._url('api:upload_chunked_finalize', upload_id)
+            ),
+            prepare=self._new_upload
+        )
+
+
+@pytest.mark.large
+class TestLargeExperimentsQueryCounts(TestExperimentsQueryCounts):
+    sizes = (10, 100, 10_000)
+
+
+@pytest.mark.large
+class TestLargeExportQueryCounts(TestExportQueryCounts):
+    # Enough datapoints for the export to read many chunks
+    sizes = (10, 1_000, 100_000)
+
+
+@pytest.mark.large
+class TestLargeAdministrationQueryCounts(TestAdministrationQueryCounts):
+    sizes = (10, 100, 10_000)
+
+
+@pytest.mark.large
+class TestLargeApiQueryCounts(TestApiQueryCounts):
+    sizes = (10, 100, 10_000)
@@ -0,0 +1,143 @@
+import io
+import tracemalloc
+import zipfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from ..utils.zipstream import ZipStream, buffered, deflate
+
+MiB = 1024 * 1024
+
+
+def _zeros(size, chunk=b'\0' * MiB):
+    """size bytes of zeros, reusing a single chunk"""
+    while size > 0:
+        yield chunk[:size]
+        size -= len(chunk)
+
+
+def _archive(entries, **kwargs) -> bytes:
+    zip_stream = ZipStream()
+
+    def generate():
+        for name, data in entries:
+            yield from zip_stream.write_file(name, [data], **kwargs)
+        yield from zip_stream.close()
+
+    return b''.join(buffered(generate()))
+
+
+class TestZipStream(SimpleTestCase):
+
+    def assertValidArchive(self, archive, entries):
+        with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.namelist(),
+                             [name for name, _ in entries])
+            for name, data in entries:
+                self.assertEqual(zip_file.read(name), data)
+
+    def test_archive(self):
+        entries = [
+            ('data.csv', b'trial,rt\n1,300\n' * 1000),
+            ('empty.txt', b''),
+            ('proefpersoon_ë.txt', 'data ë'.encode('utf-8')),
+        ]
+        self.assertValidArchive(_archive(entries), entries)
+
+        zip_stream = ZipStream()
+        archive = b''.join([
+            *zip_stream.write_file('recording.webm', [b'\x1a\x45', b'\xdf'],
+                                   compression=zipfile.ZIP_STORED),
+            *zip_stream.write_str('report.txt', 'SUCCESS'),
+            *zip_stream.close(),
+        ])
+        self.assertValidArchive(archive, [
+            ('recording.webm', b'\x1a\x45\xdf'),
+            ('report.txt', b'SUCCESS'),
+        ])
+
+    def test_compressed(self):
+        data = b'trial,rt\n1,300\n' * 1000
+        crc, compressed = deflate(data)
+        empty_crc, empty_compressed = deflate(b'')
+
+        zip_stream = ZipStream()
+        archive = b''.join([
+            *zip_stream.write_compressed('data.csv', compressed, crc,
+                                         len(data)),
+            *zip_stream.write_compressed('empty.csv', empty_compressed,
+                                         empty_crc, 0),
+            *zip_stream.write_str('report.txt', 'SUCCESS'),
+            *zip_stream.close(),
+        ])
+        self.assertValidArchive(archive, [
+            ('data.csv', data),
+            ('empty.csv', b''),
+            ('report.txt', b'SUCCESS'),
+        ])
+
+    def test_unknown_size(self):
+        entries = [('data.txt', b'A' * 5000)]
+        self.assertValidArchive(_archive(entries, size=None), entries)
+
+    @mock.patch('experiments.utils.zipstream.ZIP64_LIMIT', 1000)
+    @mock.patch('experiments.utils.zipstream.ZIP64_ENTRY_THRESHOLD', 1000)
+    @mock.patch('experiments.utils.zipstream.ZIP_FILECOUNT_LIMIT', 3)
+    def test_zip64(self):
+        # With lowered limits, sizes, offsets and the entry count all need
+        # the ZIP64 extensions
+        entries = [
+            ('entry_{}.bin'.format(i), bytes(range(256)) * (i + 1))
+            for i in range(6)
+        ]
+        archive = _archive(entries, compression=zipfile.ZIP_STORED,
+                           size=None)
+        self.assertValidArchive(archive, entries)
+        self.assertIn(b'PK\x06\x06', archive)
+        self.assertIn(b'PK\x06\x07', archive)
+
+    def _peak_memory(self, entries, binary_size) -> int:
+        """Peak memory while streaming an archive with entries small text
+        entries and binary_size bytes of binary files, in 1 GiB files"""
+        zip_stream = ZipStream()
+
+        def generate():
+            for i in range(entries):
+                yield from zip_stream.write_str(
+                    'entry_{:05}.txt'.format(i),
+                    '[{"trial": 1, "rt": 300}]'
+                )
+            remaining = binary_size
+            while remaining > 0:
+                size = min(remaining, 1024 * MiB)
+                yield from zip_stream.write_file(
+                    'recording_{}.bin'.format(remaining),
+                    _zeros(size),
+                    compression=zipfile.ZIP_STORED,
+                    size=size
+                )
+                remaining -= size
+            yield from zip_stream.close()
+
+        tracemalloc.start()
+        try:
+            total = 0
+            for chunk in buffered(generate()):
+                total += len(chunk)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertGreater(total, binary_size)
+        return peak
+
+    def test_memory(self):
+        small = self._peak_memory(5_000, 100 * MiB)
+        large = self._peak_memory(50_000, 4608 * MiB)
+
+        # Ten times the entries and 45 times the data, but the same memory:
+        # the central directory spills to disk after SPOOL_MAX_SIZE
+        self.assertLess(large, small + 2 * MiB)
+        self.assertLess(large, 8 * MiB)
@@ -1,2 +1,4 @@
-from .download import create_download_response_zip, create_file_response_single
+from .download import create_delta_download_response_zip, \
+    create_download_response_zip, create_file_response_single
+from .export_cache import create_cached_download_response_zip
 from .mails import send_new_experiment_mail
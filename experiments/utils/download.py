@@ -1,15 +1,24 @@
 import csv
 import io
-import zipfile
+import itertools
 import json
+import os
 import re
-from typing import Callable, Optional
+import tempfile
+from concurrent.futures import Executor
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Tuple
+from zipfile import ZIP_DEFLATED, ZIP_STORED
 
+from django.conf import settings
 from django.db.models import QuerySet
 from django.http import FileResponse, HttpResponse, HttpResponseBase
 from django.utils.datastructures import OrderedSet
 
-from experiments.models import DataPoint, Experiment
+from experiments.models import DataPoint, Experiment, ExportCursor
+from main.models import User
+from .export_pool import convert_in_pool, deflate_in_pool, \
+    get_compression_pool, get_export_pool, with_ciphertext
+from .zipstream import SPOOL_MAX_SIZE, ZipStream, buffered
 
 EXPORT_NO_VALUE = ""
 
@@ -26,11 +35,25 @@ Files:
 
 DEFAULT_ZFILL = 4
 
+# Columns of the merged CSV that come before those of the data
+MERGED_COLUMNS = ['number', 'subject_id', 'group', 'status']
+
+# Amount of datapoints fetched from the database at once while exporting
+EXPORT_CHUNK_SIZE = 500
+
+# Size of the blocks in which files are copied into an export
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+def _create_title_slug(experiment: Experiment) -> str:
+    return re.sub(r'\W+', "-", experiment.title.strip().lower())
+
 
 def _create_file_name(
         dp: DataPoint,
         suffix: str = ".txt",
-        zfill: int = DEFAULT_ZFILL
+        zfill: int = DEFAULT_ZFILL,
+        title_slug: Optional[str] = None
         ) -> str:
     """Creates a file name with suffix based on the datapoint
 
@@ -46,16 +69,42 @@ def _create_file_name(
     :param zfill: The amount of zero padding applied to the subject_id and
                   `DataPoint.number`. By default, it accomodates for [0001-9999]
                   alphabetical ordering.
+
+    :param title_slug: The experiment's title as used in the file name. Pass
+                       it when creating many file names, so it is not
+                       computed (and the experiment fetched) for each of them.
     """
-    readable_title = re.sub(r'\W+', "-", dp.experiment.title.strip().lower())
+    if title_slug is None:
+        title_slug = _create_title_slug(dp.experiment)
     return "{}_{}_{}{}".format(
-        readable_title,
+        title_slug,
         str(dp.session.subject_id).zfill(zfill) if dp.session else '',
         str(dp.number).zfill(zfill),
         suffix
     )
 
 
+def get_exporters(
+        file_format: str,
+        experiment: Experiment
+) -> Tuple[Callable[[DataPoint], str], Callable[[str], str]]:
+    """The filename generator and processor of _create_zip for the desired
+    format"""
+    title_slug = _create_title_slug(experiment)
+    if file_format == 'raw':
+        return (
+            lambda dp: _create_file_name(dp, suffix=".txt",
+                                         title_slug=title_slug),
+            # Raw should just return the data of the DataPoint
+            _keep_raw,
+        )
+    return (
+        lambda dp: _create_file_name(dp, suffix='.csv', title_slug=title_slug),
+        # CSV should apply _flatten_json to the data and return the result
+        _flatten_json,
+    )
+
+
 def create_download_response_zip(
         file_format: str,
         experiment: Experiment,
@@ -63,33 +112,61 @@ def create_download_response_zip(
 ) -> FileResponse:
     """Creates a FileResponse containing a ZIP with all data of the provided
     experiment, in the desired format. """
-
-    # Create the zip using the desired methods
-    if file_format == 'raw':
-        zip_file = _create_zip(
-            experiment,
-            lambda dp: _create_file_name(dp, suffix=".txt"),
-            # Raw should just return the data of the DataPoint
-            lambda dp: dp.data,
-            queryset
-        )
+    if file_format == 'merged':
+        zip_file = _create_merged_zip(experiment, queryset)
     else:
+        filename_generator, processor = get_exporters(file_format, experiment)
         zip_file = _create_zip(
             experiment,
-            lambda dp: _create_file_name(dp, suffix='.csv'),
-            # CSV should apply _flatten_json to the data and return the result
-            lambda dp: _flatten_json(dp.data),
-            queryset
+            filename_generator,
+            processor,
+            queryset,
+            get_export_pool(),
+            get_compression_pool()
         )
 
     response = FileResponse(
-        zip_file,
+        buffered(zip_file),
         content_type='application/zip',
         )
     response['Content-Disposition'] = 'attachment; filename="{}-{}.zip"'.format(experiment.title, file_format)
     return response
 
 
+def create_delta_download_response_zip(
+        file_format: str,
+        experiment: Experiment,
+        user: User
+) -> FileResponse:
+    """Like create_download_response_zip, but only with the datapoints added
+    since the user last downloaded new data, see ExportCursor. The cursor
+    moves once the whole ZIP was sent.
+
+    This always includes all new data: the cursor moves past anything a
+    filter would leave out, which would then never be downloaded."""
+    cursor = ExportCursor.get_for(user, experiment)
+    last = cursor.get_last()
+
+    response = create_download_response_zip(
+        file_format,
+        experiment,
+        cursor.filter_new(experiment.datapoint_set.all(), last)
+    )
+    response.streaming_content = _on_completion(
+        response.streaming_content,
+        lambda: cursor.advance(last)
+    )
+    response['Content-Disposition'] = 'attachment; filename="{}-{}-new.zip"'.format(experiment.title, file_format)
+    return response
+
+
+def _on_completion(chunks: Iterable[bytes], callback: Callable[[], None]):
+    """Calls callback after the last chunk, but not when the response is
+    closed before that"""
+    yield from chunks
+    callback()
+
+
 def create_file_response_single(file_format: str, data_point: DataPoint) -> HttpResponseBase:
     """Creates a HttpResponse containing a the data of the provided
     DataPoint, in the desired format. """
@@ -128,64 +205,297 @@ def create_file_response_single(file_format: str, data_point: DataPoint) -> Http
     return response
 
 
-class StreamingIO:
-    def __init__(self):
-        self.buffer = io.BytesIO()
+def _keep_raw(data: str) -> str:
+    return data
 
-    def write(self, data):
-        return self.buffer.write(data)
 
-    def flush(self):
-        return self.buffer.flush()
+def _convert(
+        data_points: Iterable[DataPoint],
+        processor: Callable[[str], str]
+) -> Iterator[Tuple[DataPoint, Optional[bytes]]]:
+    """Yields every datapoint with its converted data, or None for files and
+    data that could not be converted. Like export_pool.convert_in_pool, but
+    in the current thread."""
+    for data_point in data_points:
+        data = None
+        if not data_point.is_file():
+            try:
+                data = processor(data_point.data).encode('utf-8')
+            except Exception:
+                pass
+        yield data_point, data
 
-    def reset(self):
-        del self.buffer
-        self.buffer = io.BytesIO()
 
-    def getvalue(self):
-        return self.buffer.getvalue()
+def _get_file_compression(name: str) -> int:
+    """Files in a compressed format are stored as they are, compressing them
+    again costs a lot of time for hardly any gain"""
+    extension = os.path.splitext(name)[1].lstrip('.').lower()
+    if extension in settings.EXPORT_STORED_EXTENSIONS:
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def _read_file(file, failures: list):
+    """Yields the contents of an opened file in chunks, and closes it.
+
+    By the time a read fails, part of the file has already been sent. The
+    entry is ended early then, and the error is appended to failures.
+    """
+    try:
+        with file:
+            yield from file.chunks(FILE_CHUNK_SIZE)
+    except Exception as e:
+        failures.append(e)
 
 
 def _create_zip(
         experiment: Experiment,
         filename_generator: Callable[[DataPoint], str],
-        processor: Callable[[DataPoint], str],
-        queryset: Optional[QuerySet] = None
-) -> io.BytesIO:
-    """Creates a ZIP in a BytesIO buffer.
+        processor: Callable[[str], str],
+        queryset: Optional[QuerySet] = None,
+        pool: Optional[Executor] = None,
+        compression_pool: Optional[Executor] = None
+) -> Iterator[bytes]:
+    """Creates a ZIP, as a stream of chunks.
 
     :param experiment: The experiment containing the requested data
     :param filename_generator: a callable that provides a filename when given a
     datapoint object
     :param processor: a callable that produces the data in the intended
-    format when given a datapoint object
+    format when given the data of a datapoint. When using a process pool, it
+    should be a module level function, so the workers can import it.
+    :param queryset: the datapoints to include, all datapoints of the
+    experiment by default
+    :param pool: the pool to convert the data in, see export_pool
+    :param compression_pool: the thread pool to compress the converted data
+    in, see export_pool
+
+    Files are copied into the ZIP in chunks, and the export report is kept
+    in a temporary file, so the memory use does not depend on the amount or
+    size of the datapoints.
     """
-    buffer = StreamingIO()
-
-    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, True) as zip_file:
-        export_report = EXPORT_REPORT_HEADER
+    zip_file = ZipStream()
 
+    with tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE) as export_report:
         if queryset is None:
-            queryset = experiment.datapoint_set.all().defer('data')
+            queryset = experiment.datapoint_set.order_by('number')
 
-        for data_point in queryset:
-            filename = filename_generator(data_point)
-            try:
-                if data_point.is_file():
-                    filename = _create_file_name(data_point, suffix='_' + data_point.file.name)
-                    data = data_point.file.read()
-                else:
-                    data = processor(data_point)
-                zip_file.writestr(filename, data)
-                export_report += "-{} - SUCCESS\n".format(filename)
-            except Exception as e:
-                export_report += "-{} - FAILED\n".format(filename)
-
-            yield buffer.getvalue()
-            buffer.reset()
-        zip_file.writestr("export_report.txt", export_report)
-
-    yield buffer.getvalue()
+        yield from write_entries(zip_file, experiment, queryset,
+                                 filename_generator, processor,
+                                 export_report, pool, compression_pool)
+        yield from write_export_report(zip_file, export_report)
+
+    yield from zip_file.close()
+
+
+def write_entries(
+        zip_file: ZipStream,
+        experiment: Experiment,
+        queryset: QuerySet,
+        filename_generator: Callable[[DataPoint], str],
+        processor: Callable[[str], str],
+        export_report: BinaryIO,
+        pool: Optional[Executor] = None,
+        compression_pool: Optional[Executor] = None
+) -> Iterator[bytes]:
+    """Writes an entry for every datapoint in the queryset, and a line for
+    each of them in export_report. See _create_zip for the parameters.
+
+    The datapoints are read through a single cursor (server-side, where the
+    database supports it), EXPORT_CHUNK_SIZE rows at a time. Their data and
+    session are part of those rows, so the amount of queries does not depend
+    on the amount of datapoints.
+    """
+    title_slug = _create_title_slug(experiment)
+    queryset = queryset.select_related('session')
+
+    if pool:
+        converted = convert_in_pool(
+            pool,
+            with_ciphertext(queryset).iterator(chunk_size=EXPORT_CHUNK_SIZE),
+            processor
+        )
+    else:
+        converted = _convert(
+            queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE),
+            processor
+        )
+
+    if compression_pool:
+        entries = deflate_in_pool(compression_pool, converted)
+    else:
+        entries = ((data_point, data, None)
+                   for data_point, data in converted)
+
+    for data_point, data, deflated in entries:
+        filename = filename_generator(data_point)
+        failures = []
+        compression = ZIP_DEFLATED
+        try:
+            if data_point.is_file():
+                filename = _create_file_name(
+                    data_point,
+                    suffix='_' + data_point.file.name,
+                    title_slug=title_slug
+                )
+                compression = _get_file_compression(data_point.file.name)
+                data_point.file.open('rb')
+                chunks = _read_file(data_point.file, failures)
+                size = data_point.size
+            elif data is None:
+                raise ValueError('Could not convert the data')
+            else:
+                chunks = [data]
+                size = len(data)
+        except Exception as e:
+            failures.append(e)
+        else:
+            if deflated:
+                crc, compressed = deflated
+                yield from zip_file.write_compressed(filename, compressed,
+                                                     crc, size)
+            else:
+                yield from zip_file.write_file(filename, chunks,
+                                               compression, size)
+
+        export_report.write("-{} - {}\n".format(
+            filename,
+            "FAILED" if failures else "SUCCESS"
+        ).encode('utf-8'))
+
+
+def write_export_report(zip_file: ZipStream,
+                        export_report: BinaryIO) -> Iterator[bytes]:
+    """Writes the export report, of which export_report holds the lines"""
+    header = EXPORT_REPORT_HEADER.encode('utf-8')
+    size = export_report.seek(0, io.SEEK_END)
+    export_report.seek(0)
+    yield from zip_file.write_file(
+        "export_report.txt",
+        itertools.chain(
+            [header],
+            iter(lambda: export_report.read(FILE_CHUNK_SIZE), b'')
+        ),
+        size=len(header) + size
+    )
+
+
+def _create_merged_zip(
+        experiment: Experiment,
+        queryset: Optional[QuerySet] = None
+) -> Iterator[bytes]:
+    """Creates a ZIP with a single CSV of all JSON datapoints, in long
+    format, and the export report. See _create_zip for the parameters.
+
+    Files are left out, these are only part of the other formats.
+    """
+    zip_file = ZipStream()
+    if queryset is None:
+        queryset = experiment.datapoint_set.all()
+    queryset = queryset.filter(data__isnull=False).order_by('number')
+
+    with tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE) as export_report:
+        yield from zip_file.write_file(
+            "{}.csv".format(_create_title_slug(experiment)),
+            _merge_json(experiment, queryset, export_report)
+        )
+        yield from write_export_report(zip_file, export_report)
+
+    yield from zip_file.close()
+
+
+def _merge_json(
+        experiment: Experiment,
+        queryset: QuerySet,
+        export_report: BinaryIO
+) -> Iterator[bytes]:
+    """Yields the merged CSV of the datapoints in the queryset, in chunks,
+    and writes a line for each datapoint in export_report.
+
+    Every row starts with the number, subject_id, group and status of its
+    datapoint, followed by the union of the columns of all datapoints, see
+    _get_merged_header(). The
+    datapoints are scanned twice through a single cursor: once to find that
+    union, and once to write the rows. Only the columns are kept in memory,
+    so the memory use does not depend on the amount of datapoints.
+    """
+    title_slug = _create_title_slug(experiment)
+
+    # Ordered set, so columns are in the order they were first seen
+    columns = OrderedSet()
+    for data in queryset.values_list('data', flat=True) \
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        try:
+            for row in _parse_json_rows(data):
+                columns.update(row.keys())
+        except Exception:
+            # Reported while writing the rows
+            pass
+    columns = list(columns)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(_get_merged_header(columns))
+    yield buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+
+    for data_point in queryset.select_related('session__group') \
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        failed = False
+        try:
+            rows = _parse_json_rows(data_point.data)
+        except Exception:
+            failed = True
+        else:
+            session = data_point.session
+            prefix = [
+                data_point.number,
+                session.subject_id if session else EXPORT_NO_VALUE,
+                session.group.name if session else EXPORT_NO_VALUE,
+                data_point.get_status_display(),
+            ]
+            writer.writerows(
+                prefix + [row.get(column, EXPORT_NO_VALUE)
+                          for column in columns]
+                for row in rows
+            )
+
+        export_report.write("-{} - {}\n".format(
+            _create_file_name(data_point, title_slug=title_slug),
+            "FAILED" if failed else "SUCCESS"
+        ).encode('utf-8'))
+
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+
+def _get_merged_header(columns: list) -> list:
+    """MERGED_COLUMNS followed by the columns of the data. Data columns named
+    like one of MERGED_COLUMNS are prefixed with data_, so every column has
+    a unique name."""
+    header = list(MERGED_COLUMNS)
+    taken = set(MERGED_COLUMNS) | set(columns)
+    for column in columns:
+        if column in MERGED_COLUMNS:
+            while column in taken:
+                column = 'data_' + column
+            taken.add(column)
+        header.append(column)
+    return header
+
+
+def _parse_json_rows(data: str) -> list:
+    """The rows of a JSON *string*, for which _flatten_json would write a
+    line each"""
+    json_data = json.loads(data)
+    if not isinstance(json_data, list):
+        json_data = [json_data]
+    if not all(isinstance(el, dict) for el in json_data):
+        raise ValueError('Expected an object or a list of objects')
+    return json_data
 
 
 def _flatten_json(data: str) -> str:
@@ -0,0 +1,293 @@
+"""Keeps an export of every experiment on disk, per format, and sends that
+when all data is downloaded.
+
+Researchers tend to download all data of a running experiment again and
+again. Instead of exporting everything from scratch every time, the archive
+of the previous download is brought up to date by appending the datapoints
+added since. It is then sent as a plain file.
+
+An archive ends with the export report and the central directory. To append
+to it, it is truncated at the start of the report, and the new entries are
+written, followed by a new report and central directory. For this, the
+following files are kept in EXPORT_CACHE_DIR/<experiment>/, next to
+<format>.zip:
+- <format>.directory, the central directory records of the entries
+- <format>.report, the lines of the export report
+- <format>.json, the state: the last datapoint in the archive, and where
+  every file ends. Without it, the archive is rebuilt.
+
+The archive is locked with flock: exclusively while it is updated, shared
+while it is sent. A download that can't get the lock right away is exported
+on the fly instead of waiting. Appending happens before the download starts,
+but rebuilding an archive takes as long as exporting it, so a rebuilt
+archive is sent while it is written instead.
+
+Deleting datapoints removes the state, so the next download rebuilds the
+archive. The amount of datapoints is also part of the state, as a safety
+net.
+
+The archives hold the data decrypted, so this is disabled unless
+settings.EXPORT_CACHE_DIR is set.
+"""
+import fcntl
+import itertools
+import json
+import os
+import shutil
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Count, Max, QuerySet
+from django.http import FileResponse
+
+from experiments.models import Experiment
+from .download import create_download_response_zip, get_exporters, \
+    write_entries, write_export_report
+from .export_pool import get_compression_pool, get_export_pool
+from .zipstream import ZipStream, buffered
+
+FORMATS = ('raw', 'csv')
+
+EMPTY_STATE = {
+    'last_number': 0,
+    'count': 0,
+    'entries': 0,
+    'report_offset': 0,
+    'directory_size': 0,
+    'report_size': 0,
+    'size': 0,
+}
+
+
+def get_cache_dir(experiment_id: int) -> str:
+    return os.path.join(settings.EXPORT_CACHE_DIR, str(experiment_id))
+
+
+def _path(experiment_id: int, file_format: str, extension: str) -> str:
+    return os.path.join(get_cache_dir(experiment_id),
+                        '{}.{}'.format(file_format, extension))
+
+
+def invalidate(experiment_id: int) -> None:
+    """Makes the next download rebuild the archives of the experiment"""
+    if not settings.EXPORT_CACHE_DIR:
+        return
+    for file_format in FORMATS:
+        try:
+            os.remove(_path(experiment_id, file_format, 'json'))
+        except FileNotFoundError:
+            pass
+
+
+def remove(experiment_id: int) -> None:
+    """Removes the archives of the experiment. Downloads in progress are
+    not affected."""
+    if settings.EXPORT_CACHE_DIR:
+        shutil.rmtree(get_cache_dir(experiment_id), ignore_errors=True)
+
+
+def _read_state(experiment_id: int, file_format: str) -> Optional[dict]:
+    try:
+        with open(_path(experiment_id, file_format, 'json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_state(experiment_id: int, file_format: str, state: dict) -> None:
+    path = _path(experiment_id, file_format, 'json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def _get_current_state(experiment: Experiment) -> dict:
+    return {
+        'title': experiment.title,
+        **experiment.datapoint_set.aggregate(
+            last_number=Max('number'),
+            count=Count('pk'),
+        ),
+    }
+
+
+def _is_up_to_date(state: Optional[dict], current: dict,
+                   archive: BinaryIO) -> bool:
+    return state is not None and \
+        state['title'] == current['title'] and \
+        state['last_number'] == (current['last_number'] or 0) and \
+        state['count'] == current['count'] and \
+        state['size'] == os.fstat(archive.fileno()).st_size
+
+
+def _plan_update(experiment: Experiment, file_format: str, archive: BinaryIO,
+                 current: dict) -> Optional[Tuple[bool, dict, QuerySet]]:
+    """Whether the archive has to be rebuilt, the state to continue it from
+    and the datapoints to append to it, or None when it is up to date"""
+    state = _read_state(experiment.pk, file_format)
+    if _is_up_to_date(state, current, archive):
+        return None
+
+    last_number = current['last_number'] or 0
+    if state is not None and \
+            state['title'] == current['title'] and \
+            state['size'] == os.fstat(archive.fileno()).st_size:
+        data_points = experiment.datapoint_set.filter(
+            number__gt=state['last_number'],
+            number__lte=last_number
+        )
+        # Unless datapoints were deleted
+        if state['count'] + data_points.count() == current['count']:
+            return False, state, data_points
+
+    return True, EMPTY_STATE, experiment.datapoint_set.filter(
+        number__lte=last_number)
+
+
+def _write_update(experiment: Experiment, file_format: str, archive: BinaryIO,
+                  current: dict, state: dict,
+                  data_points: QuerySet) -> Iterator[bytes]:
+    """Appends the datapoints to the archive, which is cut off after the
+    entries of the given state. Yields the chunks as they are written. The
+    archive should be locked exclusively."""
+    # An update that is interrupted leaves no state, so the next one
+    # rebuilds the archive
+    try:
+        os.remove(_path(experiment.pk, file_format, 'json'))
+    except FileNotFoundError:
+        pass
+
+    with open(_path(experiment.pk, file_format, 'directory'), 'a+b') \
+            as directory, \
+            open(_path(experiment.pk, file_format, 'report'), 'a+b') as report:
+        directory.truncate(state['directory_size'])
+        report.truncate(state['report_size'])
+        archive.truncate(state['report_offset'])
+        archive.seek(state['report_offset'])
+
+        zip_file = ZipStream(offset=state['report_offset'],
+                             count=state['entries'],
+                             central_directory=directory)
+        filename_generator, processor = get_exporters(file_format, experiment)
+        for chunk in buffered(write_entries(
+            zip_file, experiment, data_points.order_by('number'),
+            filename_generator, processor, report,
+            get_export_pool(), get_compression_pool()
+        )):
+            archive.write(chunk)
+            yield chunk
+
+        directory.flush()
+        report.flush()
+        state = {
+            'title': current['title'],
+            'last_number': current['last_number'] or 0,
+            'count': current['count'],
+            'entries': zip_file.count,
+            'report_offset': zip_file.offset,
+            'directory_size': os.fstat(directory.fileno()).st_size,
+            'report_size': os.fstat(report.fileno()).st_size,
+        }
+
+        for chunk in buffered(itertools.chain(
+            write_export_report(zip_file, report),
+            zip_file.close()
+        )):
+            archive.write(chunk)
+            yield chunk
+
+    archive.flush()
+    os.fsync(archive.fileno())
+    state['size'] = archive.tell()
+    _write_state(experiment.pk, file_format, state)
+
+
+def _rebuild(experiment: Experiment, file_format: str, archive: BinaryIO,
+             current: dict, data_points: QuerySet) -> Iterator[bytes]:
+    """Rebuilds the archive, yielding it while it is written, and closes
+    it"""
+    try:
+        yield from _write_update(experiment, file_format, archive, current,
+                                 EMPTY_STATE, data_points)
+    finally:
+        archive.close()
+
+
+def open_archive(
+        experiment: Experiment,
+        file_format: str
+) -> Tuple[Optional[BinaryIO], Optional[Iterator[bytes]]]:
+    """Opens the up to date archive of the experiment in the given format,
+    appending new datapoints to it first. The archive stays locked until the
+    file is closed.
+
+    Rebuilding a large archive takes as long as exporting it, so it is not
+    done up front. Instead, the chunks of the rebuilt archive are returned,
+    and the archive is written while they are sent. It stays locked until
+    they are all sent, or the generator is closed. In the latter case, it is
+    rebuilt again the next time.
+
+    Returns (archive, None), (None, chunks), or (None, None) when the cache
+    is disabled or another process is using the archive.
+    """
+    if not settings.EXPORT_CACHE_DIR or file_format not in FORMATS:
+        return None, None
+
+    os.makedirs(get_cache_dir(experiment.pk), exist_ok=True)
+    path = _path(experiment.pk, file_format, 'zip')
+    archive = open(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+    try:
+        current = _get_current_state(experiment)
+        try:
+            fcntl.flock(archive, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Possibly only others sending it, which is fine when it is
+            # up to date
+            fcntl.flock(archive, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        else:
+            update = _plan_update(experiment, file_format, archive, current)
+            if update is not None:
+                rebuild, state, data_points = update
+                if rebuild:
+                    return None, _rebuild(experiment, file_format, archive,
+                                          current, data_points)
+                for _ in _write_update(experiment, file_format, archive,
+                                       current, state, data_points):
+                    pass
+            # Not atomic, so another process may update it in between. It
+            # is then checked below, like when we didn't update it.
+            fcntl.flock(archive, fcntl.LOCK_SH)
+
+        if not _is_up_to_date(_read_state(experiment.pk, file_format),
+                              current, archive):
+            archive.close()
+            return None, None
+    except BlockingIOError:
+        archive.close()
+        return None, None
+    except Exception:
+        archive.close()
+        raise
+
+    archive.seek(0)
+    return archive, None
+
+
+def create_cached_download_response_zip(
+        file_format: str,
+        experiment: Experiment
+) -> FileResponse:
+    """Like create_download_response_zip, for all data of the experiment,
+    but sends the cached archive when possible. Its size is known, so the
+    response has a Content-Length, unless the archive is rebuilt while it is
+    sent."""
+    archive, chunks = open_archive(experiment, file_format)
+    if archive is None and chunks is None:
+        return create_download_response_zip(file_format, experiment)
+
+    response = FileResponse(
+        archive if archive is not None else chunks,
+        content_type='application/zip',
+    )
+    response['Content-Disposition'] = 'attachment; filename="{}-{}.zip"'.format(experiment.title, file_format)
+    return response
@@ -0,0 +1,213 @@
+"""Decrypts and converts the datapoints of an export in a pool of workers.
+
+Decrypting a datapoint, parsing its JSON and writing it as CSV all hold the
+GIL for most of the time they take, so a large export keeps a single core
+busy. With settings.EXPORT_WORKERS set, the export instead reads the
+ciphertext straight from the database and sends the datapoints in chunks to a
+pool of processes (or threads), which do the decryption and conversion. The
+results are put back in the order of the datapoints, so the archive is the
+same as one created without a pool.
+
+Process pools are started with 'spawn': forking a web server process would
+share its database connections and locks with the workers. The workers don't
+use the database themselves.
+
+Compressing the entries of the ZIP is another large part of an export. zlib
+releases the GIL, so with settings.EXPORT_COMPRESSION_THREADS set, the
+converted datapoints are compressed in a pool of threads, again in order.
+"""
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import django
+from django.conf import settings
+from django.db import connection
+from django.db.models import ExpressionWrapper, F, QuerySet, TextField
+
+from experiments.models import DataPoint
+from .zipstream import deflate
+
+# Amount of datapoints sent to a worker at once
+WORKER_CHUNK_SIZE = 50
+
+# Chunks in progress per worker. Bounds the memory use when the ZIP is
+# consumed slower than the workers convert the datapoints.
+CHUNKS_PER_WORKER = 2
+
+# Datapoints in progress per compression thread
+ENTRIES_PER_THREAD = 4
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_export_pool(workers: Optional[int] = None,
+                    worker_type: Optional[str] = None) -> Optional[Executor]:
+    """The pool used for exports, or None when exports should not use one.
+
+    :param workers: the amount of workers, settings.EXPORT_WORKERS by default
+    :param worker_type: 'process' or 'thread', settings.EXPORT_WORKER_TYPE by
+                        default
+    """
+    if workers is None:
+        workers = settings.EXPORT_WORKERS
+    if worker_type is None:
+        worker_type = settings.EXPORT_WORKER_TYPE
+    if not workers:
+        return None
+
+    with _pools_lock:
+        key = (worker_type, workers)
+        if key not in _pools:
+            if worker_type == 'process':
+                _pools[key] = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=django.setup,
+                )
+            elif worker_type == 'thread':
+                _pools[key] = ThreadPoolExecutor(
+                    max_workers=workers,
+                    thread_name_prefix='export',
+                )
+            else:
+                raise ValueError(
+                    'Unknown export worker type {!r}'.format(worker_type))
+        return _pools[key]
+
+
+def get_compression_pool(threads: Optional[int] = None) \
+        -> Optional[Executor]:
+    """The thread pool used to compress exports, or None when exports should
+    compress in the thread serving the download.
+
+    :param threads: the amount of threads,
+                    settings.EXPORT_COMPRESSION_THREADS by default
+    """
+    if threads is None:
+        threads = settings.EXPORT_COMPRESSION_THREADS
+    if not threads:
+        return None
+
+    with _pools_lock:
+        key = ('compression', threads)
+        if key not in _pools:
+            _pools[key] = ThreadPoolExecutor(
+                max_workers=threads,
+                thread_name_prefix='export-compression',
+            )
+        return _pools[key]
+
+
+def with_ciphertext(queryset: QuerySet) -> QuerySet:
+    """Loads the data of the datapoints as ciphertext (in a ciphertext
+    attribute), leaving the decryption to decrypt()"""
+    return queryset.defer('data').annotate(ciphertext=ExpressionWrapper(
+        F('data'), output_field=TextField()
+    ))
+
+
+def decrypt(ciphertext: Optional[str]) -> Optional[str]:
+    """Decrypts the data of a datapoint, like loading it from the database
+    would"""
+    field = DataPoint._meta.get_field('data')
+    value = ciphertext
+    for converter in field.get_db_converters(connection):
+        value = converter(value, None, connection)
+    return value
+
+
+def _convert_chunk(processor: Callable[[str], str],
+                   ciphertexts: List[str]) -> List[Optional[bytes]]:
+    """Runs in the workers. Returns None for the datapoints that could not
+    be converted, as not every exception can be sent back from a process."""
+    results = []
+    for ciphertext in ciphertexts:
+        try:
+            results.append(processor(decrypt(ciphertext)).encode('utf-8'))
+        except Exception:
+            results.append(None)
+    return results
+
+
+def _to_chunks(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def convert_in_pool(
+        pool: Executor,
+        data_points: Iterable[DataPoint],
+        processor: Callable[[str], str],
+) -> Iterator[Tuple[DataPoint, Optional[bytes]]]:
+    """Converts the data of every datapoint in the pool, and yields every
+    datapoint with its converted data in the original order.
+
+    The datapoints should come from a queryset passed through
+    with_ciphertext(). Files are passed through without data, and data that
+    could not be converted is None.
+    """
+    pending = deque()
+    # Both ThreadPoolExecutor and ProcessPoolExecutor keep their size here
+    max_pending = pool._max_workers * CHUNKS_PER_WORKER
+
+    def finish(chunk, future):
+        results = iter(future.result())
+        for data_point in chunk:
+            if data_point.is_file():
+                yield data_point, None
+            else:
+                yield data_point, next(results)
+
+    try:
+        for chunk in _to_chunks(data_points, WORKER_CHUNK_SIZE):
+            ciphertexts = [data_point.ciphertext for data_point in chunk
+                           if not data_point.is_file()]
+            pending.append(
+                (chunk, pool.submit(_convert_chunk, processor, ciphertexts))
+            )
+            if len(pending) >= max_pending:
+                yield from finish(*pending.popleft())
+
+        while pending:
+            yield from finish(*pending.popleft())
+    finally:
+        # When the download is aborted, don't convert what is left
+        for _, future in pending:
+            future.cancel()
+
+
+def deflate_in_pool(
+        pool: Executor,
+        converted: Iterable[Tuple[DataPoint, Optional[bytes]]],
+) -> Iterator[Tuple[DataPoint, Optional[bytes], Optional[Tuple[int, bytes]]]]:
+    """Deflates the converted data of the datapoints in the pool, and yields
+    every datapoint with its data and the result of zipstream.deflate(), in
+    the original order. Datapoints without data get None."""
+    pending = deque()
+    max_pending = pool._max_workers * ENTRIES_PER_THREAD
+
+    def finish(data_point, data, future):
+        return data_point, data, future.result() if future else None
+
+    try:
+        for data_point, data in converted:
+            future = None
+            if data is not None:
+                future = pool.submit(deflate, data)
+            pending.append((data_point, data, future))
+            if len(pending) >= max_pending:
+                yield finish(*pending.popleft())
+
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        for _, _, future in pending:
+            if future:
+                future.cancel()
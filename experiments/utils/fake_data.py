@@ -0,0 +1,181 @@
+"""Generates experiments with realistic data in bulk, for benchmarks and
+tests.
+
+All random choices come from a single Random seeded by the caller, so the
+same seed and parameters give the same groups, sessions and payloads. Only
+the things the database hands out itself (primary keys, access ids, uuids
+and dates) differ between runs.
+"""
+import json
+import math
+import random
+from collections import Counter
+from typing import List, Optional
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from experiments.models import DataPoint, Experiment, ParticipantSession, \
+    TargetGroup
+
+# Columns a trial can have, besides the trial number. Every call to
+# create_datapoints uses its own selection, like different experiments would.
+TRIAL_COLUMNS = {
+    'block': lambda rand, i: i // 20 + 1,
+    'condition': lambda rand, i: rand.choice(['congruent', 'incongruent',
+                                              'neutral']),
+    'stimulus': lambda rand, i: rand.choice(['left', 'right', 'up', 'down']),
+    'response': lambda rand, i: rand.choice(['f', 'j', None]),
+    'correct': lambda rand, i: rand.random() < 0.9,
+    'rt': lambda rand, i: round(rand.lognormvariate(6.3, 0.4), 1),
+    'time_elapsed': lambda rand, i: i * 1500 + rand.randint(0, 1000),
+    'word': lambda rand, i: ''.join(rand.choices('abcdefghijklmnopqrstuvwxyz',
+                                                 k=rand.randint(3, 10))),
+}
+
+
+class FakeDataGenerator:
+    """Creates groups, sessions and datapoints with bulk_create.
+
+    :param seed: seed for all random choices
+    :param trials: average amount of trials in a text payload. The amounts
+                   follow a log-normal distribution, so some payloads are
+                   much larger than average.
+    :param binary_fraction: fraction of the datapoints that is a binary
+                            file instead of a text payload
+    :param binary_size: average size of a binary file, in bytes
+    :param completed_fraction: fraction of the sessions that is completed
+    :param batch_size: amount of rows per insert
+    """
+
+    def __init__(self, seed=0, trials=50, binary_fraction=0.0,
+                 binary_size=100 * 1024, completed_fraction=0.9,
+                 batch_size=5000):
+        self.random = random.Random(seed)
+        self.trials = trials
+        self.binary_fraction = binary_fraction
+        self.binary_size = binary_size
+        self.completed_fraction = completed_fraction
+        self.batch_size = batch_size
+
+    def _lognormal(self, mean, sigma=0.5) -> int:
+        # mu is chosen so the distribution has the given mean
+        return max(1, int(self.random.lognormvariate(
+            math.log(mean) - sigma ** 2 / 2, sigma
+        )))
+
+    def create_experiment(self, title, groups=1, users=(),
+                          **fields) -> Experiment:
+        """Creates an approved experiment with the given amount of target
+        groups"""
+        fields.setdefault('state', Experiment.OPEN)
+        fields.setdefault('approved', True)
+        experiment = Experiment.objects.create(title=title, **fields)
+        experiment.users.add(*users)
+
+        # Replaces the default group
+        experiment.targetgroup_set.all().delete()
+        TargetGroup.objects.bulk_create([
+            TargetGroup(
+                experiment=experiment,
+                name='Group {}'.format(i + 1),
+                completion_target=self.random.choice([50, 100, 500, 1000]),
+            )
+            for i in range(groups)
+        ])
+        return experiment
+
+    def create_sessions(self, experiment: Experiment, amount) -> List[int]:
+        """Creates amount sessions spread randomly over the experiment's
+        groups, and returns their primary keys in subject id order"""
+        groups = list(experiment.targetgroup_set.order_by('pk')
+                      .values_list('pk', flat=True))
+        if not groups:
+            raise ValueError('Experiment has no target groups')
+
+        with transaction.atomic():
+            first_subject_id = experiment.reserve_subject_ids(amount)
+            started = Counter()
+            completed = Counter()
+            for start in range(0, amount, self.batch_size):
+                sessions = []
+                for i in range(start, min(start + self.batch_size, amount)):
+                    group = self.random.choice(groups)
+                    is_completed = self.random.random() < \
+                        self.completed_fraction
+                    started[group] += 1
+                    completed[group] += is_completed
+                    sessions.append(ParticipantSession(
+                        experiment=experiment,
+                        group_id=group,
+                        state=ParticipantSession.COMPLETED if is_completed
+                        else ParticipantSession.STARTED,
+                        experiment_state=experiment.state,
+                        subject_id=first_subject_id + i,
+                    ))
+                ParticipantSession.objects.bulk_create(sessions)
+
+            # Normally done by the signals of every session
+            for group in groups:
+                TargetGroup.update_counters(group, experiment.state,
+                                            started=started[group],
+                                            completed=completed[group])
+
+        # Not every database returns the primary keys from bulk_create
+        return list(
+            experiment.participantsession_set
+            .filter(subject_id__gte=first_subject_id,
+                    subject_id__lt=first_subject_id + amount)
+            .order_by('subject_id')
+            .values_list('pk', flat=True)
+        )
+
+    def create_datapoints(self, experiment: Experiment, amount,
+                          session_ids: Optional[List[int]] = None) -> None:
+        """Creates amount datapoints with pre-allocated numbers. When
+        session ids are given, the datapoints are divided over those
+        sessions in order."""
+        columns = ['trial'] + sorted(self.random.sample(
+            sorted(TRIAL_COLUMNS), self.random.randint(2, len(TRIAL_COLUMNS))
+        ))
+
+        with transaction.atomic():
+            first_number = experiment.reserve_datapoint_numbers(amount)
+            for start in range(0, amount, self.batch_size):
+                data_points = []
+                for i in range(start, min(start + self.batch_size, amount)):
+                    session_id = None
+                    if session_ids:
+                        session_id = session_ids[i * len(session_ids) // amount]
+                    data_point = DataPoint(
+                        experiment=experiment,
+                        session_id=session_id,
+                        number=first_number + i,
+                    )
+
+                    if self.random.random() < self.binary_fraction:
+                        data = self.random.randbytes(
+                            self._lognormal(self.binary_size))
+                        # Random bytes, as incompressible as a recording.
+                        # Stored by the field when the datapoint is inserted.
+                        data_point.file = ContentFile(
+                            data,
+                            name='{}.webm'.format(data_point.number)
+                        )
+                        data_point.size = len(data)
+                    else:
+                        data_point.data = self.make_payload(columns)
+                        data_point.size = DataPoint.get_payload_size(
+                            data_point.data)
+                    data_points.append(data_point)
+                DataPoint.objects.bulk_create(data_points)
+
+    def make_payload(self, columns) -> str:
+        """A JSON trial log with the given columns"""
+        trials = []
+        for i in range(self._lognormal(self.trials)):
+            trial = {'trial': i + 1}
+            for column in columns[1:]:
+                trial[column] = TRIAL_COLUMNS[column](self.random, i)
+            trials.append(trial)
+        return json.dumps(trials)
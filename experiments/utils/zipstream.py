@@ -0,0 +1,273 @@
+"""A ZIP writer that produces an archive as a stream of chunks, in constant
+memory.
+
+zipfile.ZipFile can write to an unseekable stream, but it keeps the central
+directory in memory and needs every entry as a whole (or as a file to copy
+from). ZipStream takes every entry as an iterable of chunks instead, and
+writes:
+- a local header without CRC and sizes, flagged to have a data descriptor
+- the (compressed) data, as it comes in
+- the data descriptor, with the CRC and sizes that are known by then
+
+Entries that were compressed beforehand (see deflate()) are written with
+their CRC and sizes in the local header instead.
+
+The central directory is spooled to a temporary file until the archive is
+closed. ZIP64 extensions are used for entries, offsets and entry counts that
+don't fit the original format.
+"""
+import struct
+import tempfile
+import time
+import zlib
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+from zipfile import LargeZipFile, ZIP_DEFLATED, ZIP_STORED
+
+# Largest values that fit the fields of the original format; anything from
+# these values onward is stored in ZIP64 fields
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+# Entries that (might) grow to this size get ZIP64 sizes in their local
+# header and data descriptor. Deflate can make incompressible data slightly
+# larger, so this stays well below ZIP64_LIMIT.
+ZIP64_ENTRY_THRESHOLD = 1 << 31
+
+# The central directory is kept in memory up to this size
+SPOOL_MAX_SIZE = 1024 * 1024
+
+READ_SIZE = 64 * 1024
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<4sIII')
+DATA_DESCRIPTOR64 = struct.Struct('<4sIQQ')
+CENTRAL_HEADER = struct.Struct('<4sHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<4sHHHHIIH')
+END_RECORD64 = struct.Struct('<4sQHHIIQQQQ')
+END_LOCATOR64 = struct.Struct('<4sIQI')
+
+ZIP64_EXTRA_ID = 0x0001
+FLAGS = 0x800  # UTF-8 file names
+FLAG_DATA_DESCRIPTOR = 0x08
+VERSION = 20
+VERSION_ZIP64 = 45
+# Unix, so the external attributes hold file permissions
+MADE_BY_UNIX = 3 << 8
+FILE_ATTRIBUTES = 0o100644 << 16
+
+
+def deflate(data: bytes, compresslevel: int = -1) -> Tuple[int, bytes]:
+    """Returns the CRC and the raw deflated data, for
+    ZipStream.write_compressed. zlib releases the GIL while doing this, so
+    entries can be compressed in threads."""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    return zlib.crc32(data), compressor.compress(data) + compressor.flush()
+
+
+def buffered(chunks: Iterable[bytes], size: int = READ_SIZE) -> Iterator[bytes]:
+    """Joins small chunks into chunks of at least size bytes"""
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+class ZipStream:
+    """Writes a ZIP archive as a stream of chunks.
+
+    Every method yields the bytes it writes, which should be sent on in
+    order:
+
+        zip_stream = ZipStream()
+        yield from zip_stream.write_file('data.txt', chunks)
+        yield from zip_stream.close()
+    """
+
+    def __init__(self, compresslevel: int = -1, date_time=None, offset=0,
+                 count=0, central_directory: Optional[BinaryIO] = None):
+        """To continue an archive, pass the offset at which it is continued,
+        the amount of entries before that offset and a file with their
+        central directory records. That file should be opened in 'a+b' mode,
+        and is closed by close()."""
+        self.compresslevel = compresslevel
+        year, month, day, hour, minute, second = \
+            (date_time or time.localtime())[:6]
+        self.dos_time = (hour << 11) | (minute << 5) | (second // 2)
+        self.dos_date = ((year - 1980) << 9) | (month << 5) | day
+
+        self.offset = offset
+        self.count = count
+        if central_directory is None:
+            central_directory = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE)
+        self.central_directory = central_directory
+
+    def _write(self, data: bytes) -> bytes:
+        self.offset += len(data)
+        return data
+
+    def write_file(self, name: str, chunks: Iterable[bytes],
+                   compression: int = ZIP_DEFLATED,
+                   size: Optional[int] = None) -> Iterator[bytes]:
+        """Writes an entry containing the given chunks.
+
+        :param size: the expected size of the data. Without it, the entry is
+                     written with ZIP64 sizes in case it turns out to be large.
+        """
+        if compression not in (ZIP_STORED, ZIP_DEFLATED):
+            raise NotImplementedError('Unsupported compression method')
+
+        encoded_name = name.encode('utf-8')
+        header_offset = self.offset
+        zip64 = size is None or size >= ZIP64_ENTRY_THRESHOLD
+
+        if zip64:
+            # A streamed ZIP64 entry has placeholder sizes in its header
+            extra = struct.pack('<HHQQ', ZIP64_EXTRA_ID, 16, 0, 0)
+            header_size = 0xFFFFFFFF
+        else:
+            extra = b''
+            header_size = 0
+        yield self._write(LOCAL_HEADER.pack(
+            b'PK\x03\x04', VERSION_ZIP64 if zip64 else VERSION,
+            FLAGS | FLAG_DATA_DESCRIPTOR,
+            compression, self.dos_time, self.dos_date, 0, header_size,
+            header_size, len(encoded_name), len(extra)
+        ) + encoded_name + extra)
+
+        compressor = None
+        if compression == ZIP_DEFLATED:
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED,
+                                          -15)
+
+        crc = 0
+        file_size = 0
+        compressed_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                compressed_size += len(chunk)
+                yield self._write(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield self._write(chunk)
+
+        if zip64:
+            yield self._write(DATA_DESCRIPTOR64.pack(
+                b'PK\x07\x08', crc, compressed_size, file_size
+            ))
+        elif max(file_size, compressed_size) >= ZIP64_LIMIT:
+            # The 4 byte descriptor can't hold the sizes anymore
+            raise LargeZipFile('{} is larger than its expected size'.format(
+                name))
+        else:
+            yield self._write(DATA_DESCRIPTOR.pack(
+                b'PK\x07\x08', crc, compressed_size, file_size
+            ))
+
+        self._add_central_record(encoded_name, FLAGS | FLAG_DATA_DESCRIPTOR,
+                                 compression, crc, compressed_size, file_size,
+                                 header_offset, zip64)
+
+    def write_compressed(self, name: str, data: bytes, crc: int, size: int,
+                         compression: int = ZIP_DEFLATED) -> Iterator[bytes]:
+        """Writes an entry of data that was already compressed, by
+        deflate() for example. Its CRC and sizes are known, so they go in the
+        local header.
+
+        :param crc: the CRC of the uncompressed data
+        :param size: the size of the uncompressed data
+        """
+        encoded_name = name.encode('utf-8')
+        header_offset = self.offset
+        zip64 = max(size, len(data)) >= ZIP64_LIMIT
+
+        if zip64:
+            extra = struct.pack('<HHQQ', ZIP64_EXTRA_ID, 16, size, len(data))
+            file_size_field = compressed_size_field = 0xFFFFFFFF
+        else:
+            extra = b''
+            file_size_field, compressed_size_field = size, len(data)
+        yield self._write(LOCAL_HEADER.pack(
+            b'PK\x03\x04', VERSION_ZIP64 if zip64 else VERSION, FLAGS,
+            compression, self.dos_time, self.dos_date, crc,
+            compressed_size_field, file_size_field, len(encoded_name),
+            len(extra)
+        ) + encoded_name + extra)
+        if data:
+            yield self._write(data)
+
+        self._add_central_record(encoded_name, FLAGS, compression, crc,
+                                 len(data), size, header_offset, zip64)
+
+    def _add_central_record(self, encoded_name, flags, compression, crc,
+                            compressed_size, file_size, header_offset, zip64):
+        # The ZIP64 extra field holds the values that don't fit, in this order
+        zip64_values = []
+        fields = []
+        for value in (file_size, compressed_size, header_offset):
+            if value >= ZIP64_LIMIT:
+                zip64_values.append(value)
+                fields.append(0xFFFFFFFF)
+            else:
+                fields.append(value)
+        file_size_field, compressed_size_field, offset_field = fields
+
+        extra = b''
+        if zip64_values:
+            extra = struct.pack('<HH{}Q'.format(len(zip64_values)),
+                                ZIP64_EXTRA_ID, 8 * len(zip64_values),
+                                *zip64_values)
+        version = VERSION_ZIP64 if zip64 or zip64_values else VERSION
+
+        self.central_directory.write(CENTRAL_HEADER.pack(
+            b'PK\x01\x02', MADE_BY_UNIX | version, version, flags,
+            compression, self.dos_time, self.dos_date, crc,
+            compressed_size_field, file_size_field, len(encoded_name),
+            len(extra), 0, 0, 0, FILE_ATTRIBUTES, offset_field
+        ) + encoded_name + extra)
+        self.count += 1
+
+    def write_str(self, name: str, data: str, **kwargs) -> Iterator[bytes]:
+        data = data.encode('utf-8')
+        return self.write_file(name, [data], size=len(data), **kwargs)
+
+    def close(self) -> Iterator[bytes]:
+        """Writes the central directory, which ends the archive"""
+        directory_offset = self.offset
+        self.central_directory.seek(0)
+        for chunk in iter(lambda: self.central_directory.read(READ_SIZE), b''):
+            yield self._write(chunk)
+        self.central_directory.close()
+        directory_size = self.offset - directory_offset
+
+        if self.count >= ZIP_FILECOUNT_LIMIT or \
+                directory_offset >= ZIP64_LIMIT or \
+                directory_size >= ZIP64_LIMIT:
+            end_record64_offset = self.offset
+            yield self._write(END_RECORD64.pack(
+                b'PK\x06\x06', END_RECORD64.size - 12,
+                MADE_BY_UNIX | VERSION_ZIP64, VERSION_ZIP64, 0, 0,
+                self.count, self.count, directory_size, directory_offset
+            ))
+            yield self._write(END_LOCATOR64.pack(
+                b'PK\x06\x07', 0, end_record64_offset, 1
+            ))
+
+        count = self.count if self.count < ZIP_FILECOUNT_LIMIT else 0xFFFF
+        yield self._write(END_RECORD.pack(
+            b'PK\x05\x06', 0, 0, count, count,
+            directory_size if directory_size < ZIP64_LIMIT else 0xFFFFFFFF,
+            directory_offset if directory_offset < ZIP64_LIMIT else 0xFFFFFFFF,
+            0
+        ))
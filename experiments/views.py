@@ -1,6 +1,7 @@
 from typing import Dict, Any
 
 from django import forms
+from django.db import models
 from django.http import HttpResponseBadRequest, Http404, HttpResponseRedirect
 from django.views import generic
 import braces.views as braces
@@ -16,8 +17,9 @@ from auditlog.utils.log import log
 from .forms import CreateExperimentForm, EditExperimentForm, DownloadForm
 from .models import Experiment, DataPoint, TargetGroup
 from .serializers import ExperimentSerializer
-from .utils import create_download_response_zip, create_file_response_single, \
-    send_new_experiment_mail
+from .utils import create_cached_download_response_zip, \
+    create_delta_download_response_zip, create_download_response_zip, \
+    create_file_response_single, send_new_experiment_mail
 from .mixins import UserAllowedMixin
 
 
@@ -36,7 +38,7 @@ class ExperimentHomeView(braces.LoginRequiredMixin, generic.ListView):
             order_by = 'date_created'
 
         qs = qs.order_by(order_by)
-        return qs
+        return qs.annotate(num_datapoints=models.Count('datapoint'))
 
 
 
@@ -166,7 +168,8 @@ class ExperimentDetailView(UserAllowedMixin, generic.ListView):
         return context
 
     def get_queryset(self):
-        return self.model.objects.filter(experiment=self.experiment).defer('data')
+        return self.model.objects.filter(experiment=self.experiment)\
+            .select_related('session__group').defer('data')
 
 
 class DeleteExperimentView(UserAllowedMixin, SuccessMessageMixin,
@@ -271,15 +274,25 @@ class DownloadView(UserAllowedMixin, generic.View):
     The decision whether to download a single or all data is made by checking
     if a datapoint ID was provided.
     """
-    _formats = ['csv', 'raw']
+    _formats = ['csv', 'raw', 'merged']
 
     def get(self, request, experiment, file_format='csv', data_point=None):
         if file_format not in self._formats:
             return HttpResponseBadRequest()
+        # Merging only makes sense for all data
+        if data_point and file_format == 'merged':
+            return HttpResponseBadRequest()
+        # Only 'last' for now: the data added since the previous download of
+        # new data
+        since = request.GET.get('since')
+        if since not in (None, 'last'):
+            return HttpResponseBadRequest()
 
         subject = "all data"
         if data_point:
             subject = "datapoint {}".format(data_point)
+        elif since:
+            subject = "new data"
 
         # log action to auditlog
         log(
@@ -299,8 +312,15 @@ class DownloadView(UserAllowedMixin, generic.View):
                 return Http404()
 
             return create_file_response_single(file_format, qs.first())
+        elif since:
+            return create_delta_download_response_zip(
+                file_format,
+                self.experiment,
+                request.user
+            )
         else:
-            return create_download_response_zip(file_format, self.experiment)
+            return create_cached_download_response_zip(file_format,
+                                                       self.experiment)
 
 
 class DownloadFormView(UserAllowedMixin, generic.FormView):
@@ -314,7 +334,14 @@ class DownloadFormView(UserAllowedMixin, generic.FormView):
 
     def form_valid(self, form):
         file_format = form.cleaned_data['file_format']
+        if form.cleaned_data['since_last_download']:
+            # The form makes sure nothing is filtered out
+            return create_delta_download_response_zip(
+                file_format,
+                self.experiment,
+                self.request.user
+            )
         queryset = self.experiment.datapoint_set \
             .filter(session__experiment_state__in=form.cleaned_data['include_status']) \
-            .filter(session__group__in=form.cleaned_data['include_groups']).defer('data')
+            .filter(session__group__in=form.cleaned_data['include_groups'])
         return create_download_response_zip(file_format, self.experiment, queryset)
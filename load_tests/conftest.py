@@ -0,0 +1,80 @@
+import pytest
+
+from load_harness import DEFAULT_MIX
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('load', 'load test of the participant API')
+    group.addoption('--run-load', action='store_true',
+                    help='Run the load tests, which are skipped otherwise')
+    group.addoption('--load-clients', type=int, default=10,
+                    help='Number of concurrent clients')
+    group.addoption('--load-duration', type=float, default=10.0,
+                    help='Duration of the run, in seconds')
+    group.addoption('--load-requests', type=int, default=0,
+                    help='Stop after this many requests (0: no limit)')
+    group.addoption('--load-mix', default=DEFAULT_MIX,
+                    help='Weights of the scenarios, like "{}"'.format(DEFAULT_MIX))
+    group.addoption('--load-payload-size', type=int, default=10 * 1024,
+                    help='Size of a text upload, in bytes')
+    group.addoption('--load-binary-size', type=int, default=1024 * 1024,
+                    help='Size of a binary upload, in bytes')
+    group.addoption('--load-seed', type=int, default=0,
+                    help='Seed for the choices of the clients')
+    group.addoption('--load-output', default=None,
+                    help='JSON file to write the results to (default: '
+                         'load-test-<date>.json in the temporary directory '
+                         'of the test)')
+    group.addoption('--load-max-error-rate', type=float, default=0.01,
+                    help='Fail when a larger fraction of the requests failed')
+
+
+# Summaries of the load test runs, reported at the end of the session
+summaries_key = pytest.StashKey[list]()
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'load: load test, needs --run-load')
+
+
+def pytest_collection_modifyitems(config, items):
+    # A plain pytest run from the root of the repository (like in CI) also
+    # collects the load tests, which take long and need a real database to
+    # give reliable results
+    if config.getoption('run_load'):
+        return
+    skip = pytest.mark.skip(reason='load tests only run with --run-load')
+    for item in items:
+        if item.get_closest_marker('load'):
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def load_options(request):
+    getoption = request.config.getoption
+    return {
+        'clients': getoption('load_clients'),
+        'duration': getoption('load_duration'),
+        'max_requests': getoption('load_requests'),
+        'mix': getoption('load_mix'),
+        'payload_size': getoption('load_payload_size'),
+        'binary_size': getoption('load_binary_size'),
+        'seed': getoption('load_seed'),
+    }
+
+
+@pytest.fixture
+def load_report(request):
+    """Adds lines to the load test results in the terminal summary"""
+    return request.config.stash.setdefault(summaries_key, []).append
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    summaries = config.stash.get(summaries_key, [])
+    if not summaries:
+        return
+
+    terminalreporter.write_sep('=', 'load test results')
+    for summary in summaries:
+        for line in summary.splitlines():
+            terminalreporter.write_line(line)
@@ -0,0 +1,244 @@
+"""Drives the participant API of a running datastore with concurrent clients,
+and measures throughput and latency.
+
+Every client acts like a participant's browser: it does one request at a
+time, picking what to do from a weighted mix of scenarios. Uploads go to the
+session the client got from its last participant request.
+"""
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.urls import reverse
+
+SCENARIOS = ('participant', 'upload', 'binary', 'metadata')
+
+# Scenarios that need a participant session first
+SESSION_SCENARIOS = ('upload', 'binary')
+
+DEFAULT_MIX = 'participant=1,upload=5,binary=1,metadata=3'
+
+
+def parse_mix(mix: str) -> dict:
+    """Parses a mix like 'participant=1,upload=4' into a weight per
+    scenario"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError('Unknown scenario {!r}, choose from {}'.format(
+                name, ', '.join(SCENARIOS)
+            ))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(values: list, percent: float):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return None
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def make_trial_log(rand: random.Random, size: int) -> bytes:
+    """A JSON trial log like experiments upload, of roughly size bytes"""
+    trials = []
+    length = 2
+    while length < size:
+        trial = {
+            'trial': len(trials) + 1,
+            'stimulus': rand.choice(['left', 'right', 'up', 'down']),
+            'response': rand.choice(['f', 'j']),
+            'rt': rand.randint(200, 2000),
+        }
+        length += len(json.dumps(trial)) + 2
+        trials.append(trial)
+    return json.dumps(trials).encode()
+
+
+class Client:
+    """A single participant, doing one request at a time"""
+    timeout = 60
+
+    def __init__(self, base_url, access_id, rand: random.Random,
+                 payload_size: int, binary_size: int):
+        self.base_url = base_url
+        self.access_id = str(access_id)
+        self.participant_id = None
+        self.response_body = b''
+        self.payload = make_trial_log(rand, payload_size)
+        self.binary = rand.randbytes(binary_size)
+
+    def request(self, method, path, body=None, headers=None) -> int:
+        """Does a request and returns its status code. Connection errors
+        and timeouts are raised as OSError."""
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=body,
+            headers=headers or {},
+            method=method
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                self.response_body = response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            self.response_body = e.read()
+            return e.code
+
+    def participant(self) -> int:
+        status = self.request('POST', reverse('api:participant', args=[self.access_id]))
+        if status == 200:
+            self.participant_id = json.loads(self.response_body)['uuid']
+        return status
+
+    def upload(self) -> int:
+        return self.request(
+            'POST',
+            reverse('api:upload', args=[self.access_id, self.participant_id]),
+            self.payload,
+            {'Content-Type': 'text/plain'}
+        )
+
+    def binary(self) -> int:
+        boundary = uuid.uuid4().hex
+        body = b''.join([
+            '--{}\r\n'.format(boundary).encode(),
+            b'Content-Disposition: form-data; name="file"; filename="recording.bin"\r\n',
+            b'Content-Type: application/octet-stream\r\n\r\n',
+            self.binary,
+            '\r\n--{}--\r\n'.format(boundary).encode(),
+        ])
+        return self.request(
+            'POST',
+            reverse('api:upload_bin', args=[self.access_id, self.participant_id]),
+            body,
+            {'Content-Type': 'multipart/form-data; boundary={}'.format(boundary)}
+        )
+
+    def metadata(self) -> int:
+        return self.request('GET', reverse('api:metadata', args=[self.access_id]))
+
+
+class Stats:
+    """Collects the latency and status of every request, per scenario"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def record(self, scenario, latency, status):
+        with self.lock:
+            self.latencies[scenario].append(latency)
+            self.statuses[scenario][status] += 1
+
+    @staticmethod
+    def summarize(latencies, statuses, elapsed) -> dict:
+        latencies = sorted(latencies)
+        errors = {
+            str(status): count for status, count in statuses.items()
+            if status is None or status >= 400
+        }
+        return {
+            'requests': len(latencies),
+            'throughput': len(latencies) / elapsed if elapsed else None,
+            'errors': sum(errors.values()),
+            'errors_by_status': errors,
+            # In milliseconds
+            'latency': {
+                name: None if value is None else value * 1000
+                for name, value in [
+                    ('p50', percentile(latencies, 50)),
+                    ('p95', percentile(latencies, 95)),
+                    ('p99', percentile(latencies, 99)),
+                    ('max', latencies[-1] if latencies else None),
+                ]
+            },
+        }
+
+    def summary(self, elapsed) -> dict:
+        with self.lock:
+            total_statuses = Counter()
+            for statuses in self.statuses.values():
+                total_statuses.update(statuses)
+
+            return {
+                'elapsed': elapsed,
+                'total': self.summarize(
+                    [latency for latencies in self.latencies.values()
+                     for latency in latencies],
+                    total_statuses,
+                    elapsed
+                ),
+                'scenarios': {
+                    scenario: self.summarize(self.latencies[scenario],
+                                             self.statuses[scenario],
+                                             elapsed)
+                    for scenario in sorted(self.latencies)
+                },
+            }
+
+
+def run_load_test(base_url, access_id, mix=DEFAULT_MIX, clients=10,
+                  duration=10.0, max_requests=0, payload_size=10 * 1024,
+                  binary_size=1024 * 1024, seed=0) -> dict:
+    """Runs clients concurrent clients against the API of the experiment,
+    until duration seconds have passed or max_requests requests were done
+    (when not 0). Returns the statistics per scenario and in total."""
+    weights = parse_mix(mix)
+    scenarios = list(weights)
+    stats = Stats()
+    budget = threading.Semaphore(max_requests) if max_requests else None
+
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def run_client(index):
+        rand = random.Random(seed + index)
+        client = Client(base_url, access_id, rand, payload_size, binary_size)
+
+        while time.perf_counter() < deadline:
+            if budget and not budget.acquire(blocking=False):
+                break
+
+            scenario = rand.choices(scenarios, [weights[s] for s in scenarios])[0]
+            if scenario in SESSION_SCENARIOS and client.participant_id is None:
+                scenario = 'participant'
+
+            request_start = time.perf_counter()
+            try:
+                status = getattr(client, scenario)()
+            except OSError:
+                status = None
+            stats.record(scenario, time.perf_counter() - request_start, status)
+
+    with ThreadPoolExecutor(clients) as pool:
+        # list() re-raises any unexpected error of the clients
+        list(pool.map(run_client, range(clients)))
+
+    return stats.summary(time.perf_counter() - start)
+
+
+def format_summary(results: dict) -> str:
+    lines = ["{:<12} {:>9} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+        'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'
+    )]
+    rows = list(results['scenarios'].items()) + [('total', results['total'])]
+    for name, summary in rows:
+        latency = summary['latency']
+        lines.append("{:<12} {:>9} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            name, summary['requests'], summary['errors'],
+            summary['throughput'] or 0,
+            latency['p50'] or 0, latency['p95'] or 0, latency['p99'] or 0,
+        ))
+    return '\n'.join(lines)
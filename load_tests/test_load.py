@@ -0,0 +1,48 @@
+import json
+from datetime import datetime
+
+import pytest
+from django.db import connection
+
+from experiments.models import Experiment
+from load_harness import format_summary, run_load_test
+
+
+@pytest.mark.load
+def test_participant_api(live_server, transactional_db, settings, tmp_path,
+                         load_options, load_report, request):
+    """Runs the configured mix of participant requests against a live
+    server, and writes throughput and latencies to a JSON file"""
+    # Measure the capacity of the server, not the rate limit
+    settings.API_THROTTLE_RATE = None
+    settings.MEDIA_ROOT = str(tmp_path)
+
+    experiment = Experiment.objects.create(
+        title='Load test',
+        state=Experiment.OPEN,
+        approved=True,
+    )
+    experiment.targetgroup_set.update(completion_target=10 ** 9)
+
+    results = run_load_test(live_server.url, experiment.access_id,
+                            **load_options)
+    date = datetime.now()
+    results = {
+        'date': date.isoformat(timespec='seconds'),
+        'database': connection.vendor,
+        'options': load_options,
+        **results,
+    }
+
+    output = request.config.getoption('load_output') or \
+        str(tmp_path / 'load-test-{:%Y%m%d-%H%M%S}.json'.format(date))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    load_report(format_summary(results))
+    load_report('Results written to {}'.format(output))
+
+    total = results['total']
+    assert total['requests'] > 0
+    assert total['errors'] <= total['requests'] * \
+        request.config.getoption('load_max_error_rate')
@@ -0,0 +1,44 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from api.serializers import ParticipantSerializer, iter_json_array
+from experiments.models import Experiment
+
+
+class Command(BaseCommand):
+    help = 'Creates a batch of participant sessions for an experiment, and ' \
+           'writes them as a JSON array'
+
+    def add_arguments(self, parser):
+        parser.add_argument('access_id', type=str)
+        parser.add_argument('count', type=int)
+        parser.add_argument(
+            '-o', '--output',
+            type=str,
+            help='File to write the sessions to, instead of stdout',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            experiment = Experiment.objects.get(access_id=options['access_id'])
+        except (Experiment.DoesNotExist, ValidationError):
+            raise CommandError(
+                'No experiment with access id {}'.format(options['access_id'])
+            )
+
+        if options['count'] < 1:
+            raise CommandError('count should be a positive number')
+
+        sessions = experiment.create_sessions(options['count'])
+        if not sessions:
+            raise CommandError('Could not assign participants to any group')
+
+        chunks = iter_json_array(sessions, ParticipantSerializer)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.writelines(chunks)
+            return
+
+        for chunk in chunks:
+            self.stdout.write(chunk, ending='')
+        self.stdout.write('')
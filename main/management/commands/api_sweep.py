@@ -0,0 +1,60 @@
+import os
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.models import ChunkedUpload, IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Removes expired transient API state, like abandoned resumable ' \
+           'uploads and idempotency keys. Intended to be run periodically.'
+
+    def handle(self, *args, **options):
+        self.sweep_chunked_uploads()
+        self.sweep_idempotency_keys()
+
+    def sweep_chunked_uploads(self):
+        cutoff = timezone.now() - timedelta(
+            seconds=settings.API_CHUNKED_UPLOAD_EXPIRY
+        )
+
+        removed = 0
+        for upload in ChunkedUpload.objects.filter(date_updated__lt=cutoff)\
+                .iterator():
+            upload.discard()
+            removed += 1
+
+        # Spool files can also be left behind when their upload was deleted
+        # along with its session
+        orphans = 0
+        if os.path.isdir(settings.API_CHUNKED_UPLOAD_DIR):
+            known = {
+                str(upload_id) for upload_id in
+                ChunkedUpload.objects.values_list('uuid', flat=True)
+            }
+            for entry in os.scandir(settings.API_CHUNKED_UPLOAD_DIR):
+                modified = datetime.fromtimestamp(
+                    entry.stat().st_mtime, tz=dt_timezone.utc
+                )
+                if entry.name not in known and modified < cutoff:
+                    os.remove(entry.path)
+                    orphans += 1
+
+        self.stdout.write(
+            "Removed {} abandoned upload(s) and {} orphaned spool "
+            "file(s)".format(removed, orphans)
+        )
+
+    def sweep_idempotency_keys(self):
+        cutoff = timezone.now() - timedelta(
+            seconds=settings.API_IDEMPOTENCY_KEY_EXPIRY
+        )
+        removed, _ = IdempotencyKey.objects.filter(date_created__lt=cutoff)\
+            .delete()
+
+        self.stdout.write(
+            "Removed {} expired idempotency key(s)".format(removed)
+        )
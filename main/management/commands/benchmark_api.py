@@ -0,0 +1,166 @@
+import gzip
+import json
+import random
+import time
+import uuid
+import zlib
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+
+from api.parsers import brotli
+from api.views import BatchUploadView, SessionUploadView
+from experiments.models import Experiment
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks API upload scenarios against the configured database. ' \
+           'A temporary experiment is created and deleted afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--items',
+            type=int,
+            default=100,
+            help='Number of datapoints to upload per run',
+        )
+        parser.add_argument(
+            '--payload-size',
+            type=int,
+            default=1024,
+            help='Approximate size of every payload, in bytes',
+        )
+        parser.add_argument(
+            '--compression',
+            action='store_true',
+            help='Compare compressed and uncompressed uploads of 1 MB and '
+                 '10 MB payloads instead',
+        )
+        parser.add_argument(
+            '--bandwidth',
+            type=float,
+            default=10,
+            help='Upload bandwidth of a participant in Mbit/s, used to '
+                 'estimate the total time of an upload with --compression',
+        )
+
+    def handle(self, *args, **options):
+        self.factory = APIRequestFactory()
+        experiment = Experiment.objects.create(
+            title='Benchmark {}'.format(uuid.uuid4()),
+            state=Experiment.OPEN,
+            approved=True,
+        )
+        try:
+            self.experiment = experiment
+            if options['compression']:
+                self.run_compression_benchmarks(options)
+            else:
+                self.run_benchmarks(options)
+        finally:
+            experiment.delete()
+
+    def run_benchmarks(self, options):
+        payloads = [
+            json.dumps({'trial': i, 'padding': 'x' * options['payload_size']})
+            for i in range(options['items'])
+        ]
+
+        self.report('single uploads', *self.measure(
+            lambda session: [self.upload_single(session, payload)
+                             for payload in payloads]
+        ))
+        self.report('batch upload', *self.measure(
+            lambda session: self.upload_batch(session, payloads)
+        ))
+
+    def run_compression_benchmarks(self, options):
+        encoders = [
+            ('identity', lambda data: data),
+            ('gzip', gzip.compress),
+            ('deflate', zlib.compress),
+        ]
+        if brotli is not None:
+            encoders.append(('br', brotli.compress))
+
+        self.stdout.write("{:<6} {:<9} {:>12} {:>10} {:>12} {:>10}".format(
+            'size', 'encoding', 'sent', 'server', 'est. total', 'MB/s'
+        ))
+        for megabytes in (1, 10):
+            data = self.make_trial_log(megabytes * 1024 * 1024).encode()
+            for encoding, compress in encoders:
+                body = compress(data)
+                session = self.experiment.create_session()
+
+                start = time.perf_counter()
+                self.upload_single(session, body,
+                                   HTTP_CONTENT_ENCODING=encoding)
+                duration = time.perf_counter() - start
+
+                # Time to send the body on the given bandwidth, plus the time
+                # the server needs to decode and store it
+                total = len(body) * 8 / (options['bandwidth'] * 10 ** 6) + \
+                    duration
+                self.stdout.write(
+                    "{:<6} {:<9} {:>12} {:>9.3f}s {:>11.3f}s {:>10.1f}".format(
+                        "{}MB".format(megabytes), encoding, len(body),
+                        duration, total, len(data) / total / 1024 ** 2
+                    )
+                )
+
+    @staticmethod
+    def make_trial_log(size) -> str:
+        """Returns a JSON trial log, similar to what experiments upload, of
+        roughly the given size"""
+        rand = random.Random(0)
+        trials = []
+        length = 2
+        while length < size:
+            trial = json.dumps({
+                'trial': len(trials),
+                'stimulus': rand.choice(['left', 'right', 'up', 'down']),
+                'response': rand.choice(['left', 'right', 'up', 'down']),
+                'rt': round(rand.uniform(200, 1500), 3),
+                'correct': rand.random() < 0.8,
+            })
+            trials.append(trial)
+            length += len(trial) + 2
+        return '[' + ', '.join(trials) + ']'
+
+    def measure(self, func):
+        """Runs func with a fresh session, returns the wall time and the
+        number of queries"""
+        session = self.experiment.create_session()
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            func(session)
+            duration = time.perf_counter() - start
+
+        return duration, len(ctx)
+
+    def report(self, name, duration, queries):
+        self.stdout.write("{:<20} {:>10.3f}s {:>8} queries".format(
+            name, duration, queries
+        ))
+
+    def upload_single(self, session, payload, **extra):
+        request = self.factory.post('/', payload, content_type='text/plain',
+                                    **extra)
+        response = SessionUploadView.as_view()(
+            request,
+            access_key=str(self.experiment.access_id),
+            participant_id=str(session.uuid),
+        )
+        assert response.status_code == 200, response.data
+
+    def upload_batch(self, session, payloads):
+        request = self.factory.post('/', '\n'.join(payloads),
+                                    content_type='application/x-ndjson')
+        response = BatchUploadView.as_view()(
+            request,
+            access_key=str(self.experiment.access_id),
+            participant_id=str(session.uuid),
+        )
+        assert response.status_code == 200, response.data
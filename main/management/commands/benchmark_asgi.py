@@ -0,0 +1,205 @@
+import asyncio
+import io
+import json
+import math
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.urls import reverse
+
+from experiments.models import Experiment
+
+
+class SlowInput(io.RawIOBase):
+    """wsgi.input that trickles the body in, like a client on a slow
+    connection would"""
+
+    def __init__(self, chunks, delay):
+        self.chunks = list(chunks)
+        self.delay = delay
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.chunks:
+            return 0
+        time.sleep(self.delay)
+        chunk = self.chunks.pop(0)
+        size = min(len(chunk), len(buffer))
+        buffer[:size] = chunk[:size]
+        if size < len(chunk):
+            self.chunks.insert(0, chunk[size:])
+        return size
+
+
+class Command(BaseCommand):
+    help = 'Compares the regular (WSGI) upload endpoint with its async (ASGI) ' \
+           'variant, using simulated slow clients. Both handlers are driven ' \
+           'in-process; a temporary experiment is created and deleted afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-c', '--clients',
+            type=int,
+            default=200,
+            help='Number of concurrent clients',
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=16,
+            help='Number of worker threads of the simulated WSGI server',
+        )
+        parser.add_argument(
+            '--payload-size',
+            type=int,
+            default=16 * 1024,
+            help='Approximate size of every payload, in bytes',
+        )
+        parser.add_argument(
+            '--chunks',
+            type=int,
+            default=10,
+            help='Number of pieces every client sends its body in',
+        )
+        parser.add_argument(
+            '--delay',
+            type=float,
+            default=0.05,
+            help='Seconds a client waits between sending two pieces',
+        )
+
+    def handle(self, *args, **options):
+        experiment = Experiment.objects.create(
+            title='Benchmark {}'.format(uuid.uuid4()),
+            state=Experiment.OPEN,
+            approved=True,
+        )
+        try:
+            self.experiment = experiment
+            self.host = next(
+                (host.lstrip('.') for host in settings.ALLOWED_HOSTS
+                 if host != '*'),
+                'localhost'
+            )
+            self.run_benchmarks(options)
+        finally:
+            experiment.delete()
+
+    def run_benchmarks(self, options):
+        body = json.dumps({'padding': 'x' * options['payload_size']}).encode()
+        size = math.ceil(len(body) / options['chunks'])
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+
+        self.report('wsgi ({} threads)'.format(options['threads']),
+                    options['clients'],
+                    *self.run_wsgi(chunks, options))
+        self.report('asgi', options['clients'],
+                    *self.run_asgi(chunks, options))
+
+    def report(self, name, clients, duration, latencies):
+        latencies = sorted(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write("{:<20} {:>8.1f} req/s {:>8.3f}s p99".format(
+            name, clients / duration, p99
+        ))
+
+    def run_wsgi(self, chunks, options):
+        application = get_wsgi_application()
+        path = reverse('api:upload', args=[self.experiment.access_id])
+        length = sum(len(chunk) for chunk in chunks)
+
+        def _request(i):
+            start = time.perf_counter()
+            environ = {
+                'REQUEST_METHOD': 'POST',
+                'PATH_INFO': path,
+                'SCRIPT_NAME': '',
+                'QUERY_STRING': '',
+                'SERVER_NAME': self.host,
+                'SERVER_PORT': '80',
+                'HTTP_HOST': self.host,
+                'CONTENT_TYPE': 'text/plain',
+                'CONTENT_LENGTH': str(length),
+                'wsgi.input': io.BufferedReader(
+                    SlowInput(chunks, options['delay'])
+                ),
+                'wsgi.url_scheme': 'http',
+                'wsgi.errors': io.StringIO(),
+            }
+            statuses = []
+            try:
+                response = application(
+                    environ, lambda status, headers: statuses.append(status)
+                )
+                b''.join(response)
+            finally:
+                connection.close()
+            assert statuses[0].startswith('200'), statuses[0]
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            latencies = list(executor.map(_request, range(options['clients'])))
+        return time.perf_counter() - start, latencies
+
+    def run_asgi(self, chunks, options):
+        application = get_asgi_application()
+        path = reverse('api:async_upload', args=[self.experiment.access_id])
+        length = sum(len(chunk) for chunk in chunks)
+
+        async def _request():
+            start = time.perf_counter()
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0'},
+                'http_version': '1.1',
+                'method': 'POST',
+                'scheme': 'http',
+                'path': path,
+                'raw_path': path.encode(),
+                'query_string': b'',
+                'root_path': '',
+                'headers': [
+                    (b'host', self.host.encode()),
+                    (b'content-type', b'text/plain'),
+                    (b'content-length', str(length).encode()),
+                ],
+                'server': (self.host, 80),
+            }
+            pending = list(chunks)
+            messages = []
+
+            async def receive():
+                if not pending:
+                    # Keeps the connection open until the response is sent
+                    await asyncio.Future()
+                await asyncio.sleep(options['delay'])
+                return {
+                    'type': 'http.request',
+                    'body': pending.pop(0),
+                    'more_body': bool(pending),
+                }
+
+            async def send(message):
+                messages.append(message)
+
+            await application(scope, receive, send)
+            assert messages[0]['status'] == 200, messages
+            return time.perf_counter() - start
+
+        async def _run():
+            return await asyncio.gather(
+                *(_request() for _ in range(options['clients']))
+            )
+
+        start = time.perf_counter()
+        latencies = asyncio.run(_run())
+        return time.perf_counter() - start, latencies
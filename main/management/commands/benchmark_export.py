@@ -0,0 +1,144 @@
+import itertools
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from django.test.utils import override_settings
+
+from experiments.models import Experiment
+from experiments.utils import create_download_response_zip
+from experiments.utils.export_pool import get_export_pool
+from experiments.utils.fake_data import FakeDataGenerator
+
+
+class Command(BaseCommand):
+    help = 'Measures how fast an experiment is exported with different ' \
+           'amounts of export workers and compression threads. Without ' \
+           '--experiment, a temporary experiment with fake data is created ' \
+           'and deleted afterwards. Use --binary-fraction to compare text ' \
+           'and binary heavy experiments.'
+
+    def add_arguments(self, parser):
+        cpus = os.cpu_count() or 1
+        default_workers = [0] + [n for n in (1, 2, 4, 8, 16) if n <= cpus]
+
+        parser.add_argument('--experiment', type=int,
+                            help='Primary key of the experiment to export')
+        parser.add_argument('-n', '--datapoints', type=int, default=10_000,
+                            help='Number of datapoints of the temporary '
+                                 'experiment')
+        parser.add_argument('--trials', type=int, default=50,
+                            help='Average number of trials in a payload of '
+                                 'the temporary experiment')
+        parser.add_argument('--binary-fraction', type=float, default=0.0,
+                            help='Fraction of the datapoints of the '
+                                 'temporary experiment that is a binary file')
+        parser.add_argument('--binary-size', type=int, default=1024 * 1024,
+                            help='Average size of a binary file of the '
+                                 'temporary experiment, in bytes')
+        parser.add_argument('--workers', type=str,
+                            default=','.join(map(str, default_workers)),
+                            help='Comma separated amounts of workers to '
+                                 'compare, 0 being no pool')
+        parser.add_argument('--compression-threads', type=str, default='0,4',
+                            help='Comma separated amounts of compression '
+                                 'threads to compare, 0 being no pool')
+        parser.add_argument('--deflate-all', action='store_true',
+                            help='Also deflate files that are already '
+                                 'compressed, like before these were stored')
+        parser.add_argument('--worker-type', choices=['process', 'thread'],
+                            default='process')
+        parser.add_argument('--format', choices=['csv', 'raw', 'merged'],
+                            default='csv')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Runs per amount of workers, of which the '
+                                 'fastest is reported')
+
+    def handle(self, *args, **options):
+        try:
+            workers = [int(n) for n in options['workers'].split(',')]
+            threads = [int(n) for n in
+                       options['compression_threads'].split(',')]
+        except ValueError:
+            raise CommandError('--workers and --compression-threads should '
+                               'be lists like 0,1,2,4')
+
+        if options['experiment']:
+            try:
+                experiment = Experiment.objects.get(pk=options['experiment'])
+            except Experiment.DoesNotExist:
+                raise CommandError('Unknown experiment {}'.format(
+                    options['experiment']))
+            self.run_benchmarks(experiment, workers, threads, options)
+            return
+
+        generator = FakeDataGenerator(
+            trials=options['trials'],
+            binary_fraction=options['binary_fraction'],
+            binary_size=options['binary_size'],
+        )
+        experiment = generator.create_experiment('Export benchmark')
+        try:
+            sessions = generator.create_sessions(experiment,
+                                                 options['datapoints'] // 10 or 1)
+            generator.create_datapoints(experiment, options['datapoints'],
+                                        sessions)
+            self.run_benchmarks(experiment, workers, threads, options)
+        finally:
+            for data_point in experiment.datapoint_set.filter(
+                    file__isnull=False).exclude(file=''):
+                data_point.file.delete(save=False)
+            experiment.delete()
+
+    def run_benchmarks(self, experiment, workers, threads, options):
+        data_points = experiment.datapoint_set
+        count = data_points.count()
+        files = data_points.filter(file__isnull=False).exclude(file='')
+        size = data_points.aggregate(size=Sum('size'))['size'] or 0
+        self.stdout.write(
+            'Exporting {} datapoints ({} files, {:.1f} MB) as {}, {} workers '
+            'on {} CPUs'.format(count, files.count(),
+                                size / 1024 ** 2, options['format'],
+                                options['worker_type'], os.cpu_count())
+        )
+        self.stdout.write("{:>8} {:>8} {:>10} {:>14} {:>9} {:>9}".format(
+            'workers', 'threads', 'time', 'datapoints/s', 'MB/s', 'speed-up'
+        ))
+
+        stored_extensions = settings.EXPORT_STORED_EXTENSIONS
+        if options['deflate_all']:
+            stored_extensions = []
+
+        baseline = None
+        for amount, thread_amount in itertools.product(workers, threads):
+            pool = get_export_pool(amount, options['worker_type'])
+            if pool:
+                # Starts the workers before measuring
+                list(pool.map(abs, range(amount)))
+
+            with override_settings(EXPORT_WORKERS=amount,
+                                   EXPORT_WORKER_TYPE=options['worker_type'],
+                                   EXPORT_COMPRESSION_THREADS=thread_amount,
+                                   EXPORT_STORED_EXTENSIONS=stored_extensions):
+                duration = min(
+                    self.measure(experiment, options['format'])
+                    for _ in range(max(options['repeat'], 1))
+                )
+            if baseline is None:
+                baseline = duration
+            self.stdout.write(
+                "{:>8} {:>8} {:>9.3f}s {:>14.0f} {:>9.1f} {:>8.2f}x".format(
+                    amount, thread_amount, duration, count / duration,
+                    size / 1024 ** 2 / duration, baseline / duration
+                )
+            )
+
+    @staticmethod
+    def measure(experiment, file_format) -> float:
+        start = time.perf_counter()
+        response = create_download_response_zip(file_format, experiment)
+        for _ in response.streaming_content:
+            pass
+        return time.perf_counter() - start
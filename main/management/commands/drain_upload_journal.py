@@ -0,0 +1,182 @@
+import fcntl
+import os
+import time
+from itertools import groupby, islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api import journal
+from api.models import JournalCheckpoint
+from api.parsers import TextPayload
+from experiments.models import DataPoint, Experiment, ParticipantSession
+
+
+class Command(BaseCommand):
+    help = 'Stores the uploads in the upload journal (see ' \
+           'API_UPLOAD_JOURNAL_DIR) as datapoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of records stored per transaction',
+        )
+        parser.add_argument(
+            '--follow',
+            action='store_true',
+            help='Keep draining the journal until interrupted',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait between two runs with --follow',
+        )
+
+    def handle(self, *args, **options):
+        directory = settings.API_UPLOAD_JOURNAL_DIR
+        if not directory:
+            raise CommandError('API_UPLOAD_JOURNAL_DIR is not configured')
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, 'drain.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise CommandError('The journal is already being drained')
+
+            if not options['follow']:
+                self.drain(directory, options['batch_size'])
+                return
+
+            try:
+                while True:
+                    self.drain(directory, options['batch_size'])
+                    time.sleep(options['interval'])
+            except KeyboardInterrupt:
+                pass
+
+    def drain(self, directory, batch_size):
+        segments = journal.list_segments(directory)
+        # Left behind when a drain stopped between removing a segment and
+        # its checkpoint
+        JournalCheckpoint.objects.exclude(segment__in=segments).delete()
+
+        stored = 0
+        for name in segments:
+            stored += self.drain_segment(directory, name, batch_size)
+
+        if stored or self.verbosity > 1:
+            self.stdout.write("Stored {} datapoint(s)".format(stored))
+
+    def drain_segment(self, directory, name, batch_size) -> int:
+        path = os.path.join(directory, name)
+        with open(path, 'rb') as segment:
+            # Writers keep their current segment locked, so if we can lock it
+            # no more records will be added to it
+            try:
+                fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                finished = True
+            except BlockingIOError:
+                finished = False
+
+            checkpoint, _ = JournalCheckpoint.objects.get_or_create(
+                segment=name
+            )
+            offset = checkpoint.offset
+            stored = 0
+
+            records = journal.read_records(segment, offset)
+            while True:
+                batch = list(islice(records, batch_size))
+                if not batch:
+                    break
+
+                with transaction.atomic():
+                    stored += self.store([record for record, _ in batch])
+                    offset = batch[-1][1]
+                    JournalCheckpoint.objects.filter(pk=checkpoint.pk)\
+                        .update(offset=offset)
+
+            if not finished:
+                return stored
+
+            # Anything after the last complete record was never acknowledged,
+            # as the writer failed before it could fsync it
+            size = os.fstat(segment.fileno()).st_size
+            if offset < size:
+                self.stderr.write(
+                    "{}: discarded {} byte(s) of incomplete data".format(
+                        name, size - offset
+                    )
+                )
+            os.remove(path)
+            checkpoint.delete()
+
+        return stored
+
+    def store(self, records) -> int:
+        """Stores the records as datapoints, in order. Returns the number of
+        datapoints created.
+
+        Records with 'complete' set also get the session bookkeeping the
+        upload views skipped: their session is completed, or for uploads
+        without a session, a new completed session is created for every
+        record."""
+        experiments = Experiment.objects.in_bulk(
+            {record['experiment'] for record in records}
+        )
+        sessions = ParticipantSession.objects.in_bulk(
+            {record['session'] for record in records} - {None}
+        )
+
+        stored = 0
+        key = lambda record: (  # NOQA
+            record['experiment'],
+            record['session'],
+            record.get('complete', False),
+        )
+        for (experiment_id, session_id, complete), group in groupby(records,
+                                                                    key=key):
+            experiment = experiments.get(experiment_id)
+            session = sessions.get(session_id)
+            # The data would have been deleted along with its experiment or
+            # session, had it been stored already
+            if experiment is None or (session_id and session is None):
+                self.stderr.write(
+                    "Skipped data of deleted experiment {} / session "
+                    "{}".format(experiment_id, session_id)
+                )
+                continue
+
+            if complete and session is None:
+                # Like UploadView, one session per upload
+                for record in group:
+                    session = ParticipantSession.objects.create(
+                        experiment=experiment,
+                        experiment_state=record['experiment_state'],
+                        group=experiment.targetgroup_set.first()
+                    )
+                    stored += self.store_data(experiment, [record], session,
+                                              complete)
+                continue
+
+            stored += self.store_data(experiment, list(group), session,
+                                      complete)
+
+        return stored
+
+    @staticmethod
+    def store_data(experiment, records, session, complete) -> int:
+        created = DataPoint.bulk_create_data(
+            experiment,
+            [TextPayload(record['data'], record['size'])
+             for record in records],
+            session
+        )
+        if complete:
+            session.complete()
+        return len(created)
@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.models import Experiment
+from experiments.utils.fake_data import FakeDataGenerator
+from main.models import User
+
+
+class Command(BaseCommand):
+    help = 'Creates experiments filled with fake sessions and datapoints, ' \
+           'for benchmarks. The same seed always generates the same data.'
+
+    states = {
+        'open': Experiment.OPEN,
+        'closed': Experiment.CLOSED,
+        'piloting': Experiment.PILOTING,
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--experiments', type=int, default=1,
+                            help='Number of experiments to create')
+        parser.add_argument('--groups', type=int, default=4,
+                            help='Number of target groups per experiment')
+        parser.add_argument('--sessions', type=int, default=1000,
+                            help='Number of sessions per experiment')
+        parser.add_argument('--datapoints', type=int, default=100_000,
+                            help='Number of datapoints per experiment')
+        parser.add_argument('--trials', type=int, default=50,
+                            help='Average number of trials in a payload')
+        parser.add_argument('--binary-fraction', type=float, default=0.0,
+                            help='Fraction of the datapoints that is a '
+                                 'binary file')
+        parser.add_argument('--binary-size', type=int, default=100 * 1024,
+                            help='Average size of a binary file, in bytes')
+        parser.add_argument('--completed-fraction', type=float, default=0.9,
+                            help='Fraction of the sessions that is completed')
+        parser.add_argument('--state', choices=self.states, default='open')
+        parser.add_argument('--user', type=str,
+                            help='Username of a user to give access to the '
+                                 'experiments')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of rows per insert')
+
+    def handle(self, *args, **options):
+        users = []
+        if options['user']:
+            try:
+                users.append(User.objects.get(username=options['user']))
+            except User.DoesNotExist:
+                raise CommandError('Unknown user {}'.format(options['user']))
+
+        if options['groups'] < 1:
+            raise CommandError('An experiment needs at least one group')
+
+        generator = FakeDataGenerator(
+            seed=options['seed'],
+            trials=options['trials'],
+            binary_fraction=options['binary_fraction'],
+            binary_size=options['binary_size'],
+            completed_fraction=options['completed_fraction'],
+            batch_size=options['batch_size'],
+        )
+
+        for i in range(options['experiments']):
+            experiment = generator.create_experiment(
+                'Fake data {}-{}'.format(options['seed'], i + 1),
+                groups=options['groups'],
+                users=users,
+                folder_name='fake-data-{}-{}'.format(options['seed'], i + 1),
+                state=self.states[options['state']],
+            )
+            session_ids = generator.create_sessions(experiment,
+                                                    options['sessions'])
+            generator.create_datapoints(experiment, options['datapoints'],
+                                        session_ids)
+
+            self.stdout.write(
+                'Created experiment {} ({}) with {} sessions and {} '
+                'datapoints'.format(experiment.pk, experiment.access_id,
+                                    len(session_ids), options['datapoints'])
+            )
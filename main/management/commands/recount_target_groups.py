@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+from api.cache import invalidate_experiment
+from experiments.models import Experiment, ParticipantSession, TargetGroup
+
+
+class Command(BaseCommand):
+    help = 'Re-derives the session counters of all target groups from the ' \
+           'sessions themselves, and reports any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only report drift, don't correct the counters",
+        )
+
+    def handle(self, *args, **options):
+        drifted = 0
+        group_ids = TargetGroup.objects.order_by('pk')\
+            .values_list('pk', flat=True)
+
+        for group_id in group_ids.iterator():
+            with transaction.atomic():
+                # Lock the group, so no session can change its counters
+                # while we're counting
+                try:
+                    group = TargetGroup.objects.select_for_update()\
+                        .select_related('experiment').get(pk=group_id)
+                except TargetGroup.DoesNotExist:
+                    continue
+
+                actual = self.count_sessions(group)
+                stored = {field: getattr(group, field) for field in actual}
+                if actual == stored:
+                    continue
+
+                drifted += 1
+                self.stdout.write("{} / {} ({}): {}".format(
+                    group.experiment.title,
+                    group.name,
+                    group.pk,
+                    ", ".join(
+                        "{} {} -> {}".format(field, stored[field], value)
+                        for field, value in actual.items()
+                        if stored[field] != value
+                    )
+                ))
+
+                if not options['dry_run']:
+                    TargetGroup.objects.filter(pk=group.pk).update(**actual)
+                    invalidate_experiment(group.experiment.access_id)
+
+        self.stdout.write("{} group(s) with drifted counters{}".format(
+            drifted,
+            " (not corrected)" if options['dry_run'] and drifted else ""
+        ))
+
+    @staticmethod
+    def count_sessions(group: TargetGroup) -> dict:
+        def _completed(experiment_state):
+            return models.Count(
+                'pk',
+                filter=models.Q(state=ParticipantSession.COMPLETED,
+                                experiment_state=experiment_state)
+            )
+
+        return ParticipantSession.objects.filter(group=group).aggregate(
+            started_count=models.Count('pk'),
+            completed_count=_completed(Experiment.OPEN),
+            pilot_completed_count=_completed(Experiment.PILOTING),
+        )
@@ -257,6 +257,108 @@ REST_FRAMEWORK = {
     'EXCEPTION_HANDLER': 'api.exceptions.exception_handler',
 }
 
+# API
+
+# Default maximum size of a single upload, in bytes. Can be overridden per
+# experiment
+API_MAX_UPLOAD_SIZE = 32 * 1024 ** 2
+
+# Maximum number of lines in a single batch upload
+API_BATCH_UPLOAD_MAX_ITEMS = 1000
+
+# Maximum number of participant sessions created in a single request
+API_PARTICIPANT_BATCH_MAX_SIZE = 1000
+
+# Seconds the API keeps an experiment in the cache. Changes made through the
+# models invalidate the entry right away, but only in the cache of the process
+# making them. With the default (local memory) cache, other processes would
+# serve the old entry until it expires, and for example keep accepting uploads
+# for a closed experiment. Only enable this with a cache in CACHES that all
+# processes share, like Redis or Memcached. None (the default) disables this
+API_EXPERIMENT_CACHE_TIMEOUT = None
+
+# Cache-Control directives of the metadata endpoint, which experiment front-ends
+# poll. These are passed to django.utils.cache.patch_cache_control. Responses
+# carry an ETag, so clients and proxies can revalidate cheaply after max-age.
+API_METADATA_CACHE_CONTROL = {
+    'public': True,
+    'max_age': 5,
+}
+
+# Default rate limit of the API per experiment, as a token bucket: '6000/min'
+# allows bursts of 6000 requests, refilled at 6000 a minute. Can be set per
+# experiment. The buckets are kept in the cache, so with the default (local
+# memory) cache every process has its own, and the effective limit grows with
+# the number of processes. Only set a limit, here or per experiment, with a
+# cache in CACHES that all processes share. None (the default) disables the
+# limit
+API_THROTTLE_RATE = None
+
+# The API rejects part of the requests with a 503 once the average duration of
+# its queries exceeds this many seconds. None disables load shedding
+API_LOAD_SHEDDING_LATENCY = 0.5
+# Retry-After of a rejected request, in seconds
+API_LOAD_SHEDDING_RETRY_AFTER = 10
+
+# Size of the thread pool the async API views use for database work
+API_ASYNC_WORKERS = 8
+
+# Resumable binary uploads are spooled in this directory until finalized
+API_CHUNKED_UPLOAD_DIR = os.path.join(BASE_DIR, 'chunked_uploads')
+# Maximum size of a resumable upload, in bytes
+API_CHUNKED_UPLOAD_MAX_SIZE = 2 * 1024 ** 3
+# Resumable uploads without any activity for this many seconds are removed by
+# the api_sweep management command
+API_CHUNKED_UPLOAD_EXPIRY = 24 * 60 * 60
+
+# Results of uploads sent with an Idempotency-Key header are kept for this many
+# seconds, after which the api_sweep management command removes them. Retries
+# arriving later are stored as new uploads.
+API_IDEMPOTENCY_KEY_EXPIRY = 24 * 60 * 60
+
+# When set, text uploads are appended to a write-ahead journal in this
+# directory, and acknowledged as soon as they are on disk. The
+# drain_upload_journal management command (run with --follow as a service)
+# then stores them as datapoints. Until then, they are not visible in the
+# application, and their date_added is the time they were drained. The same
+# goes for the sessions the uploads complete (or create, for uploads without
+# a session), so the upload requests do not write to the database at all.
+API_UPLOAD_JOURNAL_DIR = None
+# Journal segments are rotated once they grow beyond this size, in bytes
+API_UPLOAD_JOURNAL_SEGMENT_SIZE = 64 * 1024 ** 2
+
+# Exports
+
+# Exports decrypt and convert the datapoints in a pool of this many workers,
+# shared by all exports of a process. 0 converts them in the thread serving
+# the download. The benchmark_export management command compares settings
+EXPORT_WORKERS = 0
+# Either 'process' or 'thread'. Conversion holds the GIL most of the time, so
+# threads hardly use more than one core
+EXPORT_WORKER_TYPE = 'process'
+# Exports deflate their entries in a pool of this many threads. 0 deflates
+# them in the thread serving the download
+EXPORT_COMPRESSION_THREADS = 4
+# Full exports of every experiment can be kept in this directory, and appended
+# to when new data comes in, so downloading all data again only costs sending a
+# file. These exports hold the data decrypted, unlike the database, and are kept
+# until the experiment is deleted. Only enable this on storage that is as well
+# protected as the data itself, like an encrypted volume only the application
+# can read. None (the default) disables this
+EXPORT_CACHE_DIR = None
+# Uploaded files with these extensions are already compressed, so exports
+# store them without compressing them again
+EXPORT_STORED_EXTENSIONS = [
+    # Audio
+    'aac', 'flac', 'm4a', 'mp3', 'oga', 'ogg', 'opus', 'weba',
+    # Video
+    'avi', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'ogv', 'webm',
+    # Images
+    'gif', 'heic', 'jpeg', 'jpg', 'png', 'webp',
+    # Archives
+    '7z', 'bz2', 'gz', 'xz', 'zip',
+]
+
 FORM_RENDERER = 'django.forms.renderers.TemplatesSetting'
 
 SILENCED_SYSTEM_CHECKS = ["cdh.files.W001"]